@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""swap, swap-off and get-env end to end against a stand-in API server
+
+Starts benchmarks/fake_apiserver.py with a namespace of every size, runs the
+real swap_deployment.py against it and reports wall time, Kubernetes API
+requests and peak memory per scenario. With --baseline the results are
+compared to an earlier --save, more API requests than before, or more time or
+memory than the tolerance allows, fails the run with exit status 1.
+
+Usage:
+  e2e_bench.py [--sizes=<sizes>] [--latency_ms=<ms>] [--workers=<n>] [--save=<file>] [--baseline=<file>] [--tolerance=<percent>] [--json]
+  e2e_bench.py (-h | --help)
+
+Options:
+  -h --help               Show this screen.
+  --sizes=<sizes>         Deployments in the namespace, comma separated [default: 10,100,1000,10000].
+  --latency_ms=<ms>       Delay added to every API request [default: 5].
+  --workers=<n>           --workers for the selector scenarios [default: 4].
+  --save=<file>           Write the results as json.
+  --baseline=<file>       Compare with results written by --save.
+  --tolerance=<percent>   Allowed growth of wall time and memory over the baseline [default: 50].
+  --json                  Print the results as json.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+from docopt import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_APISERVER = os.path.join(ROOT, "benchmarks", "fake_apiserver.py")
+
+SCENARIOS = [
+    ("swap", ["swap", "--deployment=app-0"]),
+    ("swap again", ["swap", "--deployment=app-0"]),
+    ("swap-off", ["swap-off", "--deployment=app-0"]),
+    ("swap wait", ["swap", "--deployment=app-0", "--wait", "--timeout=30"]),
+    ("swap-off wait", ["swap-off", "--deployment=app-0", "--wait", "--timeout=30"]),
+    ("swap selector", ["swap", "--selector=group=g0", "--workers={workers}", "--wait", "--timeout=30"]),
+    ("swap-off selector", ["swap-off", "--selector=group=g0", "--workers={workers}", "--wait",
+                           "--timeout=30"]),
+    ("get-env", ["get-env", "--deployment=app-1", "--ttl=0"]),
+    ("get-env exec", ["get-env", "--deployment=app-1", "--exec"]),
+]
+
+
+def api_requests(url):
+    with urlopen(f"{url}/fake/requests") as response:
+        return json.load(response)["total"]
+
+
+def run_scenario(command, env, url):
+    """wall seconds, API requests and peak RSS in KB of one swap_deployment.py run"""
+    before = api_requests(url)
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "swap_deployment.py"),
+                                 *command], cwd=ROOT, env=env,
+                                stdout=subprocess.DEVNULL, stderr=stderr)
+        # wait4 instead of wait, for the peak RSS of this child alone
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stderr.seek(0)
+        output = stderr.read()
+    failed = proc.returncode != 0 or b"failed" in output
+    if failed:
+        print(output.decode(errors="replace"), file=sys.stderr)
+    return {
+        "wall": wall,
+        "api_calls": api_requests(url) - before - 1,
+        "max_rss_kb": usage.ru_maxrss,
+        "ok": not failed,
+    }
+
+
+def run_size(size, args, env):
+    # a process of its own, children forked from a big parent would report its memory
+    with tempfile.NamedTemporaryFile("w+t", suffix=".kubeconfig", delete=False) as kubeconfig:
+        pass
+    server = subprocess.Popen(
+        [sys.executable, FAKE_APISERVER, f"--deployments={size}",
+         f"--latency_ms={args['--latency_ms']}", f"--kubeconfig={kubeconfig.name}"],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    url = server.stdout.readline().split()[-1]
+    env = dict(env, KUBECONFIG=kubeconfig.name)
+    results = {}
+    try:
+        for name, command in SCENARIOS:
+            command = [part.format(workers=args['--workers']) for part in command]
+            results[name] = run_scenario(command, env, url)
+    finally:
+        server.terminate()
+        server.wait()
+        os.remove(kubeconfig.name)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if not result["ok"]:
+            found.append(f"{key}: failed")
+        if result["api_calls"] > base["api_calls"]:
+            found.append(f"{key}: {result['api_calls']} api calls, was {base['api_calls']}")
+        for metric in ("wall", "max_rss_kb"):
+            if base[metric] and result[metric] > base[metric] * (1 + tolerance):
+                found.append(f"{key}: {metric} {result[metric]:.2f}, was {base[metric]:.2f}")
+    return found
+
+
+def main():
+    args = docopt(__doc__)
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    results = {}
+    for size in [int(size) for size in args['--sizes'].split(",")]:
+        for name, result in run_size(size, args, env).items():
+            results[f"{size}/{name}"] = result
+
+    if args['--json']:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'deployments/scenario':<28}{'wall s':>10}{'api calls':>11}{'peak MB':>10}  ok")
+        for key, result in results.items():
+            print(f"{key:<28}{result['wall']:>10.2f}{result['api_calls']:>11}"
+                  f"{(result['max_rss_kb'] or 0) / 1024:>10.1f}  {'yes' if result['ok'] else 'NO'}")
+    if args['--save']:
+        with open(args['--save'], "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = [key for key, result in results.items() if not result["ok"]]
+    if args['--baseline']:
+        with open(args['--baseline']) as f:
+            baseline = json.load(f)
+        failed += regressions(results, baseline, int(args['--tolerance']) / 100)
+    for line in failed:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
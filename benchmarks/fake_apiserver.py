@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""Stand-in Kubernetes API server for the benchmarks
+
+Serves just what swap_deployment.py talks to: extensions/v1beta1 deployments
+and their scale, configmaps, secrets, pods with exec, services, endpoints and
+autoscaling/v1 HPAs, with list, watch, create, replace, patch and delete. A
+tiny controller makes every deployment's pods exist and be Ready right away,
+endpoints follow the ready pods. Exec runs the command on this machine with the
+container environment of the pod. Every request can be delayed to simulate a
+remote API server, and requests are counted per verb and resource, GET
+/fake/requests returns the counts.
+
+Usage:
+  fake_apiserver.py [--deployments=<n>] [--latency_ms=<ms>] [--port=<port>] [--kubeconfig=<file>]
+  fake_apiserver.py (-h | --help)
+
+Options:
+  -h --help               Show this screen.
+  --deployments=<n>       Deployments app-<i> in namespace bench [default: 10].
+  --latency_ms=<ms>       Delay added to every request [default: 0].
+  --port=<port>           Port to listen on, a free one by default [default: 0].
+  --kubeconfig=<file>     Write a kubeconfig for the server to this file.
+"""
+import base64
+import copy
+import hashlib
+import itertools
+import json
+import re
+import socket
+import subprocess
+import threading
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+PATH = re.compile(
+    r"^/(?:api/v1|apis/(?P<group>[^/]+)/(?P<version>[^/]+))(?:/namespaces/(?P<namespace>[^/]+))?"
+    r"/(?P<resource>[^/]+)(?:/(?P<name>[^/]+))?(?:/(?P<sub>[^/]+))?$"
+)
+KINDS = {
+    "deployments": ("Deployment", "extensions/v1beta1"),
+    "configmaps": ("ConfigMap", "v1"),
+    "secrets": ("Secret", "v1"),
+    "pods": ("Pod", "v1"),
+    "services": ("Service", "v1"),
+    "endpoints": ("Endpoints", "v1"),
+    "horizontalpodautoscalers": ("HorizontalPodAutoscaler", "autoscaling/v1"),
+}
+
+
+class ApiError(Exception):
+    def __init__(self, code, reason, message):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+
+
+def now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def merge(target, patch):
+    """Merge patch, None removes a key"""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def parse_selector(selector):
+    """[(key, op, value), ...] for k=v, k==v, k!=v, k and !k"""
+    terms = []
+    for term in (selector or "").split(","):
+        term = term.strip()
+        if not term:
+            continue
+        if "!=" in term:
+            key, value = term.split("!=", 1)
+            terms.append((key, "!=", value))
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            terms.append((key, "=", value.lstrip("=")))
+        elif term.startswith("!"):
+            terms.append((term[1:], "!", None))
+        else:
+            terms.append((term, "exists", None))
+    return terms
+
+
+def matches(labels, terms):
+    for key, op, value in terms:
+        if op == "=" and labels.get(key) != value:
+            return False
+        if op == "!=" and labels.get(key) == value:
+            return False
+        if op == "!" and key in labels:
+            return False
+        if op == "exists" and key not in labels:
+            return False
+    return True
+
+
+class FakeCluster:
+    """Objects of one namespace plus the controller that keeps pods in line"""
+
+    def __init__(self, namespace="bench"):
+        self.namespace = namespace
+        self.lock = threading.RLock()
+        self.objects = {resource: {} for resource in KINDS if resource != "endpoints"}
+        self.versions = itertools.count(1)
+        self.pod_ips = itertools.count(1)
+        self.owned_pods = {}
+        self.requests = Counter()
+
+    def populate(self, deployments, replicas=1):
+        """deployments apps app-<i>, each with a configmap, secret, service and pods"""
+        for i in range(deployments):
+            name = f"app-{i}"
+            labels = {"app": name, "group": f"g{i // 10}"}
+            self.store("configmaps", {
+                "metadata": {"name": f"{name}-config"},
+                "data": {"LOG_LEVEL": "info", "REDIS_HOST": f"{name}-redis"},
+            })
+            self.store("secrets", {
+                "metadata": {"name": f"{name}-secret"},
+                "data": {"PASSWORD": base64.b64encode(f"secret-{i}".encode()).decode()},
+            })
+            self.store("services", {
+                "metadata": {"name": name, "labels": dict(labels)},
+                "spec": {"selector": {"app": name},
+                         "ports": [{"name": "http", "port": 80, "targetPort": 80}]},
+            })
+            self.store("deployments", {
+                "metadata": {"name": name, "labels": dict(labels)},
+                "spec": {
+                    "replicas": replicas,
+                    "selector": {"matchLabels": {"app": name}},
+                    "template": {
+                        "metadata": {"labels": dict(labels)},
+                        "spec": {"containers": [{
+                            "name": name,
+                            "image": "registry.example/app:1",
+                            "args": ["serve"],
+                            "ports": [{"containerPort": 80, "protocol": "TCP"}],
+                            "envFrom": [{"configMapRef": {"name": f"{name}-config"}}],
+                            "env": [
+                                {"name": "SERVICE", "value": name},
+                                {"name": "URL", "value": "http://$(SERVICE):80"},
+                                {"name": "PASSWORD", "valueFrom": {"secretKeyRef": {
+                                    "name": f"{name}-secret", "key": "PASSWORD"}}},
+                                {"name": "POD_IP", "valueFrom": {"fieldRef": {
+                                    "fieldPath": "status.podIP"}}},
+                            ],
+                            "readinessProbe": {"httpGet": {"path": "/ready", "port": 80}},
+                        }]},
+                    },
+                },
+            })
+
+    def store(self, resource, obj):
+        kind, api_version = KINDS[resource]
+        obj["kind"], obj["apiVersion"] = kind, api_version
+        metadata = obj.setdefault("metadata", {})
+        metadata["namespace"] = self.namespace
+        metadata.setdefault("uid", hashlib.md5(
+            f"{resource}/{metadata['name']}".encode()).hexdigest())
+        metadata.setdefault("creationTimestamp", now())
+        metadata["resourceVersion"] = str(next(self.versions))
+        if resource == "deployments":
+            metadata.setdefault("generation", 1)
+        self.objects[resource][metadata["name"]] = obj
+        if resource == "deployments":
+            self.reconcile(obj)
+        return obj
+
+    def reconcile(self, deployment):
+        """Pods for the current template and replicas, all Ready"""
+        name = deployment["metadata"]["name"]
+        spec = deployment["spec"]
+        template = spec["template"]
+        revision = hashlib.md5(json.dumps(template, sort_keys=True).encode()).hexdigest()[:8]
+        replicas = spec.get("replicas", 1)
+        pods = self.objects["pods"]
+        owned = self.owned_pods.setdefault(name, set())
+        wanted = {f"{name}-{revision}-{i}" for i in range(replicas)}
+        for pod_name in owned - wanted:
+            del pods[pod_name]
+        for pod_name in sorted(wanted - owned):
+            created = now()
+            ip = next(self.pod_ips)
+            pods[pod_name] = {
+                "kind": "Pod", "apiVersion": "v1",
+                "metadata": {
+                    "name": pod_name, "namespace": self.namespace,
+                    "labels": dict(template["metadata"].get("labels") or {}),
+                    "creationTimestamp": created,
+                    "resourceVersion": str(next(self.versions)),
+                },
+                "spec": copy.deepcopy(template["spec"]),
+                "status": {
+                    "phase": "Running",
+                    "podIP": f"10.{ip // 65536 % 256}.{ip // 256 % 256}.{ip % 256}",
+                    "conditions": [
+                        {"type": condition, "status": "True", "lastTransitionTime": created}
+                        for condition in ("PodScheduled", "Initialized", "ContainersReady", "Ready")
+                    ],
+                },
+            }
+        self.owned_pods[name] = wanted
+        deployment["status"] = {
+            "observedGeneration": deployment["metadata"]["generation"],
+            "replicas": replicas,
+            "readyReplicas": replicas,
+            "updatedReplicas": replicas,
+            "availableReplicas": replicas,
+        }
+
+    def endpoints(self, service):
+        selector = service["spec"].get("selector") or {}
+        addresses = [
+            {"ip": pod["status"]["podIP"], "targetRef": {"kind": "Pod", "name": pod["metadata"]["name"]}}
+            for pod in self.objects["pods"].values()
+            if selector and all(pod["metadata"]["labels"].get(k) == v for k, v in selector.items())
+        ]
+        return {
+            "kind": "Endpoints", "apiVersion": "v1",
+            "metadata": {"name": service["metadata"]["name"], "namespace": self.namespace,
+                         "resourceVersion": service["metadata"]["resourceVersion"]},
+            "subsets": [{"addresses": addresses,
+                         "ports": [{"port": p["port"], "name": p.get("name")}
+                                   for p in service["spec"]["ports"]]}] if addresses else [],
+        }
+
+    def collection(self, resource, name=None):
+        if resource == "endpoints":
+            services = self.objects["services"]
+            if name is not None:
+                services = {name: services[name]} if name in services else {}
+            return {name: self.endpoints(service) for name, service in services.items()}
+        if resource not in self.objects:
+            raise ApiError(404, "NotFound", f"the server could not find {resource}")
+        return self.objects[resource]
+
+    def get(self, resource, name):
+        obj = self.collection(resource, name).get(name)
+        if obj is None:
+            raise ApiError(404, "NotFound", f'{resource} "{name}" not found')
+        return obj
+
+    def list(self, resource, label_selector=None, field_selector=None):
+        terms = parse_selector(label_selector)
+        name = None
+        if field_selector and field_selector.startswith("metadata.name="):
+            name = field_selector.split("=", 1)[1]
+        return [
+            obj for obj in self.collection(resource, name).values()
+            if (name is None or obj["metadata"]["name"] == name)
+            and matches(obj["metadata"].get("labels") or {}, terms)
+        ]
+
+    def create(self, resource, body):
+        name = body["metadata"]["name"]
+        if name in self.collection(resource):
+            raise ApiError(409, "AlreadyExists", f'{resource} "{name}" already exists')
+        body["metadata"].pop("resourceVersion", None)
+        return self.store(resource, body)
+
+    def replace(self, resource, name, body):
+        current = self.get(resource, name)
+        body["metadata"]["uid"] = current["metadata"]["uid"]
+        body["metadata"]["creationTimestamp"] = current["metadata"]["creationTimestamp"]
+        if resource == "deployments":
+            generation = current["metadata"]["generation"]
+            changed = body.get("spec") != current.get("spec")
+            body["metadata"]["generation"] = generation + 1 if changed else generation
+        return self.store(resource, body)
+
+    def patch(self, resource, name, patch, sub=None):
+        current = copy.deepcopy(self.get(resource, name))
+        if sub == "scale":
+            patch = {"spec": {"replicas": patch["spec"]["replicas"]}}
+        spec = copy.deepcopy(current.get("spec"))
+        merge(current, patch)
+        if resource == "deployments" and current.get("spec") != spec:
+            current["metadata"]["generation"] += 1
+        obj = self.store(resource, current)
+        if sub == "scale":
+            return {
+                "kind": "Scale", "apiVersion": "extensions/v1beta1",
+                "metadata": {"name": name, "namespace": self.namespace},
+                "spec": {"replicas": obj["spec"]["replicas"]},
+                "status": {"replicas": obj["spec"]["replicas"]},
+            }
+        return obj
+
+    def delete(self, resource, name):
+        self.get(resource, name)
+        del self.objects[resource][name]
+        if resource == "deployments":
+            for pod_name in self.owned_pods.pop(name, ()):
+                del self.objects["pods"][pod_name]
+        return {"kind": "Status", "apiVersion": "v1", "status": "Success", "metadata": {}}
+
+    def container_env(self, pod, container_name):
+        """Environment the kubelet would give the container"""
+        container = next(c for c in pod["spec"]["containers"] if c["name"] == container_name)
+        env = {}
+        for env_from in container.get("envFrom") or []:
+            if "configMapRef" in env_from:
+                source = self.objects["configmaps"].get(env_from["configMapRef"]["name"], {})
+                env.update(source.get("data") or {})
+        for var in container.get("env") or []:
+            value_from = var.get("valueFrom")
+            if not value_from:
+                env[var["name"]] = re.sub(r"\$\((\w+)\)", lambda m: env.get(m.group(1), ""),
+                                          var.get("value", ""))
+            elif "secretKeyRef" in value_from:
+                ref = value_from["secretKeyRef"]
+                data = self.objects["secrets"].get(ref["name"], {}).get("data") or {}
+                env[var["name"]] = base64.b64decode(data.get(ref["key"], "")).decode()
+            elif "configMapKeyRef" in value_from:
+                ref = value_from["configMapKeyRef"]
+                data = self.objects["configmaps"].get(ref["name"], {}).get("data") or {}
+                env[var["name"]] = data.get(ref["key"], "")
+            elif "fieldRef" in value_from:
+                path = value_from["fieldRef"]["fieldPath"]
+                env[var["name"]] = {
+                    "metadata.name": pod["metadata"]["name"],
+                    "metadata.namespace": self.namespace,
+                    "status.podIP": pod["status"]["podIP"],
+                    "spec.nodeName": "fake-node",
+                }.get(path, "")
+        env.setdefault("PATH", "/usr/local/bin:/usr/bin:/bin")
+        return env
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # headers and body go out as separate writes
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_status(self, error):
+        self.send_json(error.code, {
+            "kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Failure",
+            "message": str(error), "reason": error.reason, "code": error.code,
+        })
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def route(self, verb):
+        cluster = self.server.cluster
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        if url.path == "/fake/requests":
+            with cluster.lock:
+                counts = {f"{verb} {resource}": n for (verb, resource), n in cluster.requests.items()}
+            return self.send_json(200, {"total": sum(counts.values()), "requests": counts})
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        match = PATH.match(url.path)
+        if not match:
+            return self.send_error_status(ApiError(404, "NotFound", url.path))
+        resource, name, sub = match.group("resource", "name", "sub")
+        watch = query.get("watch") in ("true", "True", "1")
+        with cluster.lock:
+            cluster.requests[(verb if not watch else "watch", resource)] += 1
+        if sub == "exec":
+            return self.exec(name, parse_qs(url.query))
+        try:
+            with cluster.lock:
+                if verb == "get" and name:
+                    result = cluster.get(resource, name)
+                elif verb == "get":
+                    items = cluster.list(resource, query.get("labelSelector"),
+                                         query.get("fieldSelector"))
+                    if watch:
+                        return self.send_watch(items)
+                    kind, api_version = KINDS[resource]
+                    result = {"kind": f"{kind}List", "apiVersion": api_version,
+                              "metadata": {"resourceVersion": str(next(cluster.versions))},
+                              "items": items}
+                elif verb == "post":
+                    return self.send_json(201, cluster.create(resource, self.read_body()))
+                elif verb == "put":
+                    result = cluster.replace(resource, name, self.read_body())
+                elif verb == "patch":
+                    result = cluster.patch(resource, name, self.read_body(), sub)
+                else:
+                    self.read_body()
+                    result = cluster.delete(resource, name)
+                data = json.dumps(result)
+        except ApiError as e:
+            return self.send_error_status(e)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data.encode())
+
+    def send_watch(self, items):
+        """Current state as ADDED events, then the watch ends"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for item in items:
+            line = json.dumps({"type": "ADDED", "object": item}).encode() + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def exec(self, pod_name, query):
+        """Websocket exec, v4.channel.k8s.io: stdout on channel 1, status on channel 3"""
+        cluster = self.server.cluster
+        with cluster.lock:
+            pod = cluster.objects["pods"].get(pod_name)
+            env = pod and cluster.container_env(pod, query["container"][-1])
+        key = self.headers["Sec-WebSocket-Key"]
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest())
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept.decode())
+        self.send_header("Sec-WebSocket-Protocol", "v4.channel.k8s.io")
+        self.end_headers()
+        if env is None:
+            output, status = b"", {"status": "Failure", "message": "pod not found"}
+        else:
+            proc = subprocess.run(query["command"], env=env, capture_output=True, timeout=30)
+            output, status = proc.stdout, {"metadata": {}, "status": "Success"}
+        for channel, payload in ((1, output), (3, json.dumps(status).encode())):
+            if payload:
+                self.wfile.write(self.frame(0x82, bytes([channel]) + payload))
+        self.wfile.write(self.frame(0x88, b"\x03\xe8"))
+        self.wfile.flush()
+        self.close_connection = True
+
+    @staticmethod
+    def frame(opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = bytes([opcode, length])
+        elif length < 65536:
+            header = bytes([opcode, 126]) + length.to_bytes(2, "big")
+        else:
+            header = bytes([opcode, 127]) + length.to_bytes(8, "big")
+        return header + payload
+
+    def do_GET(self):
+        self.route("get")
+
+    def do_POST(self):
+        self.route("post")
+
+    def do_PUT(self):
+        self.route("put")
+
+    def do_PATCH(self):
+        self.route("patch")
+
+    def do_DELETE(self):
+        self.route("delete")
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cluster, latency=0.0, port=0):
+        self.cluster = cluster
+        self.latency = latency
+        super().__init__(("127.0.0.1", port), FakeApiHandler)
+
+    def handle_error(self, request, client_address):
+        # clients hanging up after exec or a watch are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def kubeconfig(self):
+        return KUBECONFIG.format(server=self.url, namespace=self.cluster.namespace)
+
+
+KUBECONFIG = """apiVersion: v1
+kind: Config
+clusters:
+- cluster: {{server: '{server}'}}
+  name: fake
+contexts:
+- context: {{cluster: fake, user: fake, namespace: {namespace}}}
+  name: fake
+current-context: fake
+users:
+- name: fake
+  user: {{token: fake}}
+"""
+
+
+def main():
+    from docopt import docopt
+
+    args = docopt(__doc__)
+    cluster = FakeCluster()
+    cluster.populate(int(args['--deployments']))
+    server = FakeApiServer(cluster, latency=int(args['--latency_ms']) / 1000,
+                           port=int(args['--port']))
+    if args['--kubeconfig']:
+        with open(args['--kubeconfig'], "w") as f:
+            f.write(server.kubeconfig())
+    print(f"Serving {args['--deployments']} deployments on {server.url}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
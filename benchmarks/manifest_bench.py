@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Swap manifest generation, client models against raw manifests
+
+Builds the swap of a synthetic deployment with many containers, env vars and
+volumes both ways: the kubernetes client model path swap used before
+(deserialize the response, deepcopy, change, serialize for the spec hash and
+the request body) and the raw path it uses now (json.loads, swap_manifest with
+structural sharing, serialize). Reports time and allocated memory per swap and
+checks that both give the same spec.
+
+Usage:
+  manifest_bench.py [--containers=<n>] [--env=<n>] [--volumes=<n>] [--repeat=<n>]
+  manifest_bench.py (-h | --help)
+
+Options:
+  -h --help               Show this screen.
+  --containers=<n>        Containers in the deployment [default: 10].
+  --env=<n>               Env vars per container [default: 200].
+  --volumes=<n>           Volumes, each mounted in every container [default: 50].
+  --repeat=<n>            Swaps per path [default: 50].
+"""
+import copy
+import hashlib
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from docopt import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from kubernetes import client
+from deployment_swapper import ANNOTATION_PREFIX, SWAP_LABEL, swap_manifest
+
+NAME = "big"
+SIDECAR = {
+    "name": "openvpn",
+    "image": "openvpn-sidecar",
+    "env": [{"name": "OPENVPN_PROTO", "value": "tcp"}],
+    "ports": [{"name": "openvpn", "protocol": "TCP", "containerPort": 1194}],
+    "securityContext": {"capabilities": {"add": ["NET_ADMIN"]}},
+}
+LABELS = {"remote_http_port": "80", "remote_grpc_port": "50050", "remote_host": "192.168.88.6",
+          SWAP_LABEL: NAME}
+ANNOTATIONS = {ANNOTATION_PREFIX + "owner": "bench@localhost"}
+
+
+def deployment_manifest(containers, env, volumes):
+    """A deployment as the API server would send it"""
+    probe = {"httpGet": {"path": "/health", "port": 80}, "periodSeconds": 10}
+    return {
+        "kind": "Deployment",
+        "apiVersion": "extensions/v1beta1",
+        "metadata": {
+            "name": NAME, "namespace": "bench", "uid": "0000", "resourceVersion": "1",
+            "generation": 1, "creationTimestamp": "2020-01-01T00:00:00Z",
+            "labels": {"app": NAME}, "annotations": {"team": "bench"},
+        },
+        "spec": {
+            "replicas": 3,
+            "selector": {"matchLabels": {"app": NAME}},
+            "template": {
+                "metadata": {"labels": {"app": NAME}},
+                "spec": {
+                    "containers": [{
+                        "name": f"c{c}",
+                        "image": f"registry.example.com/{NAME}/c{c}:1.0",
+                        "args": ["--serve"],
+                        "env": [{"name": f"VAR_{c}_{i}", "value": f"value-{i}" * 4}
+                                for i in range(env)],
+                        "ports": [{"containerPort": 80 + c, "protocol": "TCP"}],
+                        "resources": {"limits": {"cpu": "1", "memory": "1Gi"},
+                                      "requests": {"cpu": "100m", "memory": "128Mi"}},
+                        "livenessProbe": probe,
+                        "readinessProbe": probe,
+                        "volumeMounts": [{"name": f"v{v}", "mountPath": f"/mnt/v{v}"}
+                                         for v in range(volumes)],
+                    } for c in range(containers)],
+                    "volumes": [{"name": f"v{v}", "configMap": {"name": f"cm{v}"}}
+                                for v in range(volumes)],
+                },
+            },
+        },
+        "status": {"replicas": 3, "readyReplicas": 3, "observedGeneration": 1},
+    }
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+
+def spec_hash(api_client, spec):
+    manifest = spec if isinstance(spec, dict) else api_client.sanitize_for_serialization(spec)
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def model_path(api_client, data):
+    """Deserialize, deepcopy and change the models, serialize for hash and body"""
+    deployment = api_client.deserialize(Response(data), "ExtensionsV1beta1Deployment")
+    swap = copy.deepcopy(deployment)
+    name = f"{NAME}-swap"
+    pod_spec = swap.spec.template.spec
+    pod_spec.volumes.append(client.V1Volume(
+        name=name, config_map=client.V1ConfigMapVolumeSource(name=name, default_mode=420)))
+    pod_spec.containers[0].volume_mounts.append(
+        client.V1VolumeMount(name=name, mount_path="/etc/nginx/conf.d"))
+    swap.metadata.resource_version = None
+    for key in list(swap.metadata.annotations):
+        if key.startswith(ANNOTATION_PREFIX):
+            del swap.metadata.annotations[key]
+    swap.metadata.annotations.update(ANNOTATIONS)
+    pod_spec.containers[0].args = []
+    pod_spec.containers[0].liveness_probe = None
+    pod_spec.containers[0].image = "nginx"
+    swap.metadata.name = name
+    swap.metadata.labels.update(LABELS)
+    swap.spec.template.metadata.labels[SWAP_LABEL] = NAME
+    pod_spec.containers.append(SIDECAR)
+    spec_hash(api_client, swap.spec)
+    json.dumps(api_client.sanitize_for_serialization(swap))
+    return swap.spec
+
+
+def raw_path(api_client, data):
+    """json.loads, swap_manifest, serialize for hash and body"""
+    deployment = json.loads(data)
+    name = f"{NAME}-swap"
+    swap = swap_manifest(
+        deployment, name=name, labels=LABELS, annotations=ANNOTATIONS,
+        template_labels={SWAP_LABEL: NAME}, image="nginx", sidecars=[SIDECAR],
+        volumes=[{"name": name, "configMap": {"name": name, "defaultMode": 420}}],
+        volume_mounts=[{"name": name, "mountPath": "/etc/nginx/conf.d"}],
+    )
+    spec_hash(api_client, swap["spec"])
+    json.dumps(api_client.sanitize_for_serialization(swap))
+    return swap["spec"]
+
+
+def measure(path, api_client, data, repeat):
+    """Median seconds per swap and peak allocated KB of one swap"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        path(api_client, data)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    path(api_client, data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(times), peak / 1024
+
+
+def main():
+    args = docopt(__doc__)
+    api_client = client.ApiClient()
+    data = json.dumps(deployment_manifest(
+        int(args['--containers']), int(args['--env']), int(args['--volumes']))).encode()
+    same = spec_hash(api_client, model_path(api_client, data)) == \
+        spec_hash(api_client, raw_path(api_client, data))
+    print(f"deployment manifest {len(data) / 1024:.0f} KB, same spec both ways: "
+          f"{'yes' if same else 'NO'}")
+    print(f"{'path':<8}{'ms/swap':>10}{'peak KB':>10}")
+    results = {}
+    for name, path in (("models", model_path), ("raw", raw_path)):
+        results[name] = measure(path, api_client, data, int(args['--repeat']))
+        seconds, peak = results[name]
+        print(f"{name:<8}{seconds * 1000:>10.2f}{peak:>10.0f}")
+    print("raw is {:.1f}x faster, {:.1f}x less memory".format(
+        results["models"][0] / results["raw"][0], results["models"][1] / results["raw"][1]))
+    sys.exit(0 if same else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Compare the nginx proxy profiles against a local stand-in upstream
+
+Renders nginx_template.conf.j2 once per profile, runs a local nginx with it
+in front of a small http server that plays the developer laptop, and drives
+requests through it. The upstream adds a delay to every new connection to
+simulate the handshake over the VPN, so connection reuse shows up in the
+numbers. A "direct" row without nginx is the baseline.
+
+Usage:
+  proxy_profiles_bench.py [--requests=<n>] [--concurrency=<n>] [--body=<bytes>] [--handshake_ms=<ms>] [--profile=<profile>...]
+  proxy_profiles_bench.py (-h | --help)
+
+Options:
+  -h --help               Show this screen.
+  --requests=<n>          Requests per profile [default: 2000].
+  --concurrency=<n>       Concurrent client connections [default: 16].
+  --body=<bytes>          Response body size [default: 16384].
+  --handshake_ms=<ms>     Delay for every new upstream connection [default: 30].
+  --profile=<profile>     Only run these profiles.
+"""
+import http.client
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from docopt import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("CONF_DIR", ROOT)
+from deployment_swapper import PROXY_PROFILES, render_config_template
+
+NGINX_CONF = """daemon off;
+worker_processes 1;
+pid {tmp}/nginx.pid;
+error_log {tmp}/error.log warn;
+events {{ worker_connections 4096; }}
+http {{
+  access_log off;
+  client_body_temp_path {tmp}/client_body;
+  proxy_temp_path {tmp}/proxy;
+  fastcgi_temp_path {tmp}/fastcgi;
+  uwsgi_temp_path {tmp}/uwsgi;
+  scgi_temp_path {tmp}/scgi;
+  include {tmp}/default.conf;
+}}
+"""
+
+
+class StandInUpstream(ThreadingHTTPServer):
+    """Plays the local service at the other end of the tunnel"""
+
+    daemon_threads = True
+
+    def __init__(self, body_size, handshake_delay):
+        self.body = b"x" * body_size
+        self.handshake_delay = handshake_delay
+        self.connections = 0
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+
+    def process_request_thread(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        time.sleep(self.handshake_delay)
+        super().process_request_thread(request, client_address)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def drive(port, requests, concurrency):
+    """Keep-alive clients hammering port, returns wall time and latencies"""
+    per_client = requests // concurrency
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        latencies = []
+        for _ in range(per_client):
+            start = time.perf_counter()
+            conn.request("GET", "/")
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f"status {response.status}")
+            latencies.append(time.perf_counter() - start)
+        conn.close()
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: client(), range(concurrency)))
+    wall = time.perf_counter() - start
+    return wall, sorted(latency for latencies in results for latency in latencies)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing listening on {port}")
+
+
+def run_nginx(nginx, profile, upstream_port, tmp):
+    listen_port = free_port()
+    conf = render_config_template({
+        "remote_host": "127.0.0.1",
+        "service_id": "bench",
+        "remote_http_port": upstream_port,
+        "remote_grpc_port": upstream_port,
+        "local_percent": None,
+        "listen_http_port": listen_port,
+        "listen_grpc_port": free_port(),
+        "profile": PROXY_PROFILES[profile],
+    })
+    with open(os.path.join(tmp, "default.conf"), "w") as f:
+        f.write(conf)
+    with open(os.path.join(tmp, "nginx.conf"), "w") as f:
+        f.write(NGINX_CONF.format(tmp=tmp))
+    proc = subprocess.Popen([nginx, "-p", tmp, "-c", os.path.join(tmp, "nginx.conf")],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wait_for_port(listen_port)
+    return proc, listen_port
+
+
+def report(name, requests, wall, latencies, connections):
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name:<12}{requests / wall:>10.0f}{p50:>10.2f}{p99:>10.2f}{connections:>14}")
+
+
+def main():
+    args = docopt(__doc__)
+    requests = int(args['--requests'])
+    concurrency = int(args['--concurrency'])
+    profiles = args['--profile'] or list(PROXY_PROFILES)
+    upstream = StandInUpstream(int(args['--body']), int(args['--handshake_ms']) / 1000)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_port = upstream.server_address[1]
+
+    print(f"{'profile':<12}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'upstream conn':>14}")
+    wall, latencies = drive(upstream_port, requests, concurrency)
+    report("direct", requests, wall, latencies, upstream.connections)
+
+    nginx = shutil.which("nginx")
+    if not nginx:
+        print("nginx not found in PATH, only the direct baseline was measured")
+        return
+    for profile in profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            proc, port = run_nginx(nginx, profile, upstream_port, tmp)
+            try:
+                upstream.connections = 0
+                wall, latencies = drive(port, requests, concurrency)
+                report(profile, requests, wall, latencies, upstream.connections)
+            finally:
+                proc.terminate()
+                proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Startup cost of swap_deployment.py per subcommand
+
+Usage:
+  startup_bench.py [--runs=<runs>] [--json]
+  startup_bench.py (-h | --help)
+
+Options:
+  -h --help       Show this screen.
+  --runs=<runs>   Fresh interpreters started per subcommand [default: 5].
+  --json          Print the results as json.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What every subcommand imports and initializes before it talks to anything
+SUBCOMMANDS = {
+    "swap": (
+        "from deployment_swapper import SwapDeployment, KubeSession",
+        "KubeSession(pool_size=4)",
+    ),
+    "get-env": (
+        "from deployment_swapper import SwapDeployment, KubeSession",
+        "KubeSession(pool_size=4)",
+    ),
+    "vpn": (
+        "from deployment_swapper import SwapDeployment",
+        "SwapDeployment('bench', None, None, None).openvpn",
+    ),
+    "setup-sudoers": (
+        "from openvpn_client import OpenVpn",
+        "OpenVpn(None, os.environ)",
+    ),
+    "reset-vpn": (
+        "from openvpn_client import OpenVpn",
+        "OpenVpn(None, os.environ)",
+    ),
+}
+
+PROBE = """
+import os, sys, time, json
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+{imports}
+imported = time.perf_counter()
+{init}
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start, "init": done - imported}}))
+"""
+
+KUBECONFIG = """apiVersion: v1
+kind: Config
+clusters:
+- cluster: {server: 'https://127.0.0.1:6443', insecure-skip-tls-verify: true}
+  name: bench
+contexts:
+- context: {cluster: bench, user: bench, namespace: bench}
+  name: bench
+current-context: bench
+users:
+- name: bench
+  user: {token: bench}
+"""
+
+
+def run_probe(imports, init, env):
+    code = PROBE.format(root=ROOT, imports=imports, init=init)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", code], env=env, cwd=ROOT,
+                          capture_output=True, universal_newlines=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    timings = json.loads(proc.stdout.strip().splitlines()[-1])
+    timings["wall"] = wall
+    return timings
+
+
+def run_help(env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, "swap_deployment.py"), "--help"],
+                   env=env, cwd=ROOT, capture_output=True, check=True)
+    return {"import": 0.0, "init": 0.0, "wall": time.perf_counter() - start}
+
+
+def median(samples, key):
+    return statistics.median(sample[key] for sample in samples)
+
+
+def main():
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+    env = dict(os.environ)
+    with tempfile.NamedTemporaryFile("w+t", suffix=".kubeconfig", delete=False) as kubeconfig:
+        kubeconfig.write(KUBECONFIG)
+    if not os.getenv("KUBECONFIG"):
+        env["KUBECONFIG"] = kubeconfig.name
+
+    results = {"--help": [run_help(env) for _ in range(runs)]}
+    for name, (imports, init) in SUBCOMMANDS.items():
+        results[name] = [run_probe(imports, init, env) for _ in range(runs)]
+    os.remove(kubeconfig.name)
+
+    report = {
+        name: {key: median(samples, key) for key in ("import", "init", "wall")}
+        for name, samples in results.items()
+    }
+    if args['--json']:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'subcommand':<15}{'import ms':>12}{'init ms':>12}{'wall ms':>12}")
+    for name, timing in report.items():
+        print(f"{name:<15}{timing['import'] * 1000:>12.1f}"
+              f"{timing['init'] * 1000:>12.1f}{timing['wall'] * 1000:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Latency and throughput through the reverse tunnel against a direct connection
+
+Runs an echo server playing the local service, the tunnel agent and the tunnel
+client on this machine, the client connected straight to the agent instead of
+through a port forward. Measures connection setup, request/response round
+trips and bulk throughput, then round trips again while another tunnelled
+connection pushes data at a service that never reads it, which must not hold
+up the other streams. --via measures the same against an echo server
+reachable at host:port, for example through an openvpn swap, so both
+transports can be compared on a real cluster.
+
+Usage:
+  tunnel_bench.py [--round_trips=<n>] [--megabytes=<n>] [--connections=<n>] [--via=<host:port>]
+                  [--stall_timeout=<s>]
+  tunnel_bench.py (-h | --help)
+
+Options:
+  -h --help               Show this screen.
+  --round_trips=<n>       Small request/response round trips per path [default: 2000].
+  --megabytes=<n>         Megabytes pushed through every path [default: 64].
+  --connections=<n>       New connections opened to measure setup time [default: 200].
+  --via=<host:port>       Also measure an echo server at host:port.
+  --stall_timeout=<s>     Seconds a round trip may take next to the slow reader [default: 5].
+"""
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tunnel_agent import Agent, run_client
+
+CHUNK = 65536
+
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(CHUNK)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def setup_times(host, port, connections):
+    times = []
+    for _ in range(connections):
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b"x")
+        await reader.readexactly(1)
+        times.append(time.perf_counter() - start)
+        writer.close()
+    return times
+
+
+async def round_trips(host, port, count):
+    reader, writer = await asyncio.open_connection(host, port)
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        writer.write(b"ping" * 16)
+        await reader.readexactly(64)
+        times.append(time.perf_counter() - start)
+    writer.close()
+    return times
+
+
+async def throughput(host, port, megabytes):
+    reader, writer = await asyncio.open_connection(host, port)
+    total = megabytes * 1024 * 1024
+    block = b"x" * CHUNK
+
+    async def send():
+        for _ in range(total // CHUNK):
+            writer.write(block)
+            await writer.drain()
+
+    start = time.perf_counter()
+    sender = asyncio.ensure_future(send())
+    received = 0
+    while received < total:
+        received += len(await reader.read(CHUNK))
+    await sender
+    writer.close()
+    return megabytes / (time.perf_counter() - start)
+
+
+async def never_read(reader, writer):
+    await asyncio.sleep(3600)
+
+
+async def slow_reader(host, port, echo_port, args):
+    """Round trips on one stream while another fills a service that never reads"""
+    reader, writer = await asyncio.open_connection(host, port)
+    block = b"x" * CHUNK
+
+    async def send():
+        while True:
+            writer.write(block)
+            await writer.drain()
+
+    sender = asyncio.ensure_future(send())
+    await asyncio.sleep(0.5)
+    try:
+        rtt = sorted(await asyncio.wait_for(
+            round_trips(host, echo_port, int(args['--round_trips'])),
+            float(args['--stall_timeout'])))
+        print(f"{'slow peer':<10}{'':>12}{statistics.median(rtt) * 1000:>10.3f}"
+              f"{rtt[int(len(rtt) * 0.99) - 1] * 1000:>10.3f}{'':>10}")
+        return True
+    except asyncio.TimeoutError:
+        print(f"{'slow peer':<10}{'':>12}{'stalled':>10}")
+        return False
+    finally:
+        sender.cancel()
+        writer.close()
+
+
+async def measure(name, host, port, args):
+    setup = await setup_times(host, port, int(args['--connections']))
+    rtt = sorted(await round_trips(host, port, int(args['--round_trips'])))
+    mb_s = await throughput(host, port, int(args['--megabytes']))
+    print(f"{name:<10}{statistics.median(setup) * 1000:>12.3f}"
+          f"{statistics.median(rtt) * 1000:>10.3f}{rtt[int(len(rtt) * 0.99) - 1] * 1000:>10.3f}"
+          f"{mb_s:>10.1f}")
+
+
+async def main(args):
+    echo_port, tunnel_port, listen_port = free_port(), free_port(), free_port()
+    stuck_port, stuck_listen_port = free_port(), free_port()
+    await asyncio.start_server(echo, "127.0.0.1", echo_port)
+    await asyncio.start_server(never_read, "127.0.0.1", stuck_port)
+    agent = Agent(tunnel_port, {listen_port: echo_port, stuck_listen_port: stuck_port})
+    asyncio.ensure_future(agent.serve())
+    await asyncio.sleep(0.2)
+    asyncio.ensure_future(run_client("127.0.0.1", tunnel_port))
+    while not agent.mux:
+        await asyncio.sleep(0.05)
+
+    print(f"{'path':<10}{'setup ms':>12}{'p50 ms':>10}{'p99 ms':>10}{'MB/s':>10}")
+    await measure("direct", "127.0.0.1", echo_port, args)
+    await measure("tunnel", "127.0.0.1", listen_port, args)
+    unstalled = await slow_reader("127.0.0.1", stuck_listen_port, listen_port, args)
+    if args['--via']:
+        host, port = args['--via'].rsplit(":", 1)
+        await measure("via", host, int(port), args)
+    # the servers and the tunnel are torn down with the loop, nothing to report there
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: None)
+    return unstalled
+
+
+if __name__ == '__main__':
+    sys.exit(0 if asyncio.run(main(docopt(__doc__))) else 1)
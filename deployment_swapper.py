@@ -1,215 +1,238 @@
-import copy
+import datetime
+import functools
+import getpass
+import hashlib
+import json
+import math
 import os
+import socket
 import sys
 import subprocess
-import tempfile
-import shutil
-import psutil
-import stat
-import functools
+import threading
 import configparser
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client import configuration
 from kubernetes.client.rest import ApiException
-from kubernetes.stream import stream
-from jinja2 import Template
-
-
-def run_in_new_window(code, hold=False):
-    if sys.platform == "darwin":
-        with tempfile.NamedTemporaryFile("w+t", delete=False) as start_new:
-            start_new.write('tell application "Terminal"\n')
-            start_new.write(f'    set w to do script "{code}"\n')
-            start_new.write(f"    activate\n")
-            if hold:
-                start_new.write("    repeat\n")
-                start_new.write("        delay 1\n")
-                start_new.write("        if not busy of w then exit repeat\n")
-                start_new.write("    end repeat\n")
-            start_new.write("end tell\n")
-            start_new.close()
-            proc = subprocess.Popen(
-                ["osascript", start_new.name],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-    elif sys.platform == "linux":
-        terminal = os.getenv("TERMINAL", shutil.which("xfce4-terminal"))
-        if not terminal:
-            print("You need to set the TERMINAL env ...")
-            print("tilix, gnome-terminal and xfce4-terminal are officially supported")
-            print("others might work")
-            sys.exit(1)
-        hold_args = []
-        terminal_args = []
-        if hold:
-            if os.path.basename(terminal) == "xfce4-terminal":
-                hold_args = ["--disable-server"]
-
-        if os.path.basename(terminal) == "tilix":
-            terminal_args = ["-a", "session-add-down"]
-
-        with tempfile.NamedTemporaryFile("w+t", delete=False) as start_new:
-            start_new.write(code)
-            start_new.close()
-            args = [
-                terminal,
-                *terminal_args,
-                *hold_args,
-                "-e",
-                "bash {}".format(start_new.name),
-            ]
+from kubernetes.config import kube_config
+from informer_cache import CacheClient
+from openvpn_client import OpenVpn, get_pid, run_in_new_window
+from tracing import NullTracer, traced
 
-            proc = subprocess.Popen(
-                args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-    else:
-        print("Your platform: {} is not supported!!".format(sys.platfrom))
-        sys.exit(1)
-    if hold:
-        if proc.wait() != 0:
-            raise RuntimeError(proc.stderr.read().decode())
+ANNOTATION_PREFIX = "deployment-swapper/"
+ORIGINAL_REPLICAS_ANNOTATION = ANNOTATION_PREFIX + "original-replicas"
+HPA_ANNOTATION = ANNOTATION_PREFIX + "hpa"
+SWAP_LABEL = ANNOTATION_PREFIX + "swap"
+# autoscaling/v1 carries the autoscaling/v2 metrics and behavior of an HPA in
+# these annotations, the status ones are left out of the saved copy
+HPA_V2_ANNOTATION_PREFIX = "autoscaling.alpha.kubernetes.io/"
+HPA_V2_STATUS_ANNOTATIONS = (HPA_V2_ANNOTATION_PREFIX + "conditions",
+                             HPA_V2_ANNOTATION_PREFIX + "current-metrics")
+CONFIG_HASH_ANNOTATION = ANNOTATION_PREFIX + "config-hash"
+SPEC_HASH_ANNOTATION = ANNOTATION_PREFIX + "spec-hash"
+PKI_HASH_ANNOTATION = ANNOTATION_PREFIX + "pki-hash"
+PKI_EXPIRES_ANNOTATION = ANNOTATION_PREFIX + "pki-expires"
+# who swapped and where the traffic goes, on the metadata of every swap
+# deployment, found cluster wide by SWAP_LABEL
+OWNER_ANNOTATION = ANNOTATION_PREFIX + "owner"
+TRANSPORT_ANNOTATION = ANNOTATION_PREFIX + "transport"
+TARGET_ANNOTATION = ANNOTATION_PREFIX + "target"
+MIRROR_ANNOTATION = ANNOTATION_PREFIX + "mirror"
+# OVPN_* variables of the openvpn image that --ephemeral_pki replaces
+PKI_ENV = ("OVPN_CA", "OVPN_SERVER", "OVPN_KEY", "OVPN_CRL")
+TRANSPORTS = ("openvpn", "tunnel")
+# the tunnel agent takes the local client on TUNNEL_PORT and the swapped
+# traffic from nginx on ports counting up from TUNNEL_LISTEN_BASE
+TUNNEL_PORT = 7000
+TUNNEL_LISTEN_BASE = 10000
+# a copy of a request waits at most this long for the local service, the
+# connection it came in on is held until the copy is done
+MIRROR_TIMEOUT = "2s"
+# most swap pods --weight runs to reach a share above one pod's
+MAX_WEIGHT_REPLICAS = 10
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 * 1024}
+# set by the API server, not sent back when creating the swap
+SERVER_METADATA = ("resourceVersion", "uid", "selfLink", "creationTimestamp", "generation",
+                   "managedFields")
 
+# nginx tuning rendered into the swap proxy config. Every profile keeps a
+# pool of idle upstream connections so requests do not pay a new handshake
+# over the VPN.
+PROXY_PROFILES = {
+    # small buffers, nothing held back, fail fast
+    "latency": {
+        "keepalive": 32,
+        "keepalive_requests": 1000,
+        "keepalive_timeout": "60s",
+        "connect_timeout": "2s",
+        "read_timeout": "30s",
+        "send_timeout": "30s",
+        "stream_timeout": "10m",
+        "buffering": "off",
+        "request_buffering": "off",
+        "buffer_size": "4k",
+        "buffers": "8 4k",
+    },
+    # big buffers so the upstream connection is freed fast, more idle connections
+    "throughput": {
+        "keepalive": 128,
+        "keepalive_requests": 10000,
+        "keepalive_timeout": "120s",
+        "connect_timeout": "5s",
+        "read_timeout": "60s",
+        "send_timeout": "60s",
+        "stream_timeout": "10m",
+        "buffering": "on",
+        "request_buffering": "on",
+        "buffer_size": "16k",
+        "buffers": "64 16k",
+    },
+    # long lived responses and uploads, websockets and grpc streams
+    "streaming": {
+        "keepalive": 16,
+        "keepalive_requests": 1000,
+        "keepalive_timeout": "3600s",
+        "connect_timeout": "5s",
+        "read_timeout": "3600s",
+        "send_timeout": "3600s",
+        "stream_timeout": "3600s",
+        "buffering": "off",
+        "request_buffering": "off",
+        "buffer_size": "8k",
+        "buffers": "8 8k",
+    },
+}
 
-class OpenVpn:
 
-    def __init__(self, namespace, env):
-        self.namespace = namespace
-        self.env = env
-        self.run = functools.partial(
-            subprocess.run,
-            env=env,
-            universal_newlines=True,
-            capture_output=True,
-            check=True,
-        )
-        self.conf_location = os.path.join(os.getcwd(), "config")
-        self.vpn_profile_fn = os.path.join(self.conf_location, "vpn-test.ovpn")
-        self.vpn_pid_file = os.path.join(self.conf_location, "vpn.pid")
-        self.vpn_updown_script = os.path.join(
-            self.conf_location,
-            f"update_resolv_conf.{sys.platform}.sh",
-        )
+@functools.lru_cache(maxsize=8)
+def load_template(template_file, mtime):
+    """Compiled template, compiled again only when the file changes"""
+    from jinja2 import Template
 
-    def check_openvpn_installed(self):
-        with self.override_env():
-            if not shutil.which("openvpn"):
-                if sys.platform == "darwin":
-                    print("openvpn not installed. brew/apt/pacman install openvpn")
-                    print("Hint (for macs):")
-                    print("    # Run this")
-                    print("    brew install openvpn")
-                    print("    # Add this line to ~/.bash_profile")
-                    print("    export PATH=$(brew --prefix openvpn)/sbin:$PATH")
-                else:
-                    print("openvpn not installed. apt install openvpn")
-                    print("Hint (for linux):")
-                    print("    # Run this")
-                    print("    apt install openvpn openresolv")
-                    print("    openresolv is also needed!!!")
-                sys.exit(1)
-
-    def run_vpn_if_needed(self):
-        """Run vpn in new termianl window"""
-        vpn_pid = self.get_vpn_pid()
-        if vpn_pid:
-            print(f"VPN running, pid {vpn_pid}")
-        else:
-            print("Running openvpn in new window.")
-            openvpn_path = shutil.which("openvpn")
-            if not openvpn_path:
-                raise RuntimeError("openvpn not found in path!")
-            run_in_new_window(
-                f"sudo {openvpn_path} --config {self.vpn_profile_fn} "
-                f"--up {self.vpn_updown_script} --down {self.vpn_updown_script} "
-                f"--script-security 3 --writepid {self.vpn_pid_file}\n"
+    with open(template_file) as file_:
+        return Template(file_.read(), trim_blocks=True)
+
+
+def render_config_template(values, name="nginx_template.conf.j2"):
+    template_file = os.path.join(os.getenv("CONF_DIR", "./"), name)
+    return load_template(template_file, os.path.getmtime(template_file)).render(values)
+
+
+def parse_size(size):
+    """Bytes of an nginx style size, 512, 64k or 1m"""
+    number, unit = size.strip().lower()[:-1], size.strip().lower()[-1:]
+    if unit.isdigit():
+        number, unit = number + unit, ""
+    if unit not in SIZE_UNITS or not number.isdigit():
+        raise ValueError(f"Bad size {size}, use bytes, k or m")
+    return int(number) * SIZE_UNITS[unit]
+
+
+def max_number_pattern(limit):
+    """Regex matching the decimal numbers 0 to limit, nginx maps can only compare strings"""
+    digits = str(limit)
+    parts = [r"\d{1,%d}" % (len(digits) - 1)] if len(digits) > 1 else []
+    for i, digit in enumerate(digits):
+        low = 1 if i == 0 and len(digits) > 1 else 0
+        if int(digit) > low:
+            rest = len(digits) - i - 1
+            parts.append(f"{digits[:i]}[{low}-{int(digit) - 1}]" + (r"\d{%d}" % rest if rest else ""))
+    parts.append(digits)
+    return "|".join(parts)
+
+
+def swap_manifest(deployment, name, labels, annotations, template_labels, image, sidecars,
+                  volumes, volume_mounts, replicas=None, disable_liveness=True,
+                  disable_readiness=False):
+    """The swap deployment for the raw deployment manifest, as a raw manifest.
+
+    Only the dicts and lists on the paths that change are copied, the rest,
+    env, volumes, other containers, is shared with deployment, which must not
+    be changed afterwards.
+    """
+    metadata = {key: value for key, value in deployment["metadata"].items()
+                if key not in SERVER_METADATA}
+    metadata["name"] = name
+    metadata["labels"] = {**(metadata.get("labels") or {}), **labels}
+    metadata["annotations"] = {
+        **{key: value for key, value in (metadata.get("annotations") or {}).items()
+           if not key.startswith(ANNOTATION_PREFIX)},
+        **annotations,
+    }
+    spec = dict(deployment["spec"])
+    if replicas is not None:
+        spec["replicas"] = replicas
+    template = dict(spec["template"])
+    template["metadata"] = dict(template.get("metadata") or {})
+    template["metadata"]["labels"] = {**(template["metadata"].get("labels") or {}),
+                                      **template_labels}
+    pod_spec = dict(template["spec"])
+    first, *others = pod_spec["containers"]
+    first = dict(first, image=image, args=[])
+    first["volumeMounts"] = (first.get("volumeMounts") or []) + volume_mounts
+    if disable_liveness:
+        first.pop("livenessProbe", None)
+    if disable_readiness:
+        first.pop("readinessProbe", None)
+    pod_spec["containers"] = [first] + others + sidecars
+    pod_spec["volumes"] = (pod_spec.get("volumes") or []) + volumes
+    template["spec"] = pod_spec
+    spec["template"] = template
+    swap = {key: value for key, value in deployment.items() if key != "status"}
+    swap["metadata"] = metadata
+    swap["spec"] = spec
+    return swap
+
+
+class KubeSession:
+    """Kubeconfig parsed once, shared by the api client and the namespace lookup"""
+
+    def __init__(self, pool_size=None, tracer=None):
+        self.tracer = tracer or NullTracer()
+        with self.tracer.span("kubeconfig"):
+            loader = kube_config._get_kube_config_loader_for_yaml_file(
+                kube_config.KUBE_CONFIG_DEFAULT_LOCATION, persist_config=True
             )
+            client_config = client.Configuration()
+            loader.load_and_set(client_config)
+        client_config.assert_hostname = False
+        if pool_size:
+            client_config.connection_pool_maxsize = pool_size
+        self.api_client = client.ApiClient(client_config)
+        self.owner = f"{getpass.getuser()}@{socket.gethostname()}"
+        try:
+            self.namespace = loader.current_context["context"]["namespace"]
+        except KeyError:
+            self.namespace = "default"
 
-    def get_vpn_pid(self):
-        if os.path.isfile(self.vpn_pid_file):
-            with open(self.vpn_pid_file, "r") as f:
-                pid = int(f.read().strip())
-            if psutil.pid_exists(pid):
-                return pid
-
-    def kill_vpn(self):
-        vpn_pid = self.get_vpn_pid()
-        if vpn_pid:
-            print("Killing openvpn, will need elevated access...")
-            kill_path = shutil.which("kill")
-            subprocess.run(["sudo", kill_path, "-2", str(vpn_pid)])
-        self.reset_vpn()
 
-    def reset_vpn(self):
-        my_env = os.environ
-        my_env["script_type"] = "down"
-        my_env["dev"] = "none"
-        if sys.platform == "linux":
-            subprocess.run(["sudo", "cp", "/etc/resolv.conf.bak", "/etc/resolv.conf"])
-        else:
-            subprocess.run([self.vpn_updown_script], env=my_env)
+class OfflineSession:
+    """Stands in for KubeSession when rendering manifests, no kubeconfig, no API server
 
-    def setup_sudoers(self):
-        proc = subprocess.run(
-            ["sudo", "-n", "-l"],
-            check=False,
-            capture_output=True,
-            universal_newlines=True,
-        )
-        required_commands = ["openvpn --config", "kill -2"]
-        if not all(part in proc.stdout for part in required_commands):
-            with tempfile.NamedTemporaryFile("w+t", delete=False) as sudo_config:
-                username = os.getenv("USER")
-                sudo_config.write(
-                    "Cmnd_Alias    OVPN =  {} --config *\n".format(
-                        shutil.which("openvpn")
-                    )
-                )
-                sudo_config.write(
-                    "Cmnd_Alias    KILL =  {} -2 *\n".format(shutil.which("kill"))
-                )
-                sudo_config.write(
-                    "Cmnd_Alias    NETFIX =  {} /etc/resolv.conf.bak /etc/resolv.conf\n".format(
-                        shutil.which("cp")
-                    )
-                )
-                if sys.platform == "darwin":
-                    target_sudo_file = f"/etc/sudoers.d/swapper-{username}"
-                    sudo_config.write(
-                        "%admin          ALL = (ALL) NOPASSWD:OVPN\n"
-                        "%admin          ALL = (ALL) NOPASSWD:KILL\n"
-                    )
-                else:
-                    target_sudo_file = f"/etc/sudoers.d/swapper-{username}"
-                    sudo_config.write(
-                        f"{username}          ALL = (ALL) NOPASSWD:OVPN\n"
-                        f"{username}          ALL = (ALL) NOPASSWD:KILL\n"
-                        f"{username}          ALL = (ALL) NOPASSWD:NETFIX\n"
-                    )
-                sudo_config.close()
-                print(
-                    f"Copying sudo config to {target_sudo_file}, will need elevated access"
-                )
-                os.chmod(sudo_config.name, stat.S_IRUSR | stat.S_IRGRP)
-                run_in_new_window(
-                    f"sudo cp {sudo_config.name} {target_sudo_file}", hold=True
-                )
+    No owner unless one is given, rendered files must not depend on who rendered them.
+    """
 
-    def override_env(self):
-        return self.env
+    def __init__(self, namespace=None, api_client=None, tracer=None, owner=None):
+        self.tracer = tracer or NullTracer()
+        self.api_client = api_client or client.ApiClient()
+        self.namespace = namespace
+        self.owner = owner
 
 
 class SwapDeployment:
-    def __init__(self, deployment_name, remote_host, remote_http_port, remote_grpc_port):
-        if deployment_name != "dummy":
-            self.config = config.load_kube_config()
+    def __init__(self, deployment_name, remote_host, remote_http_port, remote_grpc_port,
+                 session=None, proxy_profile="latency", transport="openvpn", ephemeral_pki=False,
+                 weight=None, mirror=False, mirror_sample=100, mirror_body="64k", api_budget=None):
+        self.session = session or KubeSession()
+        self.tracer = self.session.tracer
         cf = configparser.ConfigParser()
         cf.read('config/settings.ini')
         self.configs = cf['default']
         configuration.assert_hostname = False
-        self.extensions_v1beta1 = client.ExtensionsV1beta1Api()
-        self.api_inst = client.CoreV1Api()
-        self.namespace = self._get_current_namespace()
+        self.extensions_v1beta1 = client.ExtensionsV1beta1Api(self.session.api_client)
+        self.api_inst = client.CoreV1Api(self.session.api_client)
+        self.autoscaling_v1 = client.AutoscalingV1Api(self.session.api_client)
+        self.namespace = self.session.namespace
+        self.cache = CacheClient(self.namespace)
         self.deployment_name = deployment_name
         if remote_host:
             self.remote_host = remote_host
@@ -223,90 +246,483 @@ class SwapDeployment:
             self.remote_grpc_port = remote_grpc_port
         else:
             self.remote_grpc_port = "50050"
-        self.openvpn =  OpenVpn(self.namespace, os.environ)
+        if proxy_profile not in PROXY_PROFILES:
+            raise ValueError("Unknown proxy profile {}, use one of {}".format(
+                proxy_profile, ", ".join(PROXY_PROFILES)))
+        self.proxy_profile = proxy_profile
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport {}, use one of {}".format(
+                transport, ", ".join(TRANSPORTS)))
+        self.transport = transport
+        if ephemeral_pki and transport != "openvpn":
+            raise ValueError("--ephemeral_pki needs --transport=openvpn")
+        self.ephemeral_pki = ephemeral_pki
+        self.weight = None
+        if weight is not None:
+            self.weight = float(weight)
+            if not 0 < self.weight <= 100:
+                raise ValueError("--weight is a percent, more than 0 and up to 100")
+            # above 50% the plan does not depend on the replicas, reject what it can not reach
+            self.plan_weight(1, self.weight)
+        self.mirror = None
+        if mirror:
+            mirror_sample = float(mirror_sample)
+            if not 0 < mirror_sample <= 100:
+                raise ValueError("--mirror_sample is a percent, more than 0 and up to 100")
+            self.mirror = {
+                "percent": round(mirror_sample, 2),
+                "body_pattern": max_number_pattern(parse_size(mirror_body)),
+                "timeout": MIRROR_TIMEOUT,
+            }
+        self.pki_hash = None
+        self.local_percent = None
+        self.cluster_http_upstream = None
+        self.cluster_grpc_upstream = None
+        self.stream_ports = []
+        self._openvpn = None
+        self._deployments = {}
+        self._manifests = {}
+        self._calls_lock = threading.Lock()
+        self.api_calls = 0
+        self.api_budget = int(api_budget) if api_budget else None
+
+    def _call(self, func, *args, **kwargs):
+        """Every request to the Kubernetes API goes through here so it is counted and traced.
+
+        With an api_budget the request past it is not sent, RuntimeError instead.
+        """
+        with self._calls_lock:
+            if self.api_budget is not None and self.api_calls >= self.api_budget:
+                target = args[0] if args and callable(args[0]) else func
+                raise RuntimeError(f"api budget of {self.api_budget} calls used up, "
+                                   f"{target.__name__} not sent")
+            self.api_calls += 1
+        if not self.tracer.enabled:
+            return func(*args, **kwargs)
+        # stream(api_method, ...) for exec, api_method(...) for everything else
+        target = args[0] if args and callable(args[0]) else func
+        with self.tracer.span(target.__name__, kind="api", deployment=self.deployment_name) as span:
+            with_http_info = getattr(getattr(func, "__self__", None),
+                                     f"{func.__name__}_with_http_info", None)
+            if with_http_info and "watch" not in kwargs:
+                data, span["status"], _ = with_http_info(*args, **kwargs)
+                return data
+            return func(*args, **kwargs)
+
+    @property
+    def openvpn(self):
+        if not self._openvpn:
+            self._openvpn = OpenVpn(self.namespace, os.environ, tracer=self.tracer)
+            if os.path.isfile(self.pki_profile()):
+                self._openvpn.vpn_profile_fn = self.pki_profile()
+        return self._openvpn
+
+    def phase(self, name):
+        return self.tracer.span(name, deployment=self.deployment_name)
 
     def get_deployment(self, deployment_name):
+        if deployment_name in self._deployments:
+            return self._deployments[deployment_name]
         try:
-            api_response = self.extensions_v1beta1.read_namespaced_deployment(
+            api_response = self._call(
+                self.extensions_v1beta1.read_namespaced_deployment,
                 deployment_name, self.namespace
             )
         except ApiException as e:
             print("Exception when calling read_namespaced_deployment: %s\n" % e)
             exit(0)
+        self._deployments[deployment_name] = api_response
         return api_response
 
-    def _get_current_namespace(self):
-        try:
-            return config.list_kube_config_contexts()[1]["context"]["namespace"]
-        except KeyError:
-            return "default"
+    def _raw(self, func, *args, **kwargs):
+        """func's response as the plain dict the API server sent, no client models"""
+        response = self._call(func, *args, _preload_content=False, **kwargs)
+        return json.loads(response.data)
 
-    def get_default_image(self):
-        return self.configs['SWAP_IMAGE']
-
-    def create_deployment(self, deployment):
+    def get_deployment_manifest(self, deployment_name):
+        if deployment_name in self._manifests:
+            return self._manifests[deployment_name]
         try:
-            self.extensions_v1beta1.create_namespaced_deployment(
-                body=deployment, namespace=self.namespace
+            manifest = self._raw(
+                self.extensions_v1beta1.read_namespaced_deployment,
+                deployment_name, self.namespace
             )
         except ApiException as e:
-            print("Exception when calling create_namespaced_deployment: %s\n" % e)
+            print("Exception when calling read_namespaced_deployment: %s\n" % e)
             exit(0)
+        self._manifests[deployment_name] = manifest
+        return manifest
+
+    def get_default_image(self):
+        return self.configs['SWAP_IMAGE']
 
-    def deployment_exists(self, deployment):
-        deployments = [
+    def list_deployments(self, label_selector):
+        return [
             item.metadata.name
-            for item in self.extensions_v1beta1.list_namespaced_deployment(
-                namespace=self.namespace
+            for item in self._call(
+                self.extensions_v1beta1.list_namespaced_deployment,
+                namespace=self.namespace, label_selector=label_selector
             ).items
+            if not item.metadata.name.endswith("-swap")
         ]
-        return deployment in deployments
 
     def get_config_template(self):
-        template_file = os.path.join(
-            os.getenv("CONF_DIR", "./"), "nginx_template.conf.j2"
-        )
-        with open(template_file) as file_:
-            template = Template(file_.read())
+        remote_host, http_port, grpc_port = \
+            self.remote_host, self.remote_http_port, self.remote_grpc_port
+        if self.transport == "tunnel":
+            remote_host, http_port, grpc_port = \
+                "127.0.0.1", TUNNEL_LISTEN_BASE, TUNNEL_LISTEN_BASE + 1
         swap = {
-            "remote_host": self.remote_host,
+            "remote_host": remote_host,
             "service_id": self.deployment_name,
-            "remote_http_port": self.remote_http_port,
-            "remote_grpc_port": self.remote_grpc_port,
+            "remote_http_port": http_port,
+            "remote_grpc_port": grpc_port,
+            "local_percent": self.local_percent,
+            "cluster_http_upstream": self.cluster_http_upstream,
+            "cluster_grpc_upstream": self.cluster_grpc_upstream,
+            "listen_http_port": "80",
+            "listen_grpc_port": "50050",
+            "profile": PROXY_PROFILES[self.proxy_profile],
+            "mirror": self.mirror,
         }
-        return template.render(swap)
+        return render_config_template(swap)
+
+    def get_main_config(self):
+        """Full nginx.conf with a stream block passing the raw ports through"""
+        remote_host, stream_ports = self.remote_host, self.stream_ports
+        if self.transport == "tunnel":
+            remote_host = "127.0.0.1"
+            stream_ports = [dict(port, remote=TUNNEL_LISTEN_BASE + 2 + i)
+                            for i, port in enumerate(self.stream_ports)]
+        return render_config_template({
+            "remote_host": remote_host,
+            "stream_ports": stream_ports,
+            "profile": PROXY_PROFILES[self.proxy_profile],
+        }, name="nginx_main.conf.j2")
+
+    def parse_stream_ports(self, ports, container):
+        """[{listen, remote, protocol}, ...] from port[:remote_port][/udp],...
+
+        all stands for every port the container declares, except the http and
+        grpc ports that the http proxy listens on already.
+        """
+        if ports.strip() == "all":
+            return [
+                {"listen": port["containerPort"], "remote": port["containerPort"],
+                 "protocol": (port.get("protocol") or "TCP").lower()}
+                for port in container.get("ports") or []
+                if port["containerPort"] not in (80, 50050)
+            ]
+        stream_ports = []
+        for mapping in ports.split(","):
+            mapping = mapping.strip()
+            if not mapping:
+                continue
+            protocol = "tcp"
+            if "/" in mapping:
+                mapping, protocol = mapping.split("/", 1)
+                protocol = protocol.lower()
+            if protocol not in ("tcp", "udp"):
+                raise ValueError(f"Unknown protocol {protocol} in --ports, use tcp or udp")
+            listen, _, remote = mapping.partition(":")
+            stream_ports.append(
+                {"listen": int(listen), "remote": int(remote or listen), "protocol": protocol})
+        return stream_ports
+
+    def content_hash(self, obj):
+        # raw manifests are plain json already
+        manifest = obj if isinstance(obj, dict) else \
+            self.session.api_client.sanitize_for_serialization(obj)
+        return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
 
     def create_configmaps_objects(self):
+        data = {"default.conf": self.get_config_template()}
+        if self.stream_ports:
+            # not ending in .conf, so the http block does not include it
+            data["nginx-main"] = self.get_main_config()
+        if self.transport == "tunnel":
+            agent = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tunnel_agent.py")
+            with open(agent) as f:
+                data["tunnel_agent.py"] = f.read()
         metadata = client.V1ObjectMeta(
-            name="{}-swap".format(self.deployment_name), namespace=self.namespace
+            name="{}-swap".format(self.deployment_name),
+            namespace=self.namespace,
+            labels={SWAP_LABEL: self.deployment_name},
+            annotations={CONFIG_HASH_ANNOTATION: self.content_hash(data)},
         )
         return client.V1ConfigMap(
-            data={"default.conf": self.get_config_template()},
+            api_version="v1",
+            data=data,
             kind="ConfigMap",
             metadata=metadata,
         )
 
-    def create_configmap(self, obj):
+    def is_swapped(self, deployment):
+        """The original carries the swap annotations while a swap is active"""
+        return ORIGINAL_REPLICAS_ANNOTATION in (deployment["metadata"].get("annotations") or {})
+
+    def apply_configmap(self, obj, exists=False):
+        """Create the swap configmap or replace it when its content hash changed.
+
+        Returns True when something was written.
+        """
+        if not exists:
+            try:
+                self._call(
+                    self.api_inst.create_namespaced_config_map,
+                    namespace=self.namespace, body=obj
+                )
+                return True
+            except ApiException as e:
+                if e.status != 409:
+                    raise
         try:
-            self.api_inst.create_namespaced_config_map(
-                namespace=self.namespace, body=self.create_configmaps_objects()
+            current = self._call(
+                self.api_inst.read_namespaced_config_map, obj.metadata.name, self.namespace
             )
-        except ApiException:
-            self.api_inst.replace_namespaced_config_map(
-                namespace=self.namespace,
-                name="{}-swap".format(self.deployment_name),
-                body=self.create_configmaps_objects(),
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            # deleted by hand since the swap, create it again
+            self._call(
+                self.api_inst.create_namespaced_config_map,
+                namespace=self.namespace, body=obj
             )
+            return True
+        current_hash = (current.metadata.annotations or {}).get(CONFIG_HASH_ANNOTATION)
+        if current_hash == obj.metadata.annotations[CONFIG_HASH_ANNOTATION]:
+            return False
+        self._call(
+            self.api_inst.replace_namespaced_config_map,
+            namespace=self.namespace,
+            name=obj.metadata.name,
+            body=obj,
+        )
+        return True
+
+    def apply_deployment(self, swap_deployment, exists=False):
+        """Create the swap deployment or replace it when its spec hash changed.
+
+        Returns True when something was written.
+        """
+        name = swap_deployment["metadata"]["name"]
+        if not exists:
+            try:
+                self._manifests[name] = self._raw(
+                    self.extensions_v1beta1.create_namespaced_deployment,
+                    body=swap_deployment, namespace=self.namespace
+                )
+                return True
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+        try:
+            current = self._raw(
+                self.extensions_v1beta1.read_namespaced_deployment, name, self.namespace
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            self._manifests[name] = self._raw(
+                self.extensions_v1beta1.create_namespaced_deployment,
+                body=swap_deployment, namespace=self.namespace
+            )
+            return True
+        current_hash = (current["metadata"].get("annotations") or {}).get(SPEC_HASH_ANNOTATION)
+        if current_hash == swap_deployment["metadata"]["annotations"][SPEC_HASH_ANNOTATION]:
+            self._manifests[name] = current
+            return False
+        swap_deployment["metadata"]["resourceVersion"] = current["metadata"]["resourceVersion"]
+        self._manifests[name] = self._raw(
+            self.extensions_v1beta1.replace_namespaced_deployment,
+            name=name, namespace=self.namespace, body=swap_deployment
+        )
+        return True
+
+    def apply_swap(self, swap_deployment, deployment):
+        """Write the swap configmap and deployment, skipping whatever is unchanged.
+
+        The config hash goes into the pod template so a new nginx config rolls
+        the swap pods. Returns the number of objects written.
+        """
+        configmap = self.create_configmaps_objects()
+        exists = self.is_swapped(deployment)
+        pki_written = False
+        if self.ephemeral_pki:
+            with self.phase("apply_pki_secret"):
+                pki_written = self.apply_pki_secret(exists=exists)
+        self.annotate_swap(swap_deployment, configmap)
+        with self.phase("apply_configmap"):
+            writes = self.apply_configmap(configmap, exists=exists)
+        with self.phase("apply_deployment"):
+            writes += self.apply_deployment(swap_deployment, exists=exists)
+        if pki_written:
+            self.own_pki_secret(swap_deployment)
+            writes += 1
+        if not writes:
+            print(f"{swap_deployment['metadata']['name']} is up to date")
+        return writes
+
+    def annotate_swap(self, swap_deployment, configmap):
+        """Config and pki hash on the pod template, the spec hash over that on the deployment"""
+        template_metadata = swap_deployment["spec"]["template"]["metadata"]
+        template_metadata["annotations"] = dict(template_metadata.get("annotations") or {})
+        template_metadata["annotations"][CONFIG_HASH_ANNOTATION] = \
+            configmap.metadata.annotations[CONFIG_HASH_ANNOTATION]
+        if self.ephemeral_pki:
+            # new credentials roll the swap pods
+            template_metadata["annotations"][PKI_HASH_ANNOTATION] = self.pki_hash
+        swap_deployment["metadata"]["annotations"][SPEC_HASH_ANNOTATION] = \
+            self.content_hash(swap_deployment["spec"])
+
+    def render(self, deployment, disable_readiness=False, skip_openvpn_sidecar=False,
+               stream_ports=None):
+        """Swap configmap and deployment manifests for a deployment manifest, no API requests"""
+        swap_deployment, _ = self.generate_deployment_swap(
+            disable_readiness=disable_readiness,
+            skip_openvpn_sidecar=skip_openvpn_sidecar,
+            stream_ports=stream_ports,
+            deployment=deployment,
+        )
+        configmap = self.create_configmaps_objects()
+        self.annotate_swap(swap_deployment, configmap)
+        if self.namespace:
+            swap_deployment["metadata"]["namespace"] = self.namespace
+        return [self.session.api_client.sanitize_for_serialization(configmap), swap_deployment]
+
+    def pki_secret_name(self):
+        return "{}-swap-pki".format(self.deployment_name)
+
+    def pki_profile(self):
+        """Local openvpn profile matching the ephemeral credentials of this swap"""
+        return os.path.join(os.getcwd(), "config", f"pki-{self.deployment_name}.ovpn")
+
+    def local_pki_hash(self):
+        try:
+            with open(self.pki_profile()) as f:
+                first_line = f.readline()
+        except OSError:
+            return None
+        return first_line.rpartition(":")[2].strip() or None
+
+    def apply_pki_secret(self, exists=False):
+        """Issue credentials for the sidecar into the swap pki Secret and the local profile.
+
+        Credentials in the Secret are kept while the local profile matches them
+        and they hold for another hour. Returns True when something was written.
+        """
+        from ephemeral_pki import issue
+
+        days = int(self.configs.get('EPHEMERAL_PKI_DAYS', '7'))
+        credentials = None
+        if not exists:
+            credentials = issue(self.deployment_name, days=days)
+            try:
+                self._call(
+                    self.api_inst.create_namespaced_secret,
+                    namespace=self.namespace, body=self.pki_secret(credentials)
+                )
+                self.write_pki_profile(credentials)
+                return True
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+        try:
+            current = self._call(
+                self.api_inst.read_namespaced_secret, self.pki_secret_name(), self.namespace
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            current = None
+        if current is not None:
+            annotations = current.metadata.annotations or {}
+            expires = annotations.get(PKI_EXPIRES_ANNOTATION)
+            if annotations.get(PKI_HASH_ANNOTATION) == self.local_pki_hash() and expires and \
+                    datetime.datetime.fromisoformat(expires) - datetime.timedelta(hours=1) > \
+                    datetime.datetime.now(datetime.timezone.utc):
+                self.pki_hash = annotations[PKI_HASH_ANNOTATION]
+                return False
+        credentials = credentials or issue(self.deployment_name, days=days)
+        if current is None:
+            self._call(
+                self.api_inst.create_namespaced_secret,
+                namespace=self.namespace, body=self.pki_secret(credentials)
+            )
+        else:
+            self._call(
+                self.api_inst.replace_namespaced_secret,
+                name=self.pki_secret_name(), namespace=self.namespace,
+                body=self.pki_secret(credentials)
+            )
+        self.write_pki_profile(credentials)
+        return True
+
+    def pki_secret(self, credentials):
+        from ephemeral_pki import fingerprint, sidecar_env
+
+        self.pki_hash = fingerprint(credentials)
+        return client.V1Secret(
+            metadata=client.V1ObjectMeta(
+                name=self.pki_secret_name(),
+                namespace=self.namespace,
+                labels={SWAP_LABEL: self.deployment_name},
+                annotations={PKI_HASH_ANNOTATION: self.pki_hash,
+                             PKI_EXPIRES_ANNOTATION: credentials["expires"].isoformat()},
+            ),
+            string_data=sidecar_env(credentials),
+            type="Opaque",
+        )
+
+    def write_pki_profile(self, credentials):
+        profile = render_config_template({
+            "pki_hash": self.pki_hash,
+            "expires": credentials["expires"].isoformat(),
+            "remote_host": "127.0.0.1",
+            "remote_port": 1194,
+            "ca": credentials["ca"].decode(),
+            "key": credentials["client_key"].decode(),
+            "cert": credentials["client_crt"].decode(),
+        }, name="ovpn_profile.j2")
+        fd = os.open(self.pki_profile(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(profile)
+        print(f"Client profile for {self.deployment_name}-swap in {self.pki_profile()}")
+
+    def own_pki_secret(self, swap_deployment):
+        """Make the swap deployment own the Secret, deleting the swap deletes it"""
+        owner = self._manifests[swap_deployment["metadata"]["name"]]
+        self._call(
+            self.api_inst.patch_namespaced_secret,
+            name=self.pki_secret_name(), namespace=self.namespace,
+            body={"metadata": {"ownerReferences": [{
+                "apiVersion": owner.get("apiVersion") or "extensions/v1beta1",
+                "kind": "Deployment",
+                "name": owner["metadata"]["name"],
+                "uid": owner["metadata"]["uid"],
+            }]}}
+        )
+
+    def remove_pki_profile(self):
+        if os.path.isfile(self.pki_profile()):
+            os.remove(self.pki_profile())
 
     def get_side_car(self):
         """Return the openvpn sidecar"""
+        env = [
+            {'name': 'OPENVPN_PROTO', 'value': 'tcp'},
+            {'name': 'OVPN_ROUTES', 'value': self.configs['DEFAULT_POD_SERVICE']}
+        ]
+        if self.ephemeral_pki:
+            # override the credentials baked into the image
+            env += [
+                {'name': key, 'valueFrom': {'secretKeyRef': {'name': self.pki_secret_name(), 'key': key}}}
+                for key in PKI_ENV
+            ]
         return {
             'name': 'openvpn',
             'image': self.configs['OPENVPN_SIDECAR'],
-            'env': [
-                {'name': 'OPENVPN_PROTO', 'value': 'tcp'},
-                {'name': 'OVPN_ROUTES', 'value': self.configs['DEFAULT_POD_SERVICE']}
-            ],
+            'env': env,
             'ports': [
                 {'name': 'openvpn', 'protocol': 'TCP', 'containerPort': 1194},
                 {'containerPort': 1194, 'name': 'uovpn', 'protocol': 'UDP'''}
@@ -314,57 +730,275 @@ class SwapDeployment:
             'securityContext': {'capabilities': {'add': ['NET_ADMIN']}},
         }
 
-    def set_configmap_volumes(self, original):
+    def tunnel_ports(self):
+        """{port the tunnel agent listens on: port on the developer machine}"""
+        local_ports = [int(self.remote_http_port), int(self.remote_grpc_port)]
+        local_ports += [port["remote"] for port in self.stream_ports]
+        return {TUNNEL_LISTEN_BASE + i: port for i, port in enumerate(local_ports)}
+
+    def get_tunnel_side_car(self):
+        """Return the reverse tunnel sidecar, it runs tunnel_agent.py from the swap configmap"""
+        return {
+            'name': 'tunnel',
+            'image': self.configs.get('TUNNEL_SIDECAR', 'python:3.8-alpine'),
+            'command': ['python', '-u', '/tunnel/tunnel_agent.py'],
+            'env': [
+                {'name': 'TUNNEL_PORT', 'value': str(TUNNEL_PORT)},
+                {'name': 'TUNNEL_PORTS', 'value': ",".join(
+                    f"{listen}:{local}" for listen, local in self.tunnel_ports().items())},
+            ],
+            'ports': [{'name': 'tunnel', 'protocol': 'TCP', 'containerPort': TUNNEL_PORT}],
+            'volumeMounts': [
+                {'name': "{}-swap".format(self.deployment_name), 'mountPath': '/tunnel'}
+            ],
+        }
+
+    def configmap_volumes(self):
+        """Volume of the swap configmap and the nginx mounts of it"""
         name = "{}-swap".format(self.deployment_name)
-        volume = client.V1Volume(
-            config_map=client.V1ConfigMapVolumeSource(name=name, default_mode=420),
-            name=name,
-        )
-        volume_mount = client.V1VolumeMount(mount_path="/etc/nginx/conf.d", name=name)
-        if not original.spec.template.spec.volumes:
-            original.spec.template.spec.volumes = [volume]
-        else:
-            original.spec.template.spec.volumes.append(volume)
-        if not original.spec.template.spec.containers[0].volume_mounts:
-            original.spec.template.spec.containers[0].volume_mounts = [volume_mount]
-        else:
-            original.spec.template.spec.containers[0].volume_mounts.append(volume_mount)
+        volumes = [{"name": name, "configMap": {"name": name, "defaultMode": 420}}]
+        volume_mounts = [{"name": name, "mountPath": "/etc/nginx/conf.d"}]
+        if self.stream_ports:
+            volume_mounts.append(
+                {"name": name, "mountPath": "/etc/nginx/nginx.conf", "subPath": "nginx-main"})
+        return volumes, volume_mounts
 
+    @traced("generate_swap")
     def generate_deployment_swap(self,
                                  disable_liveness=True,
                                  disable_readiness=False,
-                                 skip_openvpn_sidecar=False):
-        swap_deployment = self.get_deployment("{}".format(self.deployment_name))
-        deployment = copy.deepcopy(swap_deployment)
-        self.set_configmap_volumes(swap_deployment)
-
-        swap_deployment.metadata.resource_version = None
-        swap_deployment.spec.template.spec.containers[0].args = []
-        if disable_liveness:
-            swap_deployment.spec.template.spec.containers[0].liveness_probe = None
-        if disable_readiness:
-            swap_deployment.spec.template.spec.containers[0].readiness_probe = None
-        swap_deployment.metadata.name = "{}-swap".format(deployment.metadata.name)
-        swap_deployment.metadata.labels["remote_http_port"] = self.remote_http_port
-        swap_deployment.metadata.labels["remote_grpc_port"] = self.remote_grpc_port
-        swap_deployment.metadata.labels["remote_host"] = self.remote_host
-        swap_deployment.spec.template.spec.containers[0].image = self.get_default_image()
-        if not skip_openvpn_sidecar:
-            swap_deployment.spec.template.spec.containers.append(self.get_side_car())
+                                 skip_openvpn_sidecar=False,
+                                 stream_ports=None,
+                                 deployment=None):
+        """The swap manifest and the original, deployment is the original's manifest if given"""
+        if deployment is None:
+            deployment = self.get_deployment_manifest(self.deployment_name)
+        if stream_ports and self.mirror:
+            raise ValueError("--mirror copies http requests, it can not be used with --ports")
+        if stream_ports:
+            self.stream_ports = self.parse_stream_ports(
+                stream_ports, deployment["spec"]["template"]["spec"]["containers"][0])
+            if self.transport == "tunnel" and any(
+                    port["protocol"] == "udp" for port in self.stream_ports):
+                raise ValueError("UDP ports need --transport=openvpn")
+        replicas = None
+        if self.is_swapped(deployment):
+            # the original is scaled down already, size the swap like the original was
+            replicas = int(deployment["metadata"]["annotations"][ORIGINAL_REPLICAS_ANNOTATION])
+        if self.transport == "tunnel":
+            sidecars = [self.get_tunnel_side_car()]
+        elif not skip_openvpn_sidecar:
+            sidecars = [self.get_side_car()]
+        else:
+            sidecars = []
+            self.ephemeral_pki = False
+        volumes, volume_mounts = self.configmap_volumes()
+        with self.phase("build_manifest"):
+            swap_deployment = swap_manifest(
+                deployment,
+                name="{}-swap".format(self.deployment_name),
+                labels={
+                    "remote_http_port": self.remote_http_port,
+                    "remote_grpc_port": self.remote_grpc_port,
+                    "remote_host": self.remote_host,
+                    SWAP_LABEL: self.deployment_name,
+                },
+                annotations=self.swap_annotations(),
+                template_labels={SWAP_LABEL: self.deployment_name},
+                image=self.get_default_image(),
+                sidecars=sidecars,
+                volumes=volumes,
+                volume_mounts=volume_mounts,
+                replicas=replicas,
+                disable_liveness=disable_liveness,
+                disable_readiness=disable_readiness,
+            )
         return swap_deployment, deployment
 
-    def portforward_openvpn(self, deployment):
-        labels = deployment.spec.template.metadata.labels
+    def swap_annotations(self):
+        """Owner, transport and target of this swap, metadata only so the spec hash ignores them"""
+        annotations = {
+            TRANSPORT_ANNOTATION: self.transport,
+            TARGET_ANNOTATION: f"{self.remote_host}:{self.remote_http_port},{self.remote_grpc_port}",
+        }
+        if self.session.owner:
+            annotations[OWNER_ANNOTATION] = self.session.owner
+        if self.mirror:
+            annotations[MIRROR_ANNOTATION] = f"{self.mirror['percent']}%"
+        return annotations
+
+    def list_swaps(self, namespace=None):
+        """Every active swap, of all namespaces or just namespace, with one list request"""
+        if namespace:
+            items = self._call(
+                self.extensions_v1beta1.list_namespaced_deployment,
+                namespace=namespace, label_selector=SWAP_LABEL
+            ).items
+        else:
+            items = self._call(
+                self.extensions_v1beta1.list_deployment_for_all_namespaces,
+                label_selector=SWAP_LABEL
+            ).items
+        now = datetime.datetime.now(datetime.timezone.utc)
+        swaps = []
+        for item in items:
+            annotations = item.metadata.annotations or {}
+            name = item.metadata.labels[SWAP_LABEL]
+            created = item.metadata.creation_timestamp
+            swaps.append({
+                "namespace": item.metadata.namespace,
+                "deployment": name,
+                "owner": annotations.get(OWNER_ANNOTATION),
+                "transport": annotations.get(TRANSPORT_ANNOTATION),
+                "target": annotations.get(TARGET_ANNOTATION),
+                "mirror": annotations.get(MIRROR_ANNOTATION),
+                "age": int((now - created).total_seconds()) if created else None,
+                "replicas": item.spec.replicas,
+                "ready_replicas": (item.status and item.status.ready_replicas) or 0,
+                "tunnel": self.local_tunnel_status(name, annotations.get(TRANSPORT_ANNOTATION))
+                if item.metadata.namespace == self.namespace else None,
+            })
+        return sorted(swaps, key=lambda swap: (swap["namespace"], swap["deployment"]))
+
+    def local_tunnel_status(self, name, transport):
+        """State of the port forward to the swap of name from this machine, None when not running"""
+        prefix = "tunnel" if transport == "tunnel" else "portforward"
+        prefix = os.path.join(self.openvpn.conf_location, f"{prefix}-{name}")
+        if not get_pid(f"{prefix}.pid"):
+            return None
+        try:
+            with open(f"{prefix}.json") as f:
+                state = json.load(f).get("state")
+        except (OSError, ValueError):
+            state = "running"
+        if transport != "tunnel":
+            vpn = self.openvpn.collected_status()
+            if vpn:
+                state = f"{state}, vpn {vpn['state'].lower()}"
+            elif not self.openvpn.get_vpn_pid():
+                state = f"{state}, vpn down"
+        return state
+
+    def plan_weight(self, original_replicas, weight):
+        """Original replicas to keep, swap replicas and the percent nginx sends to remote_host.
+
+        Service traffic is spread over the pods, swap pods next to keep
+        original pods get swap/(keep + swap) of it. Below weight the swap runs
+        more pods, above it nginx sends the rest of its requests back to the
+        service. The ones that land on a swap pod again are split again, the
+        percent allows for that.
+        """
+        target = weight / 100
+        if target >= 1:
+            return 0, 1, 100.0
+        # as many originals as keep one swap pod's share at or above target
+        keep = max(1, min(original_replicas, int(round((1 - target) / target, 9))))
+        swap = max(1, math.ceil(round(target * keep / (1 - target), 9)))
+        if swap > MAX_WEIGHT_REPLICAS:
+            raise ValueError("--weight={:g} needs {} swap pods next to one original, at most {} "
+                             "are run, use up to {:.1f} or a full swap".format(
+                                 weight, swap, MAX_WEIGHT_REPLICAS,
+                                 100 * MAX_WEIGHT_REPLICAS / (MAX_WEIGHT_REPLICAS + 1)))
+        swap_share = swap / (keep + swap)
+        if swap_share <= target:
+            return keep, swap, 100.0
+        local = target * (1 - swap_share) / (swap_share * (1 - target))
+        return keep, swap, round(local * 100, 2)
+
+    def find_cluster_upstreams(self, labels):
+        """host:port of the service in front of the deployment, for http and grpc"""
+        http_upstream = grpc_upstream = None
+        for service in self._call(
+            self.api_inst.list_namespaced_service, namespace=self.namespace
+        ).items:
+            selector = service.spec.selector
+            if not selector or any(labels.get(key) != value for key, value in selector.items()):
+                continue
+            for port in service.spec.ports:
+                target = str(port.target_port or port.port)
+                address = f"{service.metadata.name}:{port.port}"
+                if target in ("80", "http") or port.name == "http":
+                    http_upstream = http_upstream or address
+                elif target in ("50050", "grpc") or port.name == "grpc":
+                    grpc_upstream = grpc_upstream or address
+            if http_upstream:
+                break
+        return http_upstream, grpc_upstream
+
+    @traced("apply_weight")
+    def apply_weight(self, swap_deployment, deployment):
+        """Turn a full swap into swap pods taking about weight percent of the traffic"""
+        annotations = deployment["metadata"].get("annotations") or {}
+        original_replicas = int(annotations.get(ORIGINAL_REPLICAS_ANNOTATION,
+                                                deployment["spec"].get("replicas") or 0))
+        keep, swap, local_percent = self.plan_weight(original_replicas, self.weight)
+        swap_deployment["spec"]["replicas"] = swap
+        swap_share = swap / (keep + swap)
+        if local_percent < 100:
+            labels = deployment["spec"]["template"]["metadata"]["labels"]
+            self.cluster_http_upstream, self.cluster_grpc_upstream = \
+                self.find_cluster_upstreams(labels)
+            if not self.cluster_http_upstream:
+                raise RuntimeError("No service selects {}, can not split traffic below {:.0f}%"
+                                   .format(self.deployment_name, 100 * swap_share))
+            self.local_percent = local_percent
+        local = local_percent / 100
+        effective = swap_share * local / (1 - swap_share * (1 - local))
+        print(f"{self.deployment_name}: keeping {keep} original replicas next to {swap} swap pods, "
+              f"they send {local_percent}% of their requests to {self.remote_host}, "
+              f"about {effective * 100:.1f}% of the traffic")
+        return keep
+
+    @traced("apply_mirror")
+    def apply_mirror(self, swap_deployment, deployment):
+        """Keep the original serving, one swap pod proxies to it and copies requests to remote_host.
+
+        The swap pod gets its share of the service traffic, 1/(original + 1),
+        passes it back to the service and sends the sampled copies down the
+        tunnel. Returns the original replicas to keep, all of them.
+        """
+        annotations = deployment["metadata"].get("annotations") or {}
+        keep = int(annotations.get(ORIGINAL_REPLICAS_ANNOTATION,
+                                   deployment["spec"].get("replicas") or 0))
+        if keep < 1:
+            raise RuntimeError(f"{self.deployment_name} has no replicas to keep serving")
+        swap_deployment["spec"]["replicas"] = 1
+        labels = deployment["spec"]["template"]["metadata"]["labels"]
+        self.cluster_http_upstream, self.cluster_grpc_upstream = \
+            self.find_cluster_upstreams(labels)
+        if not self.cluster_http_upstream:
+            raise RuntimeError(f"No service selects {self.deployment_name}, nothing to mirror")
+        print(f"{self.deployment_name}: {keep} original replicas keep serving, the swap pod sees "
+              f"about {100 / (keep + 1):.0f}% of the requests and copies "
+              f"{self.mirror['percent']}% of those to {self.remote_host}")
+        return keep
+
+    def get_pod_name(self, labels):
+        """Name of a ready pod matching labels, from the cache daemon when it runs.
+
+        Terminating and not ready pods are skipped, the API is asked when the
+        cache has none, it may not have seen a new pod yet.
+        """
+        cached = self.cache.query("pods", labels=labels)
+        if cached:
+            for pod in cached:
+                if pod["ready"] and not pod["terminating"]:
+                    return pod["name"]
         label_list = None
         for key in labels:
             label_list = self.add_labels(label_list, "{}={}".format(key, labels[key]))
-        pod_name = (
-            self.api_inst.list_namespaced_pod(
-                namespace=self.namespace, label_selector=label_list
-            )
-                .items[0]
-                .metadata.name
-        )
+        for pod in self._call(
+            self.api_inst.list_namespaced_pod,
+            namespace=self.namespace, label_selector=label_list
+        ).items:
+            if not pod.metadata.deletion_timestamp and any(
+                c.type == "Ready" and c.status == "True" for c in pod.status.conditions or []
+            ):
+                return pod.metadata.name
+        raise RuntimeError("No ready pod matches {}".format(label_list))
+
+    def portforward_openvpn(self, deployment):
+        pod_name = self.get_pod_name(deployment.spec.template.metadata.labels)
         kubeconfig = os.getenv('KUBECONFIG', None)
         if kubeconfig:
             cmd = f"KUBECONFIG={kubeconfig} kubectl port-forward {pod_name} 1194"
@@ -373,26 +1007,200 @@ class SwapDeployment:
         run_in_new_window(cmd)
         self.openvpn.run_vpn_if_needed()
 
+    @traced("port_forward_start")
+    def portforward_openvpn_headless(self, deployment):
+        """Supervised port forward in a background process and openvpn as a daemon"""
+        pid_file = os.path.join(self.openvpn.conf_location,
+                                f"portforward-{self.deployment_name}.pid")
+        pid = get_pid(pid_file)
+        if pid:
+            print(f"Port forward running, pid {pid}")
+        else:
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "swap_deployment.py")
+            proc = subprocess.Popen(
+                [sys.executable, script, "port-forward",
+                 f"--deployment={self.deployment_name}"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+            with open(pid_file, "w") as f:
+                f.write(str(proc.pid))
+            print(f"Port forward started, pid {proc.pid}, status in "
+                  f"config/portforward-{self.deployment_name}.json")
+        self.openvpn.run_vpn_if_needed(headless=True)
+
+    def run_port_forwarder(self, deployment, local_port=1194, remote_port=1194):
+        from port_forwarder import PortForwarder
+
+        prefix = os.path.join(self.openvpn.conf_location, f"portforward-{self.deployment_name}")
+        forwarder = PortForwarder(
+            self,
+            deployment.spec.template.metadata.labels,
+            local_port=local_port,
+            remote_port=remote_port,
+            status_file=f"{prefix}.json",
+            log_file=f"{prefix}.log",
+        )
+        forwarder.run()
+
+    def run_tunnel_client(self, deployment, target_host="127.0.0.1"):
+        """Port forward to the tunnel sidecar and connect its streams to target_host"""
+        import asyncio
+        from port_forwarder import PortForwarder
+        from tunnel_agent import run_client
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            local_port = sock.getsockname()[1]
+        prefix = os.path.join(self.openvpn.conf_location, f"tunnel-{self.deployment_name}")
+        with open(f"{prefix}.pid", "w") as f:
+            f.write(str(os.getpid()))
+        forwarder = PortForwarder(
+            self,
+            deployment.spec.template.metadata.labels,
+            local_port=local_port,
+            remote_port=TUNNEL_PORT,
+            status_file=f"{prefix}.json",
+            log_file=f"{prefix}.log",
+        )
+        threading.Thread(target=forwarder.run, daemon=True).start()
+        for container in deployment.spec.template.spec.containers:
+            for env in container.env or []:
+                if container.name == "tunnel" and env.name == "TUNNEL_PORTS":
+                    ports = sorted({int(port.split(":")[1]) for port in env.value.split(",")})
+                    print("Tunnelling ports {} to {}".format(
+                        ", ".join(map(str, ports)), target_host))
+        asyncio.run(run_client("127.0.0.1", local_port, target_host))
+
     def setup_sudoers(self):
         self.openvpn.setup_sudoers()
 
     def reset_vpn(self):
         self.openvpn.reset_vpn()
 
-    def get_swap_deployment(self):
-        original = self.get_deployment("{}".format(self.deployment_name))
-        swapped = self.get_deployment("{}-swap".format(self.deployment_name))
-        return swapped, original
+    def scale_deployment(self, name, replicas=1):
+        """Patch only the scale subresource, no need to read the deployment first"""
+        self._call(
+            self.extensions_v1beta1.patch_namespaced_deployment_scale,
+            name=name, namespace=self.namespace, body={"spec": {"replicas": replicas}}
+        )
+
+    def find_hpa(self, name):
+        """The HorizontalPodAutoscaler scaling deployment name, if there is one"""
+        for hpa in self._call(
+            self.autoscaling_v1.list_namespaced_horizontal_pod_autoscaler,
+            namespace=self.namespace
+        ).items:
+            target = hpa.spec.scale_target_ref
+            if target.kind == "Deployment" and target.name == name:
+                return hpa
+
+    @traced("pause_original")
+    def pause_original(self, deployment, replicas=0, pause_hpa=True):
+        """Scale the original down, remembering its replicas and HPA in annotations.
 
-    def scale_deployment(self, deployment, replicas=1):
-        deployment.spec.replicas = replicas
-        self.extensions_v1beta1.patch_namespaced_deployment(
-            name=deployment.metadata.name, namespace=self.namespace, body=deployment
+        When original replicas are kept the HPA is removed while the swap is
+        active so it can not scale them, swap-off recreates it from the
+        annotation with its autoscaling/v2 metrics and behavior. An HPA does
+        not scale a deployment at 0 replicas, a full swap does not look it up.
+        A mirroring swap leaves the HPA alone. Returns True when something was
+        written, a paused original at the same size is left alone.
+        """
+        patch = {"metadata": {"annotations": {}}, "spec": {"replicas": replicas}}
+        hpa = None
+        name = deployment["metadata"]["name"]
+        if self.is_swapped(deployment):
+            if deployment["spec"].get("replicas") == replicas:
+                return False
+        else:
+            patch["metadata"]["annotations"][ORIGINAL_REPLICAS_ANNOTATION] = str(
+                deployment["spec"].get("replicas"))
+            hpa = self.find_hpa(name) if pause_hpa and replicas else None
+        if hpa:
+            manifest = self.session.api_client.sanitize_for_serialization(hpa)
+            v2_annotations = {
+                key: value for key, value in (manifest["metadata"].get("annotations") or {}).items()
+                if key.startswith(HPA_V2_ANNOTATION_PREFIX) and key not in HPA_V2_STATUS_ANNOTATIONS
+            }
+            patch["metadata"]["annotations"][HPA_ANNOTATION] = json.dumps({
+                "apiVersion": "autoscaling/v1",
+                "kind": "HorizontalPodAutoscaler",
+                "metadata": {
+                    "name": manifest["metadata"]["name"],
+                    "labels": manifest["metadata"].get("labels"),
+                    "annotations": v2_annotations or None,
+                },
+                "spec": manifest["spec"],
+            })
+        self._call(
+            self.extensions_v1beta1.patch_namespaced_deployment,
+            name=name, namespace=self.namespace, body=patch
         )
+        if hpa:
+            print(f"Pausing HPA {hpa.metadata.name} while {name} is swapped")
+            self._call(
+                self.autoscaling_v1.delete_namespaced_horizontal_pod_autoscaler,
+                name=hpa.metadata.name, namespace=self.namespace
+            )
+        return True
+
+    @traced("handover")
+    def handover(self, name, timeout=300):
+        """Wait until deployment name, the swap or the original, serves traffic"""
+        from handover import Handover
 
-    def delete_deployment(self, deployment):
-        self.extensions_v1beta1.delete_namespaced_deployment(
-            name=deployment.metadata.name,
+        deployment = self.get_deployment_manifest(name)
+        labels = dict(deployment["spec"]["template"]["metadata"]["labels"])
+        if SWAP_LABEL in labels:
+            label_selector = f"{SWAP_LABEL}={labels[SWAP_LABEL]}"
+        else:
+            selector = deployment["spec"].get("selector") or {}
+            match_labels = selector.get("matchLabels") or labels
+            label_selector = ",".join(
+                [f"{key}={value}" for key, value in match_labels.items()] + [f"!{SWAP_LABEL}"]
+            )
+        labels.pop(SWAP_LABEL, None)
+        return Handover(self, timeout=timeout).wait(name, labels, label_selector)
+
+    @traced("restore_original")
+    def restore_original(self, timeout=300, wait=True):
+        """Scale the original back to its recorded size and bring its HPA back.
+
+        Waits until every replica is ready and in the service endpoints, the
+        caller deletes the swap deployment only after that.
+        """
+        deployment = self.get_deployment_manifest(self.deployment_name)
+        annotations = deployment["metadata"].get("annotations") or {}
+        replicas = int(annotations.get(ORIGINAL_REPLICAS_ANNOTATION, 1))
+        self.scale_deployment(self.deployment_name, replicas=replicas)
+        if wait:
+            # read again after the scale, the handover watches the new generation
+            self._manifests.pop(self.deployment_name)
+            self.handover(self.deployment_name, timeout=timeout)
+        if HPA_ANNOTATION in annotations:
+            hpa = json.loads(annotations[HPA_ANNOTATION])
+            print(f"Restoring HPA {hpa['metadata']['name']}")
+            try:
+                self._call(
+                    self.autoscaling_v1.create_namespaced_horizontal_pod_autoscaler,
+                    namespace=self.namespace, body=hpa
+                )
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+        self._call(
+            self.extensions_v1beta1.patch_namespaced_deployment,
+            name=self.deployment_name, namespace=self.namespace,
+            body={"metadata": {"annotations": {
+                ORIGINAL_REPLICAS_ANNOTATION: None, HPA_ANNOTATION: None}}}
+        )
+        return replicas
+
+    def delete_deployment(self, name):
+        self._call(
+            self.extensions_v1beta1.delete_namespaced_deployment,
+            name=name,
             namespace=self.namespace,
             body=client.V1DeleteOptions(),
         )
@@ -402,30 +1210,17 @@ class SwapDeployment:
             return "{}".format(label)
         return "{},{}".format(labels, label)
 
-    def get_env_values(self, deployment, export):
-        envs = "echo FROM_K8S=yes"
-        for env in deployment.spec.template.spec.containers[0].env:
-            if export:
-                envs = "{}; echo export {}=${}".format(envs, env.name, env.name)
-            else:
-                envs = "{}; echo {}=${}".format(envs, env.name, env.name)
-        command = ["/bin/bash", "-c", envs]
-        labels = deployment.spec.template.metadata.labels
-        label_list = None
-        for key in labels:
-            label_list = self.add_labels(label_list ,"{}={}".format(key, labels[key]))
-        name = (
-            self.api_inst.list_namespaced_pod(
-                namespace=self.namespace, label_selector=label_list
-            )
-            .items[0]
-            .metadata.name
-        )
-        container_name = deployment.spec.template.spec.containers[0].name
+    def exec_in_pod(self, pod_name, container_name, command):
+        from kubernetes.stream import stream
+
         try:
-            api_response = stream(
-                self.api_inst.connect_get_namespaced_pod_exec,
-                name=name,
+            # stream() swaps the request method of the api client it is given,
+            # so exec gets its own client instead of the shared one
+            exec_api = client.CoreV1Api(client.ApiClient(self.session.api_client.configuration))
+            return self._call(
+                stream,
+                exec_api.connect_get_namespaced_pod_exec,
+                name=pod_name,
                 namespace=self.namespace,
                 command=command,
                 container=container_name,
@@ -434,9 +1229,34 @@ class SwapDeployment:
                 stdout=True,
                 tty=False,
             )
-            print(api_response)
         except ApiException as e:
             print(
                 "Exception when calling CoreV1Api->connect_get_namespaced_pod_exec: %s\n"
                 % e
             )
+
+    @traced("exec_env")
+    def get_env_values(self, deployment, export):
+        envs = "echo FROM_K8S=yes"
+        for env in deployment.spec.template.spec.containers[0].env:
+            if export:
+                envs = "{}; echo export {}=${}".format(envs, env.name, env.name)
+            else:
+                envs = "{}; echo {}=${}".format(envs, env.name, env.name)
+        command = ["/bin/bash", "-c", envs]
+        name = self.get_pod_name(deployment.spec.template.metadata.labels)
+        container_name = deployment.spec.template.spec.containers[0].name
+        return self.exec_in_pod(name, container_name, command)
+
+    @traced("resolve_env")
+    def resolve_env_values(self, deployment, export, ttl=60, env_file=None):
+        """Environment computed from the deployment spec, exec only for runtime values"""
+        from env_resolver import EnvResolver
+
+        resolver = EnvResolver(self, ttl=ttl)
+        containers = resolver.resolve(deployment)
+        if env_file:
+            for path in resolver.write_env_files(env_file, containers):
+                print(f"Wrote {path}", file=sys.stderr)
+        first = deployment.spec.template.spec.containers[0].name
+        return resolver.format(containers[first], export)
@@ -0,0 +1,219 @@
+import base64
+import json
+import os
+import re
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes.client.rest import ApiException
+
+VAR_REF = re.compile(r"\$\$|\$\(([A-Za-z_][A-Za-z0-9_.-]*)\)")
+LABEL_REF = re.compile(r"metadata\.(labels|annotations)\['(.+)'\]")
+
+
+def expand(value, defined):
+    """$(VAR) expansion the way the kubelet does it, $$ escapes a $"""
+
+    def replace(match):
+        if match.group(0) == "$$":
+            return "$"
+        value = defined.get(match.group(1))
+        return match.group(0) if value is None else value
+
+    return VAR_REF.sub(replace, value)
+
+
+class EnvResolver:
+    """Effective container environment computed from the deployment spec.
+
+    ConfigMaps and Secrets referenced by env and envFrom are fetched once
+    each. Values only known inside a running pod (pod name, pod ip, resource
+    fields) are read with one exec per container. Results are cached under
+    config/env-cache for ttl seconds, keyed on the deployment resourceVersion.
+    """
+
+    def __init__(self, swap, ttl=60, cache_dir=None):
+        self.swap = swap
+        self.ttl = int(ttl)
+        self.cache_dir = cache_dir or os.path.join(os.getcwd(), "config", "env-cache")
+
+    def cache_file(self, deployment):
+        return os.path.join(self.cache_dir, "{}.{}.json".format(
+            self.swap.namespace, deployment.metadata.name))
+
+    def load_cache(self, deployment):
+        try:
+            with open(self.cache_file(deployment)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached["resource_version"] != deployment.metadata.resource_version:
+            return None
+        if time.time() - cached["created"] > self.ttl:
+            return None
+        return {name: [tuple(env) for env in envs] for name, envs in cached["containers"].items()}
+
+    def save_cache(self, deployment, containers):
+        os.makedirs(self.cache_dir, 0o700, exist_ok=True)
+        path = self.cache_file(deployment)
+        # Secret values end up in here
+        fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({
+                "created": time.time(),
+                "resource_version": deployment.metadata.resource_version,
+                "containers": containers,
+            }, f)
+        os.replace(f"{path}.tmp", path)
+
+    def resolve(self, deployment):
+        """{container name: [(name, value), ...]} in the order the kubelet sets them"""
+        containers = self.load_cache(deployment)
+        if containers is not None:
+            return containers
+        pod_spec = deployment.spec.template.spec
+        configmaps, secrets = self.fetch_references(pod_spec.containers)
+        containers = {}
+        runtime = {}
+        for container in pod_spec.containers:
+            envs, unresolved, deferred = self.resolve_container(
+                deployment.spec.template, container, configmaps, secrets)
+            containers[container.name] = envs
+            if unresolved:
+                runtime[container.name] = (unresolved, deferred)
+        if runtime:
+            self.resolve_runtime(deployment, containers, runtime)
+        self.save_cache(deployment, containers)
+        return containers
+
+    def fetch_references(self, containers):
+        """Every ConfigMap and Secret used by the containers, each fetched once"""
+        wanted = set()
+        for container in containers:
+            for env_from in container.env_from or []:
+                if env_from.config_map_ref:
+                    wanted.add(("configmap", env_from.config_map_ref.name))
+                if env_from.secret_ref:
+                    wanted.add(("secret", env_from.secret_ref.name))
+            for env in container.env or []:
+                value_from = env.value_from
+                if value_from and value_from.config_map_key_ref:
+                    wanted.add(("configmap", value_from.config_map_key_ref.name))
+                if value_from and value_from.secret_key_ref:
+                    wanted.add(("secret", value_from.secret_key_ref.name))
+        fetched = {"configmap": {}, "secret": {}}
+        if not wanted:
+            return fetched["configmap"], fetched["secret"]
+        wanted = sorted(wanted)
+        with ThreadPoolExecutor(max_workers=min(8, len(wanted))) as pool:
+            for (kind, name), data in zip(wanted, pool.map(self.fetch, wanted)):
+                if data is not None:
+                    fetched[kind][name] = data
+        return fetched["configmap"], fetched["secret"]
+
+    def fetch(self, reference):
+        kind, name = reference
+        try:
+            if kind == "configmap":
+                return self.swap._call(self.swap.api_inst.read_namespaced_config_map,
+                                       name, self.swap.namespace).data or {}
+            data = self.swap._call(self.swap.api_inst.read_namespaced_secret,
+                                   name, self.swap.namespace).data or {}
+            return {
+                key: base64.b64decode(value).decode("utf-8", "replace")
+                for key, value in data.items()
+            }
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def resolve_container(self, template, container, configmaps, secrets):
+        """[(name, value), ...] with None for runtime values, their names and the
+        values referencing them as written, expanded once the runtime ones are known"""
+        envs = {}
+        unresolved = []
+        deferred = {}
+        for env_from in container.env_from or []:
+            prefix = env_from.prefix or ""
+            if env_from.config_map_ref:
+                source = configmaps.get(env_from.config_map_ref.name, {})
+            else:
+                source = secrets.get(env_from.secret_ref.name, {})
+            for key, value in source.items():
+                envs[prefix + key] = value
+        for env in container.env or []:
+            value_from = env.value_from
+            deferred.pop(env.name, None)
+            if not value_from:
+                value = env.value or ""
+                if any(envs.get(match.group(1), "") is None for match in VAR_REF.finditer(value)):
+                    deferred[env.name] = value
+                envs[env.name] = expand(value, envs)
+                continue
+            value = self.resolve_value_from(template, value_from, configmaps, secrets)
+            if value is None:
+                unresolved.append(env.name)
+            envs[env.name] = value
+        # unresolved names keep their place as None, the exec fills them in later
+        return list(envs.items()), unresolved, deferred
+
+    def resolve_value_from(self, template, value_from, configmaps, secrets):
+        if value_from.config_map_key_ref:
+            ref = value_from.config_map_key_ref
+            return configmaps.get(ref.name, {}).get(ref.key)
+        if value_from.secret_key_ref:
+            ref = value_from.secret_key_ref
+            return secrets.get(ref.name, {}).get(ref.key)
+        if value_from.field_ref:
+            path = value_from.field_ref.field_path
+            if path == "metadata.namespace":
+                return self.swap.namespace
+            if path == "spec.serviceAccountName":
+                return template.spec.service_account_name or "default"
+            match = LABEL_REF.match(path)
+            if match:
+                values = getattr(template.metadata, match.group(1)) or {}
+                return values.get(match.group(2))
+        # pod name, pod ip, node name and resource fields are only known at runtime
+        return None
+
+    def resolve_runtime(self, deployment, containers, runtime):
+        pod_name = self.swap.get_pod_name(deployment.spec.template.metadata.labels)
+        for container_name, (names, deferred) in runtime.items():
+            script = "; ".join('printf "%s\\0" "{0}=${0}"'.format(name) for name in names)
+            output = self.swap.exec_in_pod(pod_name, container_name, ["/bin/sh", "-c", script])
+            values = {}
+            for line in (output or "").split("\0"):
+                if "=" in line:
+                    name, value = line.split("=", 1)
+                    values[name] = value
+            # $(VAR) of a runtime value expands now, with what is defined before it
+            defined = {}
+            for name, value in containers[container_name]:
+                if value is None:
+                    value = values.get(name, "")
+                elif name in deferred:
+                    value = expand(deferred[name], defined)
+                defined[name] = value
+            containers[container_name] = list(defined.items())
+
+    def format(self, envs, export):
+        lines = ["FROM_K8S=yes"]
+        for name, value in envs:
+            if export:
+                lines.append("export {}={}".format(name, shlex.quote(value)))
+            else:
+                lines.append("{}={}".format(name, shlex.quote(value)))
+        return "\n".join(lines)
+
+    def write_env_files(self, env_file, containers):
+        """One .env file per container, suffixed with the container name if there are more"""
+        paths = []
+        for name, envs in containers.items():
+            path = env_file if len(containers) == 1 else f"{env_file}.{name}"
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(self.format(envs, export=False) + "\n")
+            paths.append(path)
+        return paths
@@ -0,0 +1,108 @@
+"""Short lived CA, server and client credentials for one swap
+
+Generated in process when swap runs with --ephemeral_pki. The server half goes
+into a Secret that the openvpn sidecar reads as OVPN_* environment variables,
+the same variables the image has baked in, so the image stays as it is. The
+client half is written to a local .ovpn profile.
+"""
+import base64
+import datetime
+import hashlib
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+KEY_BITS = 2048
+PEM = serialization.Encoding.PEM
+
+
+def new_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=KEY_BITS)
+
+
+def key_pem(key):
+    return key.private_bytes(PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                             serialization.NoEncryption())
+
+
+def name(common_name):
+    return x509.Name([x509.NameAttribute(NameOID.ORGANIZATION_NAME, "deployment-swapper"),
+                      x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+
+
+def sign(subject, key, ca_name, ca_key, not_after, extensions):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = x509.CertificateBuilder() \
+        .subject_name(subject) \
+        .issuer_name(ca_name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(minutes=5)) \
+        .not_valid_after(not_after) \
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+    for extension, critical in extensions:
+        builder = builder.add_extension(extension, critical=critical)
+    return builder.sign(ca_key, hashes.SHA256())
+
+
+def usage(**flags):
+    values = dict(digital_signature=False, content_commitment=False, key_encipherment=False,
+                  data_encipherment=False, key_agreement=False, key_cert_sign=False,
+                  crl_sign=False, encipher_only=False, decipher_only=False)
+    values.update(flags)
+    return x509.KeyUsage(**values)
+
+
+def issue(swap_name, days=7):
+    """PEM credentials for swap_name, valid for days, and when they expire"""
+    not_after = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0) \
+        + datetime.timedelta(days=days)
+    ca_key, server_key, client_key = new_key(), new_key(), new_key()
+    ca_name = name(f"{swap_name} swap CA")
+    ca = sign(ca_name, ca_key, ca_name, ca_key, not_after, [
+        (x509.BasicConstraints(ca=True, path_length=0), True),
+        (usage(key_cert_sign=True, crl_sign=True), True),
+    ])
+    # what remote-cert-tls server on the client checks
+    server = sign(name(f"{swap_name}-swap"), server_key, ca_name, ca_key, not_after, [
+        (x509.BasicConstraints(ca=False, path_length=None), True),
+        (usage(digital_signature=True, key_encipherment=True), True),
+        (x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), False),
+    ])
+    client = sign(name(f"{swap_name}-client"), client_key, ca_name, ca_key, not_after, [
+        (x509.BasicConstraints(ca=False, path_length=None), True),
+        (usage(digital_signature=True), True),
+        (x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]), False),
+    ])
+    # the sidecar runs crl-verify, it needs a CRL of this CA, nothing is revoked
+    crl = x509.CertificateRevocationListBuilder() \
+        .issuer_name(ca_name) \
+        .last_update(datetime.datetime.now(datetime.timezone.utc)) \
+        .next_update(not_after) \
+        .sign(ca_key, hashes.SHA256())
+    return {
+        "ca": ca.public_bytes(PEM),
+        "server_crt": server.public_bytes(PEM),
+        "server_key": key_pem(server_key),
+        "client_crt": client.public_bytes(PEM),
+        "client_key": key_pem(client_key),
+        "crl": crl.public_bytes(PEM),
+        "expires": not_after,
+    }
+
+
+def sidecar_env(credentials):
+    """OVPN_* values as gen_server.sh reads them, base64 PEM"""
+    return {
+        "OVPN_CA": base64.b64encode(credentials["ca"]).decode(),
+        "OVPN_SERVER": base64.b64encode(credentials["server_crt"]).decode(),
+        "OVPN_KEY": base64.b64encode(credentials["server_key"]).decode(),
+        "OVPN_CRL": base64.b64encode(credentials["crl"]).decode(),
+    }
+
+
+def fingerprint(credentials):
+    """Identifies one issue, on the Secret, the pod template and the local profile"""
+    return hashlib.sha256(credentials["ca"] + credentials["server_crt"]).hexdigest()[:16]
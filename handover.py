@@ -0,0 +1,117 @@
+import functools
+import time
+from kubernetes import watch
+
+
+class HandoverTimeout(RuntimeError):
+    pass
+
+
+class Handover:
+    """Wait for the incoming side of a swap to serve before the outgoing side is drained.
+
+    Incoming pods have to be Ready and listed in the endpoints of every
+    service that selects them. Progress is printed as watch events arrive.
+    """
+
+    def __init__(self, swap, timeout=300, progress=print):
+        self.swap = swap
+        self.timeout = timeout
+        self.progress = progress
+        self.seconds = None
+
+    def _stream(self, func, deadline, **kwargs):
+        remaining = int(deadline - time.time())
+        if remaining <= 0:
+            return
+        w = watch.Watch()
+        for event in w.stream(functools.partial(self.swap._call, func),
+                              namespace=self.swap.namespace,
+                              timeout_seconds=remaining, **kwargs):
+            yield event["raw_object"]
+            if time.time() > deadline:
+                w.stop()
+
+    def wait_ready(self, name, deadline):
+        last = None
+        for obj in self._stream(self.swap.extensions_v1beta1.list_namespaced_deployment,
+                                deadline, field_selector=f"metadata.name={name}"):
+            spec, status = obj["spec"], obj.get("status") or {}
+            replicas = spec.get("replicas", 1)
+            ready = status.get("readyReplicas", 0)
+            updated = status.get("updatedReplicas", 0)
+            if (ready, replicas) != last:
+                self.progress(f"{name}: {ready}/{replicas} replicas ready")
+                last = (ready, replicas)
+            observed = status.get("observedGeneration", 0) >= obj["metadata"]["generation"]
+            if observed and ready >= replicas and updated >= replicas:
+                return
+        raise HandoverTimeout(f"{name}: replicas not ready after {self.timeout}s")
+
+    def services_for(self, labels):
+        return [
+            service.metadata.name
+            for service in self.swap._call(
+                self.swap.api_inst.list_namespaced_service, namespace=self.swap.namespace
+            ).items
+            if service.spec.selector
+            and all(labels.get(key) == value for key, value in service.spec.selector.items())
+        ]
+
+    def ready_pod_ips(self, label_selector):
+        pods = self.swap._call(
+            self.swap.api_inst.list_namespaced_pod,
+            namespace=self.swap.namespace, label_selector=label_selector
+        ).items
+        ready = [
+            pod for pod in pods
+            if pod.status.pod_ip and not pod.metadata.deletion_timestamp
+            and any(c.type == "Ready" and c.status == "True" for c in pod.status.conditions or [])
+        ]
+        for pod in ready:
+            self.trace_pod(pod)
+        return {pod.status.pod_ip for pod in ready}
+
+    def trace_pod(self, pod):
+        """Scheduling, image pull and start, readiness of a pod as spans, from its conditions"""
+        times = {c.type: c.last_transition_time for c in pod.status.conditions or []}
+        steps = [
+            ("pod_schedule", pod.metadata.creation_timestamp, times.get("PodScheduled")),
+            ("pod_start", times.get("PodScheduled"), times.get("ContainersReady")),
+            ("pod_ready", times.get("ContainersReady"), times.get("Ready")),
+        ]
+        for name, start, end in steps:
+            if start and end:
+                self.swap.tracer.add(name, start.timestamp(), (end - start).total_seconds(),
+                                     deployment=self.swap.deployment_name,
+                                     pod=pod.metadata.name)
+
+    def wait_endpoints(self, service, pod_ips, deadline):
+        for obj in self._stream(self.swap.api_inst.list_namespaced_endpoints,
+                                deadline, field_selector=f"metadata.name={service}"):
+            addresses = {
+                address["ip"]
+                for subset in obj.get("subsets") or []
+                for address in subset.get("addresses") or []
+            }
+            registered = len(pod_ips & addresses)
+            self.progress(f"{service}: {registered}/{len(pod_ips)} pods in endpoints")
+            if registered == len(pod_ips):
+                return
+        raise HandoverTimeout(f"{service}: pods not in the endpoints after {self.timeout}s")
+
+    def wait(self, name, labels, label_selector):
+        """Block until deployment name serves traffic, returns the seconds it took"""
+        start = time.time()
+        deadline = start + self.timeout
+        tracer = self.swap.tracer
+        with tracer.span("wait_ready", deployment=name):
+            self.wait_ready(name, deadline)
+        pod_ips = self.ready_pod_ips(label_selector)
+        if pod_ips:
+            for service in self.services_for(labels):
+                with tracer.span("wait_endpoints", deployment=name, service=service):
+                    self.wait_endpoints(service, pod_ips, deadline)
+        self.seconds = time.time() - start
+        self.progress(f"{name}: serving after {self.seconds:.1f}s")
+        return self.seconds
@@ -0,0 +1,193 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+
+def get_socket_path(namespace):
+    return os.path.join(os.getcwd(), "config", f"informer-{namespace}.sock")
+
+
+def deployment_summary(obj):
+    metadata = obj["metadata"]
+    status = obj.get("status") or {}
+    return {
+        "name": metadata["name"],
+        "labels": metadata.get("labels") or {},
+        "replicas": (obj.get("spec") or {}).get("replicas"),
+        "ready_replicas": status.get("readyReplicas", 0),
+    }
+
+
+def pod_summary(obj):
+    metadata = obj["metadata"]
+    status = obj.get("status") or {}
+    ready = any(
+        condition["type"] == "Ready" and condition["status"] == "True"
+        for condition in status.get("conditions") or []
+    )
+    return {
+        "name": metadata["name"],
+        "labels": metadata.get("labels") or {},
+        "phase": status.get("phase"),
+        "ready": ready,
+        "terminating": bool(metadata.get("deletionTimestamp")),
+    }
+
+
+class InformerCache:
+    """Watch fed index of the deployments and pods in one namespace"""
+
+    def __init__(self, session):
+        self.namespace = session.namespace
+        self.extensions_v1beta1 = client.ExtensionsV1beta1Api(session.api_client)
+        self.api_inst = client.CoreV1Api(session.api_client)
+        self.lock = threading.Lock()
+        self.objects = {"deployments": {}, "pods": {}}
+        self.label_index = {"deployments": {}, "pods": {}}
+        self.synced = {"deployments": threading.Event(), "pods": threading.Event()}
+
+    def start(self):
+        watches = [
+            ("deployments", self.extensions_v1beta1.list_namespaced_deployment, deployment_summary),
+            ("pods", self.api_inst.list_namespaced_pod, pod_summary),
+        ]
+        for kind, list_func, summary in watches:
+            thread = threading.Thread(
+                target=self._run_watch, args=(kind, list_func, summary), daemon=True
+            )
+            thread.start()
+        for event in self.synced.values():
+            event.wait()
+
+    def _run_watch(self, kind, list_func, summary):
+        while True:
+            try:
+                resource_version = self._relist(kind, list_func, summary)
+                self._watch(kind, list_func, summary, resource_version)
+            except ApiException as e:
+                print(f"Watch on {kind} failed: {e.reason}, relisting")
+                time.sleep(1)
+            except Exception as e:
+                print(f"Watch on {kind} failed: {e}, relisting")
+                time.sleep(1)
+
+    def _relist(self, kind, list_func, summary):
+        response = list_func(namespace=self.namespace, _preload_content=False)
+        items = json.loads(response.data)
+        with self.lock:
+            self.objects[kind] = {}
+            self.label_index[kind] = {}
+            for obj in items["items"]:
+                self._add(kind, summary(obj))
+        self.synced[kind].set()
+        return items["metadata"]["resourceVersion"]
+
+    def _watch(self, kind, list_func, summary, resource_version):
+        w = watch.Watch()
+        while True:
+            for event in w.stream(list_func, namespace=self.namespace,
+                                  resource_version=resource_version,
+                                  timeout_seconds=300):
+                obj = event["raw_object"]
+                if event["type"] == "ERROR":
+                    # Most likely 410 Gone, the resource version is too old
+                    return
+                resource_version = obj["metadata"]["resourceVersion"]
+                with self.lock:
+                    self._remove(kind, obj["metadata"]["name"])
+                    if event["type"] != "DELETED":
+                        self._add(kind, summary(obj))
+
+    def _add(self, kind, item):
+        self.objects[kind][item["name"]] = item
+        for label in item["labels"].items():
+            self.label_index[kind].setdefault(label, set()).add(item["name"])
+
+    def _remove(self, kind, name):
+        item = self.objects[kind].pop(name, None)
+        if not item:
+            return
+        for label in item["labels"].items():
+            names = self.label_index[kind].get(label)
+            if names:
+                names.discard(name)
+                if not names:
+                    del self.label_index[kind][label]
+
+    def query(self, kind, name=None, labels=None):
+        with self.lock:
+            if name:
+                item = self.objects[kind].get(name)
+                return [item] if item else []
+            if not labels:
+                return list(self.objects[kind].values())
+            names = None
+            for label in labels.items():
+                matches = self.label_index[kind].get(label, set())
+                names = matches.copy() if names is None else names & matches
+                if not names:
+                    return []
+            return [self.objects[kind][match] for match in sorted(names)]
+
+
+class CacheRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            items = self.server.cache.query(
+                request["kind"], name=request.get("name"), labels=request.get("labels")
+            )
+            self.wfile.write(json.dumps({"items": items}).encode() + b"\n")
+            self.wfile.flush()
+
+
+class CacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, cache, socket_path):
+        self.cache = cache
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, CacheRequestHandler)
+        os.chmod(socket_path, 0o600)
+
+
+def run_daemon(session):
+    socket_path = get_socket_path(session.namespace)
+    cache = InformerCache(session)
+    print(f"Syncing deployments and pods in namespace {session.namespace}...")
+    cache.start()
+    server = CacheServer(cache, socket_path)
+    print(f"Serving cache on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+class CacheClient:
+    """Queries a running cache daemon, every query returns None when it is not running"""
+
+    def __init__(self, namespace, timeout=1.0):
+        self.socket_path = get_socket_path(namespace)
+        self.timeout = timeout
+
+    def query(self, kind, name=None, labels=None):
+        if not os.path.exists(self.socket_path):
+            return None
+        request = {"kind": kind, "name": name, "labels": labels}
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.socket_path)
+                sock.sendall(json.dumps(request).encode() + b"\n")
+                with sock.makefile("rb") as response:
+                    return json.loads(response.readline())["items"]
+        except (OSError, ValueError):
+            return None
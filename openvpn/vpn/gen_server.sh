@@ -3,7 +3,14 @@
 echo $OVPN_CA | base64 -d > $OPENVPN/ca.crt
 echo $OVPN_SERVER | base64 -d > $OPENVPN/server.crt
 echo $OVPN_KEY | base64 -d > $OPENVPN/server.key
-echo $OVPN_DH | base64 -d > $OPENVPN/dh2048.pem
+# OVPN_DH none (wasy.py generate-certs --ecdh) uses ECDH, no DH parameters needed
+if [ -z "$OVPN_DH" ] || [ "$OVPN_DH" = "none" ]; then
+  DH_CONF="dh none
+ecdh-curve ${OVPN_ECDH_CURVE:-prime256v1}"
+else
+  echo $OVPN_DH | base64 -d > $OPENVPN/dh2048.pem
+  DH_CONF="dh     $OPENVPN/dh2048.pem"
+fi
 echo $OVPN_CRL | base64 -d > $OPENVPN/ca.crl
 echo $OVPN_TA | base64 -d > $OPENVPN/ta.key
 
@@ -15,7 +22,7 @@ duplicate-cn
 ca     $OPENVPN/ca.crt
 cert   $OPENVPN/server.crt
 key    $OPENVPN/server.key
-dh     $OPENVPN/dh2048.pem
+$DH_CONF
 crl-verify   $OPENVPN/ca.crl
 #tls-auth $OPENVPN/ta.key
 server $OSERVER_IP_RANGE $OSERVER_MASK
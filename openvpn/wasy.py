@@ -2,15 +2,26 @@
 """Create openvpn certifcate for server and client
 
 Usage:
-  wasy.py generate-certs
+  wasy.py generate-certs [--ecdh] [--workers=<n>]
   wasy.py cleanup-certs
   wasy.py get-server-config
   wasy.py get-client-config [--client=<name>]
   wasy.py create-client-config [--client=<name>]
+  wasy.py create-client-configs --clients-file=<file> [--out-dir=<dir>] [--workers=<n>]
+  wasy.py revoke-clients [--clients-file=<file>] [<name>...]
+  wasy.py list-clients [--revoked] [--expiring=<days>]
+  wasy.py fill-dh-pool [--size=<n>] [--workers=<n>]
   wasy.py (-h | --help)
 
 Options:
-  -h --help     Show this screen.
+  -h --help               Show this screen.
+  --clients-file=<file>   One client name (CN) per line, # starts a comment.
+  --out-dir=<dir>         Where the .ovpn files are written [default: .].
+  --workers=<n>           Keys, profiles or DH parameters generated in parallel [default: 8].
+  --revoked               Only revoked clients.
+  --expiring=<days>       Only valid clients expiring within days.
+  --ecdh                  No DH parameters, the server uses ECDH key exchange.
+  --size=<n>              DH parameter files kept in the pool [default: 4].
 """
 import subprocess
 import os
@@ -19,11 +30,118 @@ import datetime
 import jinja2
 import base64
 import shutil
+import bisect
+import fcntl
+import functools
+import json
+import time
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from docopt import docopt
 import sys
 
 sys.path.append(os.path.abspath(__file__))
 
+# default_days, default_crl_days and default_bits in openssl.cnf
+CLIENT_DAYS = 3650
+CRL_DAYS = 30
+CLIENT_KEY_BITS = 2048
+OPENSSL_TIME = '%y%m%d%H%M%SZ'
+DH_BITS = 2048
+DH_POOL_SIZE = 4
+
+# create() steps: name, steps it needs, method, files it leaves in wasy-ca.
+# Steps signing with openssl ca share index.txt and serial, so they run one
+# after the other.
+BOOTSTRAP_STEPS = [
+    ('dirs', [], 'make_config_dirs', ['index.txt', 'serial']),
+    ('ta', ['dirs'], 'generate_ta', ['ta.key']),
+    ('dh', ['dirs'], 'gen_dh_parama', ['dh2048.pem']),
+    ('ca', ['dirs'], 'make_ca_key_cert', ['ca.key', 'ca.crt']),
+    ('server', ['ca'], 'make_server_key_cert', ['keys/server.key', 'csr/server.csr', 'crt/server.crt']),
+    ('init-client', ['server'], 'create_init_client',
+     ['keys/init-client.key', 'csr/init-client.csr', 'crt/init-client.crt']),
+    ('revoke-init-client', ['init-client'], 'revoke_init_client', []),
+    ('crl', ['revoke-init-client'], 'make_crl', ['ca.crl']),
+]
+
+
+def parse_openssl_time(value):
+    """index.txt time, the revocation date can carry a reason after a comma"""
+    value = value.split(',')[0]
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, OPENSSL_TIME).replace(tzinfo=datetime.timezone.utc)
+
+
+class CertInventory():
+    """index.txt indexed by CN, serial, status and expiry
+
+    Built once from the file and kept up to date as clients are issued and
+    revoked, so audits and batch revocations do not re-parse the database.
+    """
+
+    def __init__(self, lines=(), stat=None):
+        self.entries = []
+        self.by_serial = {}
+        self.by_cn = {}
+        self.by_status = {}
+        self.by_expiry = []
+        self.stat = stat
+        for line in lines:
+            if line.strip():
+                self.add(self.parse_line(line))
+
+    @staticmethod
+    def parse_line(line):
+        """V 270411233003Z  01 unknown /C=IS/ST=NA/O=AtHome/CN=vpn-server.mikkari.net/emailAddress=admin@mikkari.net"""
+        s = line.rstrip('\n').split('\t')
+        subject = s[5]
+        cn = ''
+        for part in subject.split('/'):
+            if part.startswith('CN='):
+                cn = part[3:]
+        return {'status': s[0], 'expire': s[1], 'revoke': s[2], 'serial': s[3],
+                'filename': s[4], 'name': subject, 'cn': cn,
+                'expires': parse_openssl_time(s[1])}
+
+    @staticmethod
+    def format_line(entry):
+        return '\t'.join([entry['status'], entry['expire'], entry['revoke'], entry['serial'],
+                          entry['filename'], entry['name']]) + '\n'
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.by_serial[entry['serial']] = entry
+        self.by_cn.setdefault(entry['cn'], []).append(entry)
+        self.by_status.setdefault(entry['status'], {})[entry['serial']] = entry
+        bisect.insort(self.by_expiry, (entry['expires'], entry['serial']))
+
+    def revoke(self, entry, when):
+        del self.by_status[entry['status']][entry['serial']]
+        entry['status'] = 'R'
+        entry['revoke'] = when.strftime(OPENSSL_TIME)
+        self.by_status.setdefault('R', {})[entry['serial']] = entry
+
+    def valid(self, cn):
+        """The valid certificate of a client, None if it has none"""
+        for entry in reversed(self.by_cn.get(cn, [])):
+            if entry['status'] == 'V':
+                return entry
+        return None
+
+    def revoked(self):
+        return list(self.by_status.get('R', {}).values())
+
+    def expiring(self, before):
+        """Valid certificates that expire before the datetime, soonest first"""
+        end = bisect.bisect_left(self.by_expiry, (before, ''))
+        entries = (self.by_serial[serial] for _, serial in self.by_expiry[:end])
+        return [entry for entry in entries if entry['status'] == 'V']
+
+    def lines(self):
+        return [self.format_line(entry) for entry in self.entries]
+
 
 class Wasy():
     def __init__(self, config_dir='/tmp/test1'):
@@ -48,6 +166,8 @@ class Wasy():
         self.ta_key = os.path.join(self.config_dir, 'wasy-ca/ta.key')
         self.revoke_path = os.path.join(self.config_dir, 'wasy-ca/revoke')
         self.openssl_conf = os.path.join(self.config_dir, 'openssl.cnf')
+        # outside wasy-ca, the pool survives cleanup-certs
+        self.dh_pool = os.getenv('WASY_DH_POOL', os.path.join(self.config_dir, 'dh-pool'))
         self.env['WASY_PATH'] = self.base_path
 
     def get_ca_subj(self):
@@ -87,12 +207,9 @@ class Wasy():
             raise RuntimeError('{} exists, already configures.'.format('ta.key'))
 
     def make_config_dirs(self):
-        os.mkdir(self.base_path, 0o770)
-        os.mkdir(self.certs_path, 0o770)
-        os.mkdir(self.keys_path, 0o770)
-        os.mkdir(self.csr_path, 0o770)
-        os.mkdir(self.crt_path, 0o770)
-        os.mkdir(self.revoke_path, 0o770)
+        for path in [self.base_path, self.certs_path, self.keys_path, self.csr_path, self.crt_path,
+                     self.revoke_path]:
+            os.makedirs(path, 0o770, exist_ok=True)
         with open(os.path.join(self.base_path, 'index.txt'), 'w') as f:
             f.write('')
         f.close()
@@ -204,13 +321,67 @@ class Wasy():
         return '{} revoked..'.format(client_name)
 
     def gen_dh_parama(self):
-        # Generate DH parameters
-        cmds = ['openssl',
-                'dhparam',
-                '-out',
-                os.path.join(self.base_path, 'dh2048.pem'),
-                '2048']
-        subprocess.call(cmds, env=self.env)
+        # Generate DH parameters, from the pool when it has some
+        dh_file = os.path.join(self.base_path, 'dh2048.pem')
+        pooled = len(self.dh_pool_files())
+        if self.take_dh_params(dh_file):
+            # only a pool made with fill-dh-pool is topped up, back to its size
+            self.fill_dh_pool_background(pooled)
+        else:
+            cmds = ['openssl',
+                    'dhparam',
+                    '-out',
+                    dh_file,
+                    str(DH_BITS)]
+            subprocess.call(cmds, env=self.env)
+
+    def dh_pool_files(self):
+        if not os.path.isdir(self.dh_pool):
+            return []
+        return sorted(name for name in os.listdir(self.dh_pool) if name.endswith('.pem'))
+
+    def take_dh_params(self, dest):
+        """Move a pooled DH parameter file to dest, False when the pool is empty"""
+        for name in self.dh_pool_files():
+            try:
+                # rename is atomic, of two runs taking the same file one gets it
+                os.rename(os.path.join(self.dh_pool, name), dest)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                shutil.move(os.path.join(self.dh_pool, name), dest)
+            return True
+        return False
+
+    def fill_dh_pool(self, size=DH_POOL_SIZE, workers=2):
+        """Generate DH parameters until the pool holds size files, returns how many were made"""
+        os.makedirs(self.dh_pool, 0o770, exist_ok=True)
+        with open(os.path.join(self.dh_pool, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0  # another run is filling it
+            missing = size - len(self.dh_pool_files())
+
+            def generate(i):
+                tmp = os.path.join(self.dh_pool, '.dh{}-{}-{}.tmp'.format(DH_BITS, os.getpid(), i))
+                subprocess.call(['openssl', 'dhparam', '-out', tmp, str(DH_BITS)], env=self.env,
+                                stderr=subprocess.DEVNULL)
+                os.replace(tmp, os.path.join(self.dh_pool, 'dh{}-{}-{}.pem'.format(
+                    DH_BITS, datetime.datetime.now().strftime('%Y%m%d%H%M%S'), os.urandom(4).hex())))
+
+            if missing > 0:
+                with ThreadPoolExecutor(workers) as pool:
+                    list(pool.map(generate, range(missing)))
+            return max(missing, 0)
+
+    def fill_dh_pool_background(self, size):
+        """Top the pool up to size in a detached process, one openssl at a time"""
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'fill-dh-pool',
+                          '--size={}'.format(size), '--workers=1'],
+                         env=dict(self.env, WASY_DH_POOL=os.path.abspath(self.dh_pool)),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
 
     def make_crl(self):
         cmds = ['openssl',
@@ -222,29 +393,222 @@ class Wasy():
                 os.path.join(self.base_path, 'ca.crl')]
         subprocess.call(cmds, env=self.env)
 
-    def make_ovpn(self, client_name):
-        ca_data = open(os.path.join(self.base_path, 'ca.crt'), "r").read().splitlines()
-        key_data = open(os.path.join(self.keys_path, '{}.key'.format(client_name)), "r").read().splitlines()
-        crt_data = open(os.path.join(self.crt_path, '{}.crt'.format(client_name)), "r").read().splitlines()
+    @functools.lru_cache()
+    def ovpn_template(self):
         try:
             j2_env = jinja2.Environment(loader=jinja2.FileSystemLoader(self.config_dir),
                                         trim_blocks=True)
-            ret = j2_env.get_template('template.ovpn').render(ca_cert=ca_data,
-                                                        key_client=key_data,
-                                                        cert_client=crt_data,
-                                                        openvpn_server=self.openvpn_server,
-                                                        openvpn_port=self.openvpn_port,
-                                                        openvpn_proto=self.openvpn_proto)
-        except: ## Fallback to localath
+            return j2_env.get_template('template.ovpn')
+        except jinja2.TemplateNotFound: ## Fallback to localath
             j2_env = jinja2.Environment(loader=jinja2.FileSystemLoader('/code'),
                                         trim_blocks=True)
-            ret = j2_env.get_template('template.ovpn').render(ca_cert=ca_data,
-                                                              key_client=key_data,
-                                                              cert_client=crt_data,
-                                                              openvpn_server=self.openvpn_server,
-                                                              openvpn_port=self.openvpn_port,
-                                                              openvpn_proto=self.openvpn_proto)
-        return ret
+            return j2_env.get_template('template.ovpn')
+
+    def render_ovpn(self, ca_data, key_data, crt_data):
+        return self.ovpn_template().render(ca_cert=ca_data,
+                                           key_client=key_data,
+                                           cert_client=crt_data,
+                                           openvpn_server=self.openvpn_server,
+                                           openvpn_port=self.openvpn_port,
+                                           openvpn_proto=self.openvpn_proto)
+
+    def make_ovpn(self, client_name):
+        ca_data = open(os.path.join(self.base_path, 'ca.crt'), "r").read().splitlines()
+        key_data = open(os.path.join(self.keys_path, '{}.key'.format(client_name)), "r").read().splitlines()
+        crt_data = open(os.path.join(self.crt_path, '{}.crt'.format(client_name)), "r").read().splitlines()
+        return self.render_ovpn(ca_data, key_data, crt_data)
+
+    def create_clients(self, client_names, out_dir='.', workers=8):
+        """Keys, certificates and .ovpn profiles for many clients in one run
+
+        Same certificates as create_cert_client, made in process instead of two
+        openssl runs per client. The CA is loaded once and index.txt and serial
+        are updated once, under a lock, for the whole batch.
+        """
+        # cryptography only for this and revoke_clients, the rest runs openssl
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        names = []
+        for name in client_names:
+            if len(name) > 64:
+                print('{}: client cn name can not be longer then 64...'.format(name))
+            elif os.path.isfile(os.path.join(self.keys_path, '{}.key'.format(name))) or name in names:
+                print('{}: client exists, revoke or choose another client name (CN)'.format(name))
+            else:
+                names.append(name)
+        if not names:
+            return []
+
+        with open(os.path.join(self.base_path, 'ca.key'), 'rb') as f:
+            ca_key = serialization.load_pem_private_key(f.read(), password=None)
+        with open(os.path.join(self.base_path, 'ca.crt'), 'rb') as f:
+            ca_pem = f.read()
+        ca_cert = x509.load_pem_x509_certificate(ca_pem)
+        ca_data = ca_pem.decode().splitlines()
+        ca_ski = ca_cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value
+        pem = serialization.Encoding.PEM
+
+        def subject(name):
+            return x509.Name([x509.NameAttribute(NameOID.COUNTRY_NAME, self.country),
+                              x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, self.state),
+                              x509.NameAttribute(NameOID.ORGANIZATION_NAME, self.org),
+                              x509.NameAttribute(NameOID.COMMON_NAME, name),
+                              x509.NameAttribute(NameOID.EMAIL_ADDRESS, self.email)])
+
+        def make_key(name):
+            key = rsa.generate_private_key(public_exponent=65537, key_size=CLIENT_KEY_BITS)
+            csr = x509.CertificateSigningRequestBuilder().subject_name(subject(name)) \
+                .sign(key, hashes.SHA256())
+            return key, csr
+
+        def sign(name, key, serial, now):
+            # basic_exts in openssl.cnf
+            return x509.CertificateBuilder() \
+                .subject_name(subject(name)) \
+                .issuer_name(ca_cert.subject) \
+                .public_key(key.public_key()) \
+                .serial_number(serial) \
+                .not_valid_before(now) \
+                .not_valid_after(now + datetime.timedelta(days=CLIENT_DAYS)) \
+                .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False) \
+                .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False) \
+                .add_extension(x509.AuthorityKeyIdentifier(ca_ski.digest,
+                                                           [x509.DirectoryName(ca_cert.issuer)],
+                                                           ca_cert.serial_number), critical=False) \
+                .sign(ca_key, hashes.SHA256())
+
+        with ThreadPoolExecutor(workers) as pool:
+            keys = list(pool.map(make_key, names))
+
+        serial_file = os.path.join(self.base_path, 'serial')
+        with self.index_lock():
+            inventory = self.inventory()
+            with open(serial_file) as f:
+                serial = int(f.read().strip(), 16)
+            now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+            clients = []
+            for name, (key, csr) in zip(names, keys):
+                crt = sign(name, key, serial, now)
+                key_pem = key.private_bytes(pem, serialization.PrivateFormat.TraditionalOpenSSL,
+                                            serialization.NoEncryption())
+                crt_pem = crt.public_bytes(pem)
+                serial_hex = '{:02X}'.format(serial)
+                serial_hex = serial_hex.zfill(len(serial_hex) + len(serial_hex) % 2)
+                self.write_file(os.path.join(self.keys_path, '{}.key'.format(name)), key_pem, 0o600)
+                self.write_file(os.path.join(self.csr_path, '{}.csr'.format(name)), csr.public_bytes(pem))
+                self.write_file(os.path.join(self.crt_path, '{}.crt'.format(name)), crt_pem)
+                self.write_file(os.path.join(self.certs_path, '{}.pem'.format(serial_hex)), crt_pem)
+                inventory.add(CertInventory.parse_line('V\t{}\t\t{}\tunknown\t{}'.format(
+                    (now + datetime.timedelta(days=CLIENT_DAYS)).strftime(OPENSSL_TIME),
+                    serial_hex, self.get_client_subj(name))))
+                clients.append((name, key_pem.decode().splitlines(), crt_pem.decode().splitlines()))
+                serial += 1
+            next_serial = '{:02X}'.format(serial)
+            self.write_file(serial_file + '.new', (next_serial.zfill(len(next_serial) + len(next_serial) % 2) + '\n').encode())
+            self.write_index(inventory)
+            os.replace(serial_file + '.new', serial_file)
+
+        def write_ovpn(client):
+            name, key_data, crt_data = client
+            with open(os.path.join(out_dir, '{}.ovpn'.format(name)), 'w') as f:
+                f.write(self.render_ovpn(ca_data, key_data, crt_data))
+            return name
+
+        self.ovpn_template()
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(write_ovpn, clients))
+
+    @contextmanager
+    def index_lock(self):
+        """Serializes changes to index.txt and serial between wasy runs"""
+        with open(os.path.join(self.base_path, 'index.txt.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def inventory(self):
+        """CertInventory of index.txt, parsed again only when the file changed"""
+        index_file = os.path.join(self.base_path, 'index.txt')
+        st = os.stat(index_file)
+        stat = (st.st_mtime_ns, st.st_size)
+        cached = getattr(self, '_inventory', None)
+        if cached is None or cached.stat != stat:
+            with open(index_file) as f:
+                self._inventory = CertInventory(f, stat)
+        return self._inventory
+
+    def write_index(self, inventory):
+        index_file = os.path.join(self.base_path, 'index.txt')
+        self.write_file(index_file + '.new', ''.join(inventory.lines()).encode())
+        os.replace(index_file + '.new', index_file)
+        st = os.stat(index_file)
+        inventory.stat = (st.st_mtime_ns, st.st_size)
+
+    def archive_client(self, client_name, fdate):
+        """Zip the files of a revoked client into revoke/ and remove them"""
+        files = [os.path.join(self.crt_path, '{}.crt'.format(client_name)),
+                 os.path.join(self.csr_path, '{}.csr'.format(client_name)),
+                 os.path.join(self.keys_path, '{}.key'.format(client_name))]
+        with zipfile.ZipFile(os.path.join(self.revoke_path, '{}_{}.zip'.format(client_name, fdate)), mode='w') as zf:
+            for path in files:
+                if os.path.isfile(path):
+                    zf.write(path)
+                    os.remove(path)
+
+    def revoke_clients(self, client_names):
+        """Revoke many clients, index.txt written and the CRL signed once for the batch"""
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        fdate = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+        revoked = []
+        with self.index_lock():
+            inventory = self.inventory()
+            for name in client_names:
+                entry = inventory.valid(name)
+                if entry is None:
+                    print('{}: no valid certificate'.format(name))
+                    continue
+                inventory.revoke(entry, now)
+                revoked.append(name)
+            if not revoked:
+                return []
+            self.write_index(inventory)
+
+            with open(os.path.join(self.base_path, 'ca.key'), 'rb') as f:
+                ca_key = serialization.load_pem_private_key(f.read(), password=None)
+            with open(os.path.join(self.base_path, 'ca.crt'), 'rb') as f:
+                ca_cert = x509.load_pem_x509_certificate(f.read())
+            ca_ski = ca_cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value
+            # crl_ext in openssl.cnf
+            builder = x509.CertificateRevocationListBuilder() \
+                .issuer_name(ca_cert.subject) \
+                .last_update(now) \
+                .next_update(now + datetime.timedelta(days=CRL_DAYS)) \
+                .add_extension(x509.AuthorityKeyIdentifier(ca_ski.digest,
+                                                           [x509.DirectoryName(ca_cert.issuer)],
+                                                           ca_cert.serial_number), critical=False)
+            for entry in inventory.revoked():
+                builder = builder.add_revoked_certificate(
+                    x509.RevokedCertificateBuilder()
+                    .serial_number(int(entry['serial'], 16))
+                    .revocation_date(parse_openssl_time(entry['revoke']))
+                    .build())
+            crl = builder.sign(ca_key, hashes.SHA256())
+            self.write_file(os.path.join(self.base_path, 'ca.crl.new'),
+                            crl.public_bytes(serialization.Encoding.PEM))
+            os.replace(os.path.join(self.base_path, 'ca.crl.new'), os.path.join(self.base_path, 'ca.crl'))
+        for name in revoked:
+            self.archive_client(name, fdate)
+        return revoked
+
+    def write_file(self, path, data, mode=0o644):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
 
 
     def get_ta(self, b64=True):
@@ -309,15 +673,12 @@ class Wasy():
             return data
 
     def get_index_txt(self):
-        """V 270411233003Z  01 unknown /C=IS/ST=NA/O=AtHome/CN=vpn-server.mikkari.net/emailAddress=admin@mikkari.net"""
-        index = open(os.path.join(self.base_path, 'index.txt'), "r").read().splitlines()
         data = {}
         data['clients'] = []
-        for line in index:
-            s = line.split('\t')
+        for s in self.inventory().entries:
             data['clients'].append(
-                {'status': s[0], 'expire': self.date_format(s[1]), 'revoke': self.date_format(s[2]), 'serial': s[3],
-                 'filename': s[4], 'name': s[5]})
+                {'status': s['status'], 'expire': self.date_format(s['expire']), 'revoke': self.date_format(s['revoke']),
+                 'serial': s['serial'], 'filename': s['filename'], 'name': s['name']})
         return data
 
     def date_format(self, cd):
@@ -326,21 +687,92 @@ class Wasy():
         else:
             return "20{}-{}-{} {}:{}:{}".format(cd[0:2], cd[2:4], cd[4:6], cd[6:8], cd[8:10], cd[10:12])
 
-    def create(self):
-        self.make_config_dirs()
-        self.generate_ta()
-        self.make_ca_key_cert()
-        self.make_server_key_cert()
+    def create_init_client(self):
         self.create_cert_client('init-client')
-        self.revokce_cert_client('init-client')
-        self.make_crl()
-        self.gen_dh_parama()
+
+    def revoke_init_client(self):
+        # already revoked and archived when a run stopped right after it
+        if os.path.isfile(os.path.join(self.crt_path, 'init-client.crt')):
+            self.revokce_cert_client('init-client')
+
+    def create(self, ecdh=False, workers=4):
+        """Bootstrap the CA, independent steps run at the same time
+
+        Steps run on threads, each is an openssl or openvpn subprocess so the
+        GIL does not hold them back. Finished steps are recorded in
+        wasy-ca/bootstrap.json, written before the first step, after an
+        interruption the next run continues with the steps left, files a step
+        left half written are removed before it runs again.
+        """
+        state_file = os.path.join(self.base_path, 'bootstrap.json')
+        if os.path.isdir(self.base_path) and not os.path.isfile(state_file):
+            raise RuntimeError('{} exists, already configures.'.format(self.base_path))
+        done = {}
+        if os.path.isfile(state_file):
+            with open(state_file) as f:
+                done = json.load(f)
+        else:
+            # a wasy-ca without bootstrap.json is not ours to resume
+            os.makedirs(self.base_path, 0o770)
+            self.write_file(state_file, b'{}')
+        steps = {name: (needs, method, outputs) for name, needs, method, outputs in BOOTSTRAP_STEPS
+                 if not (ecdh and name == 'dh')}
+        timings = {}
+
+        def run(name):
+            needs, method, outputs = steps[name]
+            for output in outputs:
+                if name != 'dirs' and os.path.isfile(os.path.join(self.base_path, output)):
+                    os.remove(os.path.join(self.base_path, output))
+            start = time.perf_counter()
+            getattr(self, method)()
+            missing = [output for output in outputs if not os.path.isfile(os.path.join(self.base_path, output))]
+            if missing:
+                raise RuntimeError('step {} did not create {}'.format(name, ', '.join(missing)))
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        failed = None
+        running = {}
+        with ThreadPoolExecutor(workers) as pool:
+            while True:
+                if not failed:
+                    for name, (needs, _, _) in steps.items():
+                        if name not in done and name not in running.values() and all(n in done for n in needs):
+                            running[pool.submit(run, name)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        timings[name] = future.result()
+                    except Exception as e:
+                        failed = failed or (name, e)
+                        continue
+                    done[name] = round(timings[name], 3)
+                    self.write_file(state_file + '.new', json.dumps(done, indent=2).encode())
+                    os.replace(state_file + '.new', state_file)
+
+        for name in steps:
+            if name in timings:
+                print('{:<20}{:>8.2f}s'.format(name, timings[name]))
+            elif name in done:
+                print('{:<20}{:>9}'.format(name, 'resumed'))
+            else:
+                print('{:<20}{:>9}'.format(name, 'failed' if failed and failed[0] == name else 'not run'))
+        print('{:<20}{:>8.2f}s, {:.2f}s of steps'.format('total', time.perf_counter() - start, sum(timings.values())))
+        if failed:
+            raise RuntimeError('bootstrap step {} failed: {}, run generate-certs again to resume'.format(*failed))
 
     def get_server_config(self):
         ca = self.get_ca().decode()
         server = self.get_server_crt().decode()
         key = self.get_server_key().decode()
-        dh = self.get_dh().decode()
+        if os.path.isfile(os.path.join(self.base_path, 'dh2048.pem')):
+            dh = self.get_dh().decode()
+        else:
+            dh = 'none'  # generated with --ecdh, gen_server.sh configures ECDH
         crl = self.get_crl().decode()
         ta = self.get_ta().decode()
         print(f"ENV OVPN_CA {ca}")
@@ -362,7 +794,7 @@ def main():
 
     if args['generate-certs']:
         w = Wasy('./conf')
-        w.create()
+        w.create(ecdh=args['--ecdh'], workers=int(args['--workers']))
 
     if args['cleanup-certs']:
         w = Wasy('./conf')
@@ -379,6 +811,43 @@ def main():
         f.writelines(w.make_ovpn(name))
         f.close()
 
+    if args['create-client-configs']:
+        w = Wasy('./conf')
+        with open(args['--clients-file']) as f:
+            names = [line.split('#')[0].strip() for line in f]
+        os.makedirs(args['--out-dir'], exist_ok=True)
+        for name in w.create_clients([name for name in names if name],
+                                     args['--out-dir'], int(args['--workers'])):
+            print('{} created.'.format(name))
+
+    if args['revoke-clients']:
+        w = Wasy('./conf')
+        names = list(args['<name>'])
+        if args['--clients-file']:
+            with open(args['--clients-file']) as f:
+                names += [line.split('#')[0].strip() for line in f]
+        for name in w.revoke_clients([name for name in names if name]):
+            print('{} revoked..'.format(name))
+
+    if args['list-clients']:
+        w = Wasy('./conf')
+        inventory = w.inventory()
+        if args['--expiring']:
+            before = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=int(args['--expiring']))
+            entries = inventory.expiring(before)
+        elif args['--revoked']:
+            entries = inventory.revoked()
+        else:
+            entries = inventory.entries
+        for s in entries:
+            print('{}\t{}\t{:<19}\t{:<19}\t{}'.format(s['status'], s['serial'], w.date_format(s['expire']),
+                                                  w.date_format(s['revoke']), s['cn']))
+
+    if args['fill-dh-pool']:
+        w = Wasy('./conf')
+        made = w.fill_dh_pool(int(args['--size']), int(args['--workers']))
+        print('{} DH parameter files added to {}'.format(made, w.dh_pool))
+
     if args['get-client-config']:
         w = Wasy('./conf')
         name = args['--client']
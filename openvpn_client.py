@@ -0,0 +1,286 @@
+import json
+import os
+import secrets
+import sys
+import subprocess
+import tempfile
+import shutil
+import stat
+import functools
+import time
+from tracing import NullTracer, traced
+
+
+def run_in_new_window(code, hold=False):
+    if sys.platform == "darwin":
+        with tempfile.NamedTemporaryFile("w+t", delete=False) as start_new:
+            start_new.write('tell application "Terminal"\n')
+            start_new.write(f'    set w to do script "{code}"\n')
+            start_new.write(f"    activate\n")
+            if hold:
+                start_new.write("    repeat\n")
+                start_new.write("        delay 1\n")
+                start_new.write("        if not busy of w then exit repeat\n")
+                start_new.write("    end repeat\n")
+            start_new.write("end tell\n")
+            start_new.close()
+            proc = subprocess.Popen(
+                ["osascript", start_new.name],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+    elif sys.platform == "linux":
+        terminal = os.getenv("TERMINAL", shutil.which("xfce4-terminal"))
+        if not terminal:
+            print("You need to set the TERMINAL env ...")
+            print("tilix, gnome-terminal and xfce4-terminal are officially supported")
+            print("others might work")
+            sys.exit(1)
+        hold_args = []
+        terminal_args = []
+        if hold:
+            if os.path.basename(terminal) == "xfce4-terminal":
+                hold_args = ["--disable-server"]
+
+        if os.path.basename(terminal) == "tilix":
+            terminal_args = ["-a", "session-add-down"]
+
+        with tempfile.NamedTemporaryFile("w+t", delete=False) as start_new:
+            start_new.write(code)
+            start_new.close()
+            args = [
+                terminal,
+                *terminal_args,
+                *hold_args,
+                "-e",
+                "bash {}".format(start_new.name),
+            ]
+
+            proc = subprocess.Popen(
+                args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+    else:
+        print("Your platform: {} is not supported!!".format(sys.platfrom))
+        sys.exit(1)
+    if hold:
+        if proc.wait() != 0:
+            raise RuntimeError(proc.stderr.read().decode())
+
+
+def get_pid(pid_file):
+    """Pid from pid_file if that process is still alive"""
+    import psutil
+
+    if os.path.isfile(pid_file):
+        with open(pid_file, "r") as f:
+            pid = int(f.read().strip())
+        if psutil.pid_exists(pid):
+            return pid
+
+
+class OpenVpn:
+
+    def __init__(self, namespace, env, tracer=None):
+        self.namespace = namespace
+        self.env = env
+        self.tracer = tracer or NullTracer()
+        self.run = functools.partial(
+            subprocess.run,
+            env=env,
+            universal_newlines=True,
+            capture_output=True,
+            check=True,
+        )
+        self.conf_location = os.path.join(os.getcwd(), "config")
+        self.vpn_profile_fn = os.path.join(self.conf_location, "vpn-test.ovpn")
+        self.vpn_pid_file = os.path.join(self.conf_location, "vpn.pid")
+        self.vpn_log_file = os.path.join(self.conf_location, "openvpn.log")
+        self.vpn_updown_script = os.path.join(
+            self.conf_location,
+            f"update_resolv_conf.{sys.platform}.sh",
+        )
+        # management interface on localhost, password protected, read by vpn_telemetry
+        self.management_port = int(os.getenv("OPENVPN_MANAGEMENT_PORT", "7505"))
+        # host:port reachable through the tunnel, vpn_telemetry times TCP connects to it
+        self.rtt_target = os.getenv("OPENVPN_RTT_TARGET")
+        self.management_pw_file = os.path.join(self.conf_location, "openvpn-mgmt.pw")
+        self.collector_pid_file = os.path.join(self.conf_location, "vpn-collector.pid")
+        self.vpn_status_file = os.path.join(self.conf_location, "vpn-status.json")
+        self.vpn_metrics_file = os.path.join(self.conf_location, "vpn-status.prom")
+
+    def phase(self, name):
+        return self.tracer.span(name)
+
+    def management_password(self):
+        """Password of the management interface, made on first use, only readable by you"""
+        if not os.path.isfile(self.management_pw_file):
+            fd = os.open(self.management_pw_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(16) + "\n")
+        with open(self.management_pw_file) as f:
+            return f.readline().strip()
+
+    def start_collector(self):
+        """Background vpn-collector polling the management interface"""
+        pid = get_pid(self.collector_pid_file)
+        if pid:
+            return pid
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "swap_deployment.py")
+        proc = subprocess.Popen(
+            [sys.executable, script, "vpn-collector"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        with open(self.collector_pid_file, "w") as f:
+            f.write(str(proc.pid))
+        print(f"VPN status collector started, pid {proc.pid}, status in {self.vpn_status_file}")
+        return proc.pid
+
+    def collected_status(self, max_age=30):
+        """Last status written by a running collector, None without a collector.
+
+        The management interface takes one client at a time, a collector that
+        has not written for max_age seconds gives a COLLECTOR STALE state
+        rather than None, so callers do not connect next to it.
+        """
+        pid = get_pid(self.collector_pid_file)
+        if not pid:
+            return None
+        try:
+            with open(self.vpn_status_file) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            status = {}
+        if time.time() - status.get("time", 0) > max_age:
+            return {"time": status.get("time"), "state": "COLLECTOR STALE",
+                    "error": f"vpn-collector pid {pid} wrote no status for {max_age}s"}
+        return status
+
+    def wait_connected(self, timeout=60):
+        """Seconds until the daemon logged that the tunnel is up, None on timeout"""
+        start = time.time()
+        while time.time() - start < timeout:
+            try:
+                with open(self.vpn_log_file) as f:
+                    if "Initialization Sequence Completed" in f.read():
+                        return time.time() - start
+            except OSError:
+                pass
+            time.sleep(0.2)
+
+    def check_openvpn_installed(self):
+        with self.override_env():
+            if not shutil.which("openvpn"):
+                if sys.platform == "darwin":
+                    print("openvpn not installed. brew/apt/pacman install openvpn")
+                    print("Hint (for macs):")
+                    print("    # Run this")
+                    print("    brew install openvpn")
+                    print("    # Add this line to ~/.bash_profile")
+                    print("    export PATH=$(brew --prefix openvpn)/sbin:$PATH")
+                else:
+                    print("openvpn not installed. apt install openvpn")
+                    print("Hint (for linux):")
+                    print("    # Run this")
+                    print("    apt install openvpn openresolv")
+                    print("    openresolv is also needed!!!")
+                sys.exit(1)
+
+    @traced("vpn_start")
+    def run_vpn_if_needed(self, headless=False):
+        """Run vpn in new termianl window, or as a daemon logging to config/openvpn.log"""
+        vpn_pid = self.get_vpn_pid()
+        if vpn_pid:
+            print(f"VPN running, pid {vpn_pid}")
+            return
+        openvpn_path = shutil.which("openvpn")
+        if not openvpn_path:
+            raise RuntimeError("openvpn not found in path!")
+        args = [
+            openvpn_path, "--config", self.vpn_profile_fn,
+            "--up", self.vpn_updown_script, "--down", self.vpn_updown_script,
+            "--script-security", "3", "--writepid", self.vpn_pid_file,
+            "--management", "127.0.0.1", str(self.management_port), self.management_pw_file,
+        ]
+        self.management_password()
+        if headless:
+            print(f"Running openvpn in the background, logging to {self.vpn_log_file}")
+            subprocess.run(["sudo", *args, "--daemon", "--log", self.vpn_log_file], check=True)
+            if self.tracer.enabled:
+                # only traced runs wait, to measure the bring up
+                with self.phase("vpn_connect") as span:
+                    span["connected"] = self.wait_connected() is not None
+        else:
+            print("Running openvpn in new window.")
+            run_in_new_window("sudo {}\n".format(" ".join(args)))
+        self.start_collector()
+
+    def get_vpn_pid(self):
+        return get_pid(self.vpn_pid_file)
+
+    def kill_vpn(self):
+        vpn_pid = self.get_vpn_pid()
+        if vpn_pid:
+            print("Killing openvpn, will need elevated access...")
+            kill_path = shutil.which("kill")
+            subprocess.run(["sudo", kill_path, "-2", str(vpn_pid)])
+        self.reset_vpn()
+
+    def reset_vpn(self):
+        my_env = os.environ
+        my_env["script_type"] = "down"
+        my_env["dev"] = "none"
+        if sys.platform == "linux":
+            subprocess.run(["sudo", "cp", "/etc/resolv.conf.bak", "/etc/resolv.conf"])
+        else:
+            subprocess.run([self.vpn_updown_script], env=my_env)
+
+    def setup_sudoers(self):
+        proc = subprocess.run(
+            ["sudo", "-n", "-l"],
+            check=False,
+            capture_output=True,
+            universal_newlines=True,
+        )
+        required_commands = ["openvpn --config", "kill -2"]
+        if not all(part in proc.stdout for part in required_commands):
+            with tempfile.NamedTemporaryFile("w+t", delete=False) as sudo_config:
+                username = os.getenv("USER")
+                sudo_config.write(
+                    "Cmnd_Alias    OVPN =  {} --config *\n".format(
+                        shutil.which("openvpn")
+                    )
+                )
+                sudo_config.write(
+                    "Cmnd_Alias    KILL =  {} -2 *\n".format(shutil.which("kill"))
+                )
+                sudo_config.write(
+                    "Cmnd_Alias    NETFIX =  {} /etc/resolv.conf.bak /etc/resolv.conf\n".format(
+                        shutil.which("cp")
+                    )
+                )
+                if sys.platform == "darwin":
+                    target_sudo_file = f"/etc/sudoers.d/swapper-{username}"
+                    sudo_config.write(
+                        "%admin          ALL = (ALL) NOPASSWD:OVPN\n"
+                        "%admin          ALL = (ALL) NOPASSWD:KILL\n"
+                    )
+                else:
+                    target_sudo_file = f"/etc/sudoers.d/swapper-{username}"
+                    sudo_config.write(
+                        f"{username}          ALL = (ALL) NOPASSWD:OVPN\n"
+                        f"{username}          ALL = (ALL) NOPASSWD:KILL\n"
+                        f"{username}          ALL = (ALL) NOPASSWD:NETFIX\n"
+                    )
+                sudo_config.close()
+                print(
+                    f"Copying sudo config to {target_sudo_file}, will need elevated access"
+                )
+                os.chmod(sudo_config.name, stat.S_IRUSR | stat.S_IRGRP)
+                run_in_new_window(
+                    f"sudo cp {sudo_config.name} {target_sudo_file}", hold=True
+                )
+
+    def override_env(self):
+        return self.env
@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+import websocket
+from kubernetes.client.rest import ApiException
+
+PORTFORWARD_PROTOCOL = "v4.channel.k8s.io"
+
+
+class PortForwardStream:
+    """One pod port tunnelled over a portforward websocket.
+
+    Every channel pair carries one port: data on channel 0 and errors on
+    channel 1. The first frame on each channel is the port number.
+    """
+
+    def __init__(self, api_client, namespace, pod_name, remote_port):
+        self.remote_port = remote_port
+        self.ws = websocket.create_connection(
+            self._url(api_client.configuration, namespace, pod_name),
+            header=self._headers(api_client),
+            sslopt=self._sslopt(api_client.configuration),
+            subprotocols=[PORTFORWARD_PROTOCOL],
+            enable_multithread=True,
+        )
+        self.seen_port = set()
+
+    def _url(self, cfg, namespace, pod_name):
+        host = cfg.host.replace("https://", "wss://").replace("http://", "ws://")
+        return (f"{host}/api/v1/namespaces/{namespace}/pods/{pod_name}/portforward"
+                f"?ports={self.remote_port}")
+
+    def _headers(self, api_client):
+        headers = {}
+        api_client.update_params_for_auth(headers, [], ["BearerToken"])
+        return [f"{key}: {value}" for key, value in headers.items()]
+
+    def _sslopt(self, cfg):
+        if not cfg.verify_ssl:
+            return {"cert_reqs": ssl.CERT_NONE, "check_hostname": False}
+        sslopt = {"cert_reqs": ssl.CERT_REQUIRED, "ca_certs": cfg.ssl_ca_cert}
+        if cfg.cert_file:
+            sslopt["certfile"] = cfg.cert_file
+            sslopt["keyfile"] = cfg.key_file
+        if cfg.assert_hostname is False:
+            sslopt["check_hostname"] = False
+        return sslopt
+
+    def send(self, data):
+        self.ws.send_binary(b"\x00" + data)
+
+    def recv(self):
+        """Next chunk of data from the pod, b"" when the stream is closed"""
+        while True:
+            opcode, frame = self.ws.recv_data()
+            if opcode == websocket.ABNF.OPCODE_CLOSE or not frame:
+                return b""
+            channel, payload = frame[0], frame[1:]
+            if channel not in self.seen_port:
+                self.seen_port.add(channel)
+                payload = payload[2:]
+            if channel == 1 and payload:
+                raise RuntimeError(payload.decode(errors="replace"))
+            if channel == 0 and payload:
+                return payload
+
+    def close(self):
+        self.ws.close()
+
+
+class PortForwarder:
+    """Supervised local port forward to whatever pod currently matches labels"""
+
+    def __init__(self, swap, labels, local_port=1194, remote_port=1194,
+                 status_file=None, log_file=None, check_interval=5):
+        self.swap = swap
+        self.labels = labels
+        self.local_port = int(local_port)
+        self.remote_port = int(remote_port)
+        self.check_interval = check_interval
+        self.status_file = status_file
+        self.lock = threading.RLock()
+        self.last_pod = None
+        self.status = {
+            "state": "starting",
+            "pod": None,
+            "local_port": self.local_port,
+            "remote_port": self.remote_port,
+            "connections": 0,
+            "active_connections": 0,
+            "reconnects": 0,
+            "last_error": None,
+        }
+        self.log = logging.getLogger("port_forwarder")
+        if log_file:
+            handler = logging.FileHandler(log_file)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+            self.log.addHandler(handler)
+            self.log.setLevel(logging.INFO)
+
+    def update_status(self, **kwargs):
+        with self.lock:
+            self.status.update(kwargs)
+            self.status["updated"] = time.time()
+            if self.status_file:
+                tmp_file = f"{self.status_file}.tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump(self.status, f)
+                os.replace(tmp_file, self.status_file)
+
+    def count(self, key, delta=1):
+        with self.lock:
+            self.update_status(**{key: self.status[key] + delta})
+
+    def resolve_pod(self):
+        pod_name = self.swap.get_pod_name(self.labels)
+        if pod_name != self.last_pod:
+            self.log.info("Forwarding to pod %s", pod_name)
+            if self.last_pod:
+                self.count("reconnects")
+            self.last_pod = pod_name
+        self.update_status(pod=pod_name, state="forwarding")
+        return pod_name
+
+    def pod_is_running(self, pod_name):
+        try:
+            pod = self.swap._call(self.swap.api_inst.read_namespaced_pod,
+                                  pod_name, self.swap.namespace)
+        except ApiException:
+            return False
+        return pod.status.phase == "Running" and not pod.metadata.deletion_timestamp
+
+    def open_stream(self, retries=5):
+        delay = 0.5
+        with self.swap.tracer.span("port_forward_open", deployment=self.swap.deployment_name) as span:
+            for attempt in range(retries):
+                span["retries"] = attempt
+                pod_name = self.status["pod"]
+                try:
+                    pod_name = pod_name or self.resolve_pod()
+                    return PortForwardStream(self.swap.session.api_client, self.swap.namespace,
+                                             pod_name, self.remote_port)
+                except Exception as e:
+                    self.log.warning("Port forward to %s failed: %s", pod_name, e)
+                    self.update_status(pod=None, state="reconnecting", last_error=str(e))
+                    time.sleep(delay)
+                    delay = min(delay * 2, 10)
+            raise RuntimeError(f"Giving up after {retries} attempts: {self.status['last_error']}")
+
+    def supervise(self):
+        """Re-resolve the pod when the one we forward to goes away"""
+        while True:
+            time.sleep(self.check_interval)
+            pod_name = self.status["pod"]
+            try:
+                if not pod_name or not self.pod_is_running(pod_name):
+                    self.log.info("Pod %s is gone, re-resolving", pod_name)
+                    self.update_status(pod=None, state="reconnecting")
+                    self.resolve_pod()
+            except Exception as e:
+                self.log.warning("Could not resolve a pod: %s", e)
+                self.update_status(state="waiting for pod", last_error=str(e))
+
+    def handle(self, conn):
+        try:
+            stream = self.open_stream()
+        except Exception as e:
+            self.log.error("Dropping connection: %s", e)
+            self.update_status(state="waiting for pod", last_error=str(e))
+            conn.close()
+            return
+        self.count("connections")
+        self.count("active_connections")
+
+        def pod_to_local():
+            try:
+                while True:
+                    data = stream.recv()
+                    if not data:
+                        break
+                    conn.sendall(data)
+            except Exception as e:
+                self.log.warning("Stream from pod closed: %s", e)
+            finally:
+                conn.close()
+
+        reader = threading.Thread(target=pod_to_local, daemon=True)
+        reader.start()
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                stream.send(data)
+        except OSError:
+            pass
+        finally:
+            stream.close()
+            reader.join()
+            self.count("active_connections", -1)
+
+    def run(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("127.0.0.1", self.local_port))
+        listener.listen(16)
+        try:
+            self.resolve_pod()
+        except Exception as e:
+            # right after swap the pod is often not ready yet, supervise keeps trying
+            self.log.warning("Could not resolve a pod: %s", e)
+            self.update_status(state="waiting for pod", last_error=str(e))
+        self.log.info("Listening on 127.0.0.1:%s", self.local_port)
+        threading.Thread(target=self.supervise, daemon=True).start()
+        while True:
+            conn, _ = listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
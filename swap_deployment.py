@@ -3,79 +3,375 @@
 """Deployment Swap tool
 
 Usage:
-  swap_deployment.py swap --deployment=<deployment> [--destination=<remote_host>] [--http_port=<remote_http_port>] [--grpc_port=<remote_grpc_port>] [--disable_readiness] [--no_sidecar]
-  swap_deployment.py swap-off --deployment=<deployment>
-  swap_deployment.py vpn --deployment=<deployment>
+  swap_deployment.py swap (--deployment=<deployment> | --selector=<selector>) [--destination=<remote_host>] [--http_port=<remote_http_port>] [--grpc_port=<remote_grpc_port>] [--disable_readiness] [--no_sidecar] [--workers=<workers>] [--api_budget=<calls>] [--wait] [--timeout=<seconds>] [--weight=<percent> | --mirror [--mirror_sample=<percent>] [--mirror_body=<size>]] [--profile=<profile>] [--ports=<ports>] [--transport=<transport>] [--ephemeral_pki] [--trace=<file>] [--metrics=<file>]
+  swap_deployment.py swap-off (--deployment=<deployment> | --selector=<selector>) [--workers=<workers>] [--api_budget=<calls>] [--wait] [--timeout=<seconds>] [--trace=<file>] [--metrics=<file>]
+  swap_deployment.py vpn --deployment=<deployment> [--headless] [--trace=<file>] [--metrics=<file>]
+  swap_deployment.py render [<file>...] [--namespace=<namespace>] [--destination=<remote_host>] [--http_port=<remote_http_port>] [--grpc_port=<remote_grpc_port>] [--disable_readiness] [--no_sidecar] [--profile=<profile>] [--ports=<ports>] [--transport=<transport>] [--owner=<owner>]
+  swap_deployment.py status [--namespace=<namespace>] [--json]
+  swap_deployment.py vpn-status [--json]
+  swap_deployment.py vpn-collector [--interval=<seconds>]
+  swap_deployment.py port-forward --deployment=<deployment> [--local_port=<local_port>]
+  swap_deployment.py tunnel --deployment=<deployment> [--target=<host>]
   swap_deployment.py get-swap-env --deployment=<deployment> [--export]
-  swap_deployment.py get-env --deployment=<deployment> [--export]
+  swap_deployment.py get-env (--deployment=<deployment> | --selector=<selector>) [--export] [--workers=<workers>] [--exec] [--env_file=<env_file>] [--ttl=<ttl>] [--trace=<file>] [--metrics=<file>]
+  swap_deployment.py cache-daemon
   swap_deployment.py setup-sudoers
   swap_deployment.py reset-vpn
   swap_deployment.py (-h | --help)
 
 Options:
-  -h --help     Show this screen.
+  -h --help                  Show this screen.
+  --deployment=<deployment>  Deployment name, or a comma separated list of names.
+  --selector=<selector>      Label selector for the deployments to act on.
+  --workers=<workers>        Deployments handled concurrently [default: 4].
+  --api_budget=<calls>       Stop a deployment before it makes more API requests than this.
+  --wait                     Drain the outgoing deployment only once the incoming pods serve.
+  --timeout=<seconds>        Seconds --wait waits for the incoming pods to serve [default: 300].
+  --weight=<percent>         Send only this percent of the traffic to the swap.
+  --mirror                   Keep the original serving, send copies of requests to the swap.
+  --mirror_sample=<percent>  Percent of the requests the swap pod sees that are copied [default: 100].
+  --mirror_body=<size>       Copy only requests with bodies up to this size, bytes, k or m [default: 64k].
+  --profile=<profile>        nginx proxy profile: latency, throughput or streaming [default: latency].
+  --ports=<ports>            Raw TCP/UDP ports passed through, port[:remote_port][/udp],... or all.
+  --transport=<transport>    How traffic reaches you: openvpn or tunnel [default: openvpn].
+  --ephemeral_pki            New openvpn credentials for this swap, in a Secret and config/pki-<deployment>.ovpn.
+  --trace=<file>             Write timed spans of every phase and API request as JSON lines, - for stderr.
+  --metrics=<file>           Write the span timings as a Prometheus textfile.
+  --headless                 Supervised port forward and openvpn in the background, no terminals.
+  --namespace=<namespace>    status: only the swaps of this namespace, all by default. render: namespace of the swap objects.
+  --owner=<owner>            render: owner annotation of the swaps, none by default.
+  --json                     Print the status as json.
+  --interval=<seconds>       Seconds between polls of the openvpn management interface [default: 5].
+  --local_port=<local_port>  Local port for the openvpn port forward [default: 1194].
+  --target=<host>            Where tunnelled connections go [default: 127.0.0.1].
+  --exec                     Read the environment with exec in a running pod.
+  --env_file=<env_file>      Also write the environment of every container to .env files.
+  --ttl=<ttl>                Seconds a resolved environment is cached [default: 60].
 """
 
 from docopt import docopt
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
 import os
+import time
+from tracing import NullTracer, Tracer
 
 sys.path.append(os.path.abspath(__file__))
-from deployment_swapper import SwapDeployment
+
+
+def get_deployment_names(args, session):
+    from deployment_swapper import SwapDeployment
+
+    if args['--deployment']:
+        return [name.strip() for name in args['--deployment'].split(',') if name.strip()]
+    swap = SwapDeployment("dummy", None, None, None, session=session)
+    return swap.list_deployments(args['--selector'])
+
+
+def format_age(seconds):
+    if seconds is None:
+        return "-"
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+
+def print_swaps(swaps):
+    rows = [("NAMESPACE", "DEPLOYMENT", "OWNER", "MODE", "TRANSPORT", "TARGET", "AGE", "READY",
+             "TUNNEL")]
+    for swap in swaps:
+        mode = f"mirror {swap['mirror']}" if swap.get("mirror") else "swap"
+        rows.append((swap["namespace"], swap["deployment"], swap["owner"] or "-", mode,
+                     swap["transport"] or "-", swap["target"] or "-", format_age(swap["age"]),
+                     f"{swap['ready_replicas']}/{swap['replicas']}", swap["tunnel"] or "-"))
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print("   ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+def read_manifests(files):
+    """Manifests from yaml or json files, - for stdin, one document at a time"""
+    import yaml
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    for name in files or ["-"]:
+        stream = sys.stdin if name == "-" else open(name)
+        try:
+            for manifest in yaml.load_all(stream, Loader=loader):
+                if not manifest:
+                    continue
+                if manifest.get("kind", "").endswith("List"):
+                    yield from manifest.get("items") or []
+                else:
+                    yield manifest
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+
+def run_concurrently(deployments, pipeline, workers, tracer):
+    """Run pipeline(deployment) for every deployment, at most workers at a time"""
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for name in deployments:
+            futures[executor.submit(timed, pipeline, name, tracer)] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except (Exception, SystemExit) as e:
+                results[name] = ("failed", e, None)
+    return results
+
+
+def timed(pipeline, name, tracer):
+    start = time.time()
+    with tracer.span(pipeline.__name__, deployment=name):
+        output = pipeline(name)
+    return "ok", output, time.time() - start
+
+
+def print_summary(deployments, results):
+    for name in deployments:
+        status, output, elapsed = results[name]
+        if status == "ok" and isinstance(output, int):
+            print(f"{name}: ok ({elapsed:.1f}s, {output} api calls)", file=sys.stderr)
+        elif status == "ok":
+            print(f"{name}: ok ({elapsed:.1f}s)", file=sys.stderr)
+        elif isinstance(output, SystemExit):
+            print(f"{name}: failed", file=sys.stderr)
+        else:
+            print(f"{name}: failed ({output})", file=sys.stderr)
+
+
+def write_trace(args, tracer):
+    if args['--trace']:
+        tracer.write_json(args['--trace'])
+    if args['--metrics']:
+        command = next(name for name in ('swap', 'swap-off', 'vpn', 'get-env') if args[name])
+        tracer.write_prometheus(args['--metrics'], command)
 
 
 def main():
     args = docopt(__doc__)
+    workers = int(args['--workers'] or 1)
+    tracer = Tracer() if args['--trace'] or args['--metrics'] else NullTracer()
+
     if args['swap']:
-        deployment = args['--deployment']
+        from deployment_swapper import SwapDeployment, KubeSession
+
         remote_host = args['--destination']
         http_port = args['--http_port']
         grpc_port = args['--grpc_port']
         readiness = args['--disable_readiness']
         sidecar =  args['--no_sidecar']
-        swap = SwapDeployment(deployment, remote_host, http_port, grpc_port)
-        swap.create_configmap(swap.create_configmaps_objects())
-        new_deployment, curr_deployment = swap.generate_deployment_swap(
-            disable_readiness=readiness,
-            skip_openvpn_sidecar=sidecar
-        )
-        swap.create_deployment(new_deployment)
-        swap.scale_deployment(curr_deployment, replicas=0)
+        session = KubeSession(pool_size=workers, tracer=tracer)
+
+        def swap_pipeline(deployment):
+            swap = SwapDeployment(deployment, remote_host, http_port, grpc_port,
+                                  session=session, proxy_profile=args['--profile'],
+                                  transport=args['--transport'],
+                                  ephemeral_pki=args['--ephemeral_pki'],
+                                  weight=args['--weight'],
+                                  mirror=args['--mirror'],
+                                  mirror_sample=args['--mirror_sample'],
+                                  mirror_body=args['--mirror_body'],
+                                  api_budget=args['--api_budget'])
+            new_deployment, curr_deployment = swap.generate_deployment_swap(
+                disable_readiness=readiness,
+                skip_openvpn_sidecar=sidecar,
+                stream_ports=args['--ports']
+            )
+            keep_replicas = 0
+            if args['--weight']:
+                keep_replicas = swap.apply_weight(new_deployment, curr_deployment)
+            elif args['--mirror']:
+                keep_replicas = swap.apply_mirror(new_deployment, curr_deployment)
+            writes = swap.apply_swap(new_deployment, curr_deployment)
+            if writes and args['--wait']:
+                swap.handover(new_deployment["metadata"]["name"], timeout=int(args['--timeout']))
+            swap.pause_original(curr_deployment, replicas=keep_replicas,
+                                pause_hpa=not args['--mirror'])
+            return swap.api_calls
+
+        deployments = get_deployment_names(args, session)
+        print_summary(deployments, run_concurrently(deployments, swap_pipeline, workers, tracer))
 
     if args['swap-off']:
-        deployment = args['--deployment']
-        swap = SwapDeployment(deployment, None, None, None)
-        swap_deployment, curr_deployment = swap.get_swap_deployment()
-        swap.scale_deployment(curr_deployment, replicas=1)
-        swap.delete_deployment(swap_deployment)
+        from deployment_swapper import SwapDeployment, KubeSession
+
+        session = KubeSession(pool_size=workers, tracer=tracer)
+
+        def swap_off_pipeline(deployment):
+            swap = SwapDeployment(deployment, None, None, None, session=session,
+                                  api_budget=args['--api_budget'])
+            swap.restore_original(timeout=int(args['--timeout']), wait=args['--wait'])
+            swap.delete_deployment("{}-swap".format(deployment))
+            # the pki Secret is owned by the swap deployment and goes with it
+            swap.remove_pki_profile()
+            return swap.api_calls
+
+        deployments = get_deployment_names(args, session)
+        print_summary(deployments, run_concurrently(deployments, swap_off_pipeline, workers, tracer))
 
     if args['vpn']:
+        from deployment_swapper import SwapDeployment, KubeSession
+
         deployment = args['--deployment']
-        swap = SwapDeployment(deployment, None, None, None)
-        swap_deployment, curr_deployment = swap.get_swap_deployment()
-        swap.portforward_openvpn(swap_deployment)
+        swap = SwapDeployment(deployment, None, None, None, session=KubeSession(tracer=tracer))
+        swap_deployment = swap.get_deployment("{}-swap".format(deployment))
+        if args['--headless']:
+            swap.portforward_openvpn_headless(swap_deployment)
+        else:
+            swap.portforward_openvpn(swap_deployment)
+
+    if args['render']:
+        import yaml
+        from deployment_swapper import SwapDeployment, OfflineSession
+
+        dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+        api_client = None
+        rendered, skipped, failed = 0, 0, 0
+        for manifest in read_manifests(args['<file>']):
+            if manifest.get("kind") != "Deployment":
+                skipped += 1
+                continue
+            name = manifest["metadata"]["name"]
+            session = OfflineSession(
+                args['--namespace'] or manifest["metadata"].get("namespace"), api_client,
+                owner=args['--owner'])
+            api_client = session.api_client
+            try:
+                swap = SwapDeployment(name, args['--destination'], args['--http_port'],
+                                      args['--grpc_port'], session=session,
+                                      proxy_profile=args['--profile'],
+                                      transport=args['--transport'])
+                objects = swap.render(manifest,
+                                      disable_readiness=args['--disable_readiness'],
+                                      skip_openvpn_sidecar=args['--no_sidecar'],
+                                      stream_ports=args['--ports'])
+            except (ValueError, KeyError) as e:
+                failed += 1
+                print(f"{name}: failed ({e})", file=sys.stderr)
+                continue
+            for obj in objects:
+                sys.stdout.write("---\n")
+                yaml.dump(obj, sys.stdout, Dumper=dumper, sort_keys=False)
+            rendered += 1
+        print(f"Rendered {rendered} swaps, skipped {skipped} other objects, {failed} failed",
+              file=sys.stderr)
+        sys.exit(1 if failed else 0)
+
+    if args['status']:
+        import json
+        from deployment_swapper import SwapDeployment
+
+        swap = SwapDeployment("dummy", None, None, None)
+        swaps = swap.list_swaps(namespace=args['--namespace'])
+        if args['--json']:
+            print(json.dumps(swaps, indent=2))
+        elif not swaps:
+            print("No active swaps")
+        else:
+            print_swaps(swaps)
+
+    if args['vpn-status']:
+        import json
+        from openvpn_client import OpenVpn
+        from vpn_telemetry import VpnCollector, format_status
+
+        openvpn = OpenVpn(None, os.environ)
+        status = openvpn.collected_status()
+        if status is None:
+            # no collector running, two samples a second apart for the rates
+            collector = VpnCollector(openvpn)
+            collector.sample()
+            time.sleep(1)
+            status = collector.sample()
+        print(json.dumps(status, indent=2) if args['--json'] else format_status(status))
+
+    if args['vpn-collector']:
+        from openvpn_client import OpenVpn
+        from vpn_telemetry import VpnCollector
+
+        openvpn = OpenVpn(None, os.environ)
+        VpnCollector(openvpn).run(interval=float(args['--interval']),
+                                  json_file=openvpn.vpn_status_file,
+                                  metrics_file=openvpn.vpn_metrics_file)
+
+    if args['port-forward']:
+        from deployment_swapper import SwapDeployment
+
+        swap = SwapDeployment(args['--deployment'], None, None, None)
+        swap_deployment = swap.get_deployment("{}-swap".format(args['--deployment']))
+        swap.run_port_forwarder(swap_deployment, local_port=args['--local_port'])
+
+    if args['tunnel']:
+        from deployment_swapper import SwapDeployment
+
+        swap = SwapDeployment(args['--deployment'], None, None, None)
+        swap_deployment = swap.get_deployment("{}-swap".format(args['--deployment']))
+        swap.run_tunnel_client(swap_deployment, target_host=args['--target'])
 
     if args['get-env']:
-        deployment = args['--deployment']
+        from deployment_swapper import SwapDeployment, KubeSession
+
         export = args['--export']
-        swap = SwapDeployment(deployment, None, None, None)
-        run_deployment = swap.get_deployment("{}".format(deployment))
-        swap.get_env_values(run_deployment, export)
+        session = KubeSession(pool_size=workers, tracer=tracer)
+
+        def get_env_pipeline(deployment):
+            swap = SwapDeployment(deployment, None, None, None, session=session)
+            run_deployment = swap.get_deployment("{}".format(deployment))
+            if args['--exec']:
+                return swap.get_env_values(run_deployment, export)
+            env_file = args['--env_file']
+            if env_file and len(deployments) > 1:
+                env_file = f"{env_file}.{deployment}"
+            return swap.resolve_env_values(run_deployment, export, ttl=args['--ttl'],
+                                           env_file=env_file)
+
+        deployments = get_deployment_names(args, session)
+        results = run_concurrently(deployments, get_env_pipeline, workers, tracer)
+        for name in deployments:
+            status, output, elapsed = results[name]
+            if status == "ok" and output:
+                if len(deployments) > 1:
+                    print(f"# {name}")
+                print(output)
+        if len(deployments) > 1:
+            print_summary(deployments, results)
 
     if args['get-swap-env']:
+        from deployment_swapper import SwapDeployment
+
         deployment = args['--deployment']
         export = args['--export']
         swap = SwapDeployment(deployment, None, None, None)
-        swap_deployment, run_deployment = swap.get_swap_deployment()
-        swap.get_env_values(swap_deployment, export)
+        swap_deployment = swap.get_deployment("{}-swap".format(deployment))
+        output = swap.get_env_values(swap_deployment, export)
+        if output:
+            print(output)
+
+    if args['cache-daemon']:
+        from deployment_swapper import KubeSession
+        from informer_cache import run_daemon
+
+        run_daemon(KubeSession())
+
+    if tracer.enabled:
+        write_trace(args, tracer)
 
     if args['setup-sudoers']:
-        swap = SwapDeployment("dummy", None, None, None)
-        swap.setup_sudoers()
+        from openvpn_client import OpenVpn
+
+        OpenVpn(None, os.environ).setup_sudoers()
 
     if args['reset-vpn']:
-        swap = SwapDeployment("dummy", None, None, None)
-        swap.reset_vpn()
+        from openvpn_client import OpenVpn
+
+        OpenVpn(None, os.environ).reset_vpn()
 
 
 if __name__ == '__main__':
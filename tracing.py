@@ -0,0 +1,137 @@
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def traced(name):
+    """Run the method in a span named name, the object provides phase(name)"""
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Tracer:
+    """Timed spans for API calls and swap phases, thread safe.
+
+    A span opened while another one is open on the same thread records it
+    as its parent. Spans are written as JSON lines and summed up per name in
+    the Prometheus text format.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = self.local.__dict__.setdefault("stack", [])
+        record = {
+            "id": next(self.ids),
+            "parent": stack[-1]["id"] if stack else None,
+            "name": name,
+            "start": time.time(),
+            "duration": None,
+            "status": None,
+        }
+        record.update(attributes)
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["status"] = getattr(e, "status", None) or record["status"]
+            record["error"] = "{}: {}".format(type(e).__name__, e).strip()
+            raise
+        finally:
+            record["duration"] = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                self.spans.append(record)
+
+    def add(self, name, start, duration, **attributes):
+        """Span measured somewhere else, pod condition timestamps for one"""
+        stack = self.local.__dict__.setdefault("stack", [])
+        record = {
+            "id": next(self.ids),
+            "parent": stack[-1]["id"] if stack else None,
+            "name": name,
+            "start": start,
+            "duration": duration,
+            "status": None,
+        }
+        record.update(attributes)
+        with self.lock:
+            self.spans.append(record)
+
+    def write_json(self, path):
+        """One span per line, - for stderr"""
+        with self.lock:
+            lines = [json.dumps(span, default=str) for span in self.spans]
+        if path == "-":
+            print("\n".join(lines), file=sys.stderr)
+            return
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def write_prometheus(self, path, command):
+        """Textfile for the node exporter, replaced atomically"""
+        totals = {}
+        statuses = {}
+        with self.lock:
+            for span in self.spans:
+                key = (span["name"], span.get("kind", "phase"))
+                seconds, count = totals.get(key, (0.0, 0))
+                totals[key] = (seconds + span["duration"], count + 1)
+                if span.get("kind") == "api":
+                    status = str(span["status"] or ("error" if "error" in span else ""))
+                    statuses[status] = statuses.get(status, 0) + 1
+        lines = [
+            "# HELP deployment_swapper_span_seconds Time spent per phase and API call.",
+            "# TYPE deployment_swapper_span_seconds summary",
+        ]
+        for (name, kind), (seconds, count) in sorted(totals.items()):
+            labels = f'command="{command}",span="{name}",kind="{kind}"'
+            lines.append(f"deployment_swapper_span_seconds_sum{{{labels}}} {seconds:.6f}")
+            lines.append(f"deployment_swapper_span_seconds_count{{{labels}}} {count}")
+        lines += [
+            "# HELP deployment_swapper_api_requests Kubernetes API requests by HTTP status.",
+            "# TYPE deployment_swapper_api_requests gauge",
+        ]
+        for status, count in sorted(statuses.items()):
+            lines.append(
+                f'deployment_swapper_api_requests{{command="{command}",status="{status}"}} {count}')
+        lines += [
+            "# HELP deployment_swapper_last_run_timestamp_seconds When the command finished.",
+            "# TYPE deployment_swapper_last_run_timestamp_seconds gauge",
+            f'deployment_swapper_last_run_timestamp_seconds{{command="{command}"}} {time.time():.0f}',
+        ]
+        with open(f"{path}.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+
+class NullTracer(Tracer):
+    """Tracer that keeps nothing, the default"""
+
+    enabled = False
+
+    @contextmanager
+    def span(self, name, **attributes):
+        yield {}
+
+    def add(self, name, start, duration, **attributes):
+        pass
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Reverse tunnel for a swap without openvpn
+
+Runs in the swap pod as a sidecar, stdlib only, shipped in the swap configmap.
+nginx sends the swapped traffic to ports the agent listens on, every
+connection is multiplexed over the one connection the local client keeps open
+through a port forward, and the client connects it to the local service.
+
+  TUNNEL_PORT   port the local client connects to [default: 7000]
+  TUNNEL_PORTS  listen_port:local_port,... the agent listens on listen_port,
+                the client connects to local_port on the developer machine
+"""
+import asyncio
+import os
+import struct
+
+OPEN, DATA, CLOSE, PING, WINDOW = 1, 2, 3, 4, 5
+# frame type, stream id, payload length
+HEADER = struct.Struct(">BII")
+PORT = struct.Struct(">H")
+CREDIT = struct.Struct(">I")
+CHUNK = 65536
+# bytes a side sends on one stream before the other side confirms it wrote
+# them out, a connection that stops reading holds up its own stream only
+STREAM_WINDOW = 4 * CHUNK
+
+
+class Stream:
+    """One tunnelled connection, its queued payloads and the send credit left"""
+
+    def __init__(self):
+        self.writer = None
+        self.queue = asyncio.Queue()
+        self.credit = STREAM_WINDOW
+        self.credit_changed = asyncio.Event()
+
+    def end(self):
+        self.queue.put_nowait(None)
+        self.credit_changed.set()
+
+
+class Mux:
+    """Many TCP connections over one, each frame tagged with its stream id"""
+
+    def __init__(self, reader, writer, on_open=None):
+        self.reader = reader
+        self.writer = writer
+        self.on_open = on_open
+        self.streams = {}
+        self.next_id = 1
+        self.drain_lock = asyncio.Lock()
+
+    async def send(self, kind, stream_id, payload=b""):
+        self.writer.write(HEADER.pack(kind, stream_id, len(payload)) + payload)
+        async with self.drain_lock:
+            await self.writer.drain()
+
+    async def close_stream(self, stream_id):
+        """End the stream here and tell the other side, once"""
+        stream = self.streams.pop(stream_id, None)
+        if stream:
+            stream.end()
+            try:
+                await self.send(CLOSE, stream_id)
+            except ConnectionError:
+                pass
+
+    async def open(self, local_port, reader, writer):
+        """Carry a connection accepted here to local_port on the other side"""
+        stream_id = self.next_id
+        self.next_id += 1
+        stream = self.streams[stream_id] = Stream()
+        try:
+            await self.send(OPEN, stream_id, PORT.pack(local_port))
+        except ConnectionError:
+            self.streams.pop(stream_id, None)
+            writer.close()
+            return
+        await self.connect(stream_id, stream, reader, writer)
+
+    async def accept(self, stream_id, stream, local_port):
+        """OPEN from the other side, on_open makes the connection, in a task of its own"""
+        connection = await self.on_open(local_port)
+        if connection is None:
+            await self.close_stream(stream_id)
+        elif stream_id not in self.streams:
+            connection[1].close()
+        else:
+            await self.connect(stream_id, stream, *connection)
+
+    async def connect(self, stream_id, stream, reader, writer):
+        stream.writer = writer
+        asyncio.ensure_future(self.write_out(stream_id, stream))
+        await self.pump(stream_id, stream, reader)
+
+    async def write_out(self, stream_id, stream):
+        """Queued payloads to the connection, the credit goes back once they are written"""
+        try:
+            while True:
+                data = await stream.queue.get()
+                if data is None:
+                    break
+                stream.writer.write(data)
+                await stream.writer.drain()
+                if stream_id in self.streams:
+                    await self.send(WINDOW, stream_id, CREDIT.pack(len(data)))
+        except ConnectionError:
+            await self.close_stream(stream_id)
+        finally:
+            stream.writer.close()
+
+    async def pump(self, stream_id, stream, reader):
+        """Connection to frames until it closes on either side"""
+        try:
+            while stream_id in self.streams:
+                data = await reader.read(CHUNK)
+                if not data:
+                    break
+                while stream.credit < len(data) and stream_id in self.streams:
+                    stream.credit_changed.clear()
+                    await stream.credit_changed.wait()
+                if stream_id not in self.streams:
+                    break
+                stream.credit -= len(data)
+                await self.send(DATA, stream_id, data)
+        except ConnectionError:
+            pass
+        finally:
+            await self.close_stream(stream_id)
+
+    async def run(self):
+        """Frames to the stream queues until the tunnel drops, never waits on a stream"""
+        try:
+            while True:
+                kind, stream_id, length = HEADER.unpack(
+                    await self.reader.readexactly(HEADER.size))
+                payload = await self.reader.readexactly(length)
+                if kind == OPEN and self.on_open:
+                    stream = self.streams[stream_id] = Stream()
+                    asyncio.ensure_future(
+                        self.accept(stream_id, stream, PORT.unpack(payload)[0]))
+                    continue
+                stream = self.streams.get(stream_id)
+                if not stream:
+                    continue
+                if kind == DATA:
+                    stream.queue.put_nowait(payload)
+                elif kind == WINDOW:
+                    stream.credit += CREDIT.unpack(payload)[0]
+                    stream.credit_changed.set()
+                elif kind == CLOSE:
+                    del self.streams[stream_id]
+                    stream.end()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for stream in self.streams.values():
+                stream.end()
+            self.streams.clear()
+            self.writer.close()
+
+    async def keepalive(self, interval=30):
+        while True:
+            await asyncio.sleep(interval)
+            await self.send(PING, 0)
+
+
+def parse_ports(value):
+    """{listen_port: local_port} from listen_port:local_port,..."""
+    ports = {}
+    for mapping in value.split(","):
+        if mapping.strip():
+            listen, local = mapping.split(":")
+            ports[int(listen)] = int(local)
+    return ports
+
+
+class Agent:
+    """Pod side, one local client at a time, a new one replaces the old"""
+
+    def __init__(self, tunnel_port, ports):
+        self.tunnel_port = tunnel_port
+        self.ports = ports
+        self.mux = None
+
+    async def handle_client(self, reader, writer):
+        if self.mux:
+            self.mux.writer.close()
+        mux = self.mux = Mux(reader, writer)
+        print("client connected", flush=True)
+        await mux.run()
+        if self.mux is mux:
+            self.mux = None
+        print("client disconnected", flush=True)
+
+    def handle_local(self, local_port):
+        async def handle(reader, writer):
+            if not self.mux:
+                writer.close()
+                return
+            await self.mux.open(local_port, reader, writer)
+        return handle
+
+    async def serve(self):
+        # only reachable through the port forward, not from the cluster
+        await asyncio.start_server(self.handle_client, "127.0.0.1", self.tunnel_port)
+        for listen, local in self.ports.items():
+            await asyncio.start_server(self.handle_local(local), "127.0.0.1", listen)
+        print("tunnel on {}, ports {}".format(self.tunnel_port, self.ports), flush=True)
+        while True:
+            await asyncio.sleep(3600)
+
+
+async def run_client(tunnel_host, tunnel_port, target_host="127.0.0.1", retry=1):
+    """Developer side, connects the tunnelled streams to target_host, reconnects forever"""
+
+    async def on_open(local_port):
+        try:
+            return await asyncio.open_connection(target_host, local_port)
+        except OSError as e:
+            print("connect to {}:{} failed: {}".format(target_host, local_port, e), flush=True)
+            return None
+
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(tunnel_host, tunnel_port)
+        except OSError as e:
+            print("tunnel not reachable: {}".format(e), flush=True)
+            await asyncio.sleep(retry)
+            continue
+        mux = Mux(reader, writer, on_open=on_open)
+        print("tunnel connected", flush=True)
+        keepalive = asyncio.ensure_future(mux.keepalive())
+        await mux.run()
+        keepalive.cancel()
+        print("tunnel closed, reconnecting", flush=True)
+        await asyncio.sleep(retry)
+
+
+if __name__ == "__main__":
+    agent = Agent(int(os.getenv("TUNNEL_PORT", "7000")),
+                  parse_ports(os.getenv("TUNNEL_PORTS", "")))
+    asyncio.run(agent.serve())
@@ -0,0 +1,283 @@
+"""Tunnel health from the openvpn management interface
+
+The openvpn client is started with its management interface on 127.0.0.1,
+password protected. The collector polls it for the connection state, the byte
+counters and the state history, measures the round trip through the tunnel by
+connecting to OPENVPN_RTT_TARGET when it is set, and writes what it saw as JSON
+and as a Prometheus textfile.
+"""
+import json
+import os
+import socket
+import statistics
+import time
+
+RTT_SAMPLES = 60
+
+
+class Management:
+    """Line protocol client for the openvpn management interface"""
+
+    def __init__(self, port, password, host="127.0.0.1", timeout=5):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.buffer = b""
+        self.notifications = []
+        if password is not None:
+            self.read_until(b"ENTER PASSWORD:")
+            self.send(password)
+            reply = self.read_line()
+            if not reply.startswith("SUCCESS"):
+                raise RuntimeError(f"openvpn management login failed: {reply}")
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, line):
+        self.sock.sendall(line.encode() + b"\n")
+
+    def read_until(self, marker):
+        while marker not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("openvpn closed the management connection")
+            self.buffer += data
+        _, _, self.buffer = self.buffer.partition(marker)
+
+    def read_line(self):
+        """Next reply line, >NOTIFICATION lines are kept aside"""
+        while True:
+            while b"\n" not in self.buffer:
+                data = self.sock.recv(4096)
+                if not data:
+                    raise ConnectionError("openvpn closed the management connection")
+                self.buffer += data
+            line, _, self.buffer = self.buffer.partition(b"\n")
+            line = line.decode(errors="replace").rstrip("\r")
+            if line.startswith(">"):
+                self.notifications.append(line)
+                continue
+            return line
+
+    def command(self, command, multiline=False):
+        """Reply lines of command, multiline replies end with END"""
+        self.send(command)
+        if not multiline:
+            line = self.read_line()
+            if line.startswith("ERROR"):
+                raise RuntimeError(f"{command}: {line}")
+            return [line]
+        lines = []
+        while True:
+            line = self.read_line()
+            if line == "END":
+                return lines
+            if line.startswith("ERROR"):
+                raise RuntimeError(f"{command}: {line}")
+            lines.append(line)
+
+    def states(self):
+        """State history, oldest first: (timestamp, state, local tunnel ip, remote ip)"""
+        states = []
+        for line in self.command("state all", multiline=True):
+            fields = line.split(",")
+            if len(fields) >= 5 and fields[0].isdigit():
+                states.append((int(fields[0]), fields[1], fields[3], fields[4]))
+        return states
+
+    def byte_counts(self):
+        """(bytes in, bytes out) since the client started"""
+        # SUCCESS: nclients=0,bytesin=1234,bytesout=5678
+        reply = self.command("load-stats")[0].partition(":")[2]
+        stats = dict(field.strip().split("=", 1) for field in reply.split(",") if "=" in field)
+        return int(stats.get("bytesin", 0)), int(stats.get("bytesout", 0))
+
+
+def probe_rtt(host, port, timeout=2):
+    """Seconds to open a TCP connection to host:port, None when it failed"""
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout):
+            return time.perf_counter() - start
+    except OSError:
+        return None
+
+
+class VpnCollector:
+    """Samples the management interface, keeps rates, RTTs and reconnect events"""
+
+    def __init__(self, openvpn):
+        self.openvpn = openvpn
+        self.rtt_target = None
+        if openvpn.rtt_target:
+            host, _, port = openvpn.rtt_target.rpartition(":")
+            if not host or not port.isdigit():
+                raise ValueError(f"OPENVPN_RTT_TARGET is host:port, not {openvpn.rtt_target}")
+            self.rtt_target = (host, int(port))
+        self.management = None
+        self.previous = None
+        self.seen_state = 0
+        self.connected_since = None
+        self.reconnects = 0
+        self.events = []
+        self.rtts = []
+        self.status = {"state": "UNKNOWN"}
+
+    def connect(self):
+        if not self.management:
+            self.management = Management(self.openvpn.management_port,
+                                         self.openvpn.management_password())
+        return self.management
+
+    def sample(self):
+        """One poll, returns the status and keeps it in self.status"""
+        now = time.time()
+        try:
+            management = self.connect()
+            states = management.states()
+            bytes_in, bytes_out = management.byte_counts()
+        except (OSError, RuntimeError) as e:
+            if self.management:
+                self.management.close()
+            self.management = None
+            self.status = {"time": now, "state": "UNREACHABLE", "error": str(e)}
+            return self.status
+
+        for timestamp, state, local_ip, remote_ip in states:
+            if timestamp < self.seen_state:
+                continue
+            if (timestamp, state) not in [(e["time"], e["state"]) for e in self.events[-10:]]:
+                self.events.append({"time": timestamp, "state": state})
+                if state == "RECONNECTING":
+                    self.reconnects += 1
+                if state == "CONNECTED":
+                    self.connected_since = timestamp
+            self.seen_state = timestamp
+        self.events = self.events[-50:]
+        state, local_ip, remote_ip = "UNKNOWN", None, None
+        if states:
+            _, state, local_ip, remote_ip = states[-1]
+
+        rate_in = rate_out = None
+        if self.previous and bytes_in >= self.previous[1]:
+            elapsed = now - self.previous[0]
+            if elapsed > 0:
+                rate_in = (bytes_in - self.previous[1]) / elapsed
+                rate_out = (bytes_out - self.previous[2]) / elapsed
+        self.previous = (now, bytes_in, bytes_out)
+
+        rtt = None
+        if state == "CONNECTED" and self.rtt_target:
+            rtt = probe_rtt(*self.rtt_target)
+            if rtt is not None:
+                self.rtts = (self.rtts + [rtt])[-RTT_SAMPLES:]
+
+        self.status = {
+            "time": now,
+            "state": state,
+            "local_ip": local_ip,
+            "remote_ip": remote_ip,
+            "connected_since": self.connected_since,
+            "reconnects": self.reconnects,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "bytes_in_per_second": rate_in,
+            "bytes_out_per_second": rate_out,
+            "rtt": rtt,
+            "rtt_p50": statistics.median(self.rtts) if self.rtts else None,
+            "rtt_max": max(self.rtts) if self.rtts else None,
+            "rtt_samples": list(self.rtts),
+            "events": self.events[-10:],
+        }
+        return self.status
+
+    def write_json(self, path):
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.status, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def write_prometheus(self, path):
+        """Textfile for the node exporter, replaced atomically"""
+        status = self.status
+        lines = [
+            "# HELP deployment_swapper_vpn_up 1 while the openvpn client is connected.",
+            "# TYPE deployment_swapper_vpn_up gauge",
+            f"deployment_swapper_vpn_up {1 if status['state'] == 'CONNECTED' else 0}",
+        ]
+        if "bytes_in" in status:
+            lines += [
+                "# HELP deployment_swapper_vpn_bytes_total Bytes through the tunnel since the client started.",
+                "# TYPE deployment_swapper_vpn_bytes_total counter",
+                f'deployment_swapper_vpn_bytes_total{{direction="in"}} {status["bytes_in"]}',
+                f'deployment_swapper_vpn_bytes_total{{direction="out"}} {status["bytes_out"]}',
+                "# HELP deployment_swapper_vpn_reconnects_total Reconnects seen by the collector.",
+                "# TYPE deployment_swapper_vpn_reconnects_total counter",
+                f"deployment_swapper_vpn_reconnects_total {status['reconnects']}",
+            ]
+        if status.get("bytes_in_per_second") is not None:
+            lines += [
+                "# HELP deployment_swapper_vpn_bytes_per_second Tunnel throughput over the last poll.",
+                "# TYPE deployment_swapper_vpn_bytes_per_second gauge",
+                f'deployment_swapper_vpn_bytes_per_second{{direction="in"}} {status["bytes_in_per_second"]:.1f}',
+                f'deployment_swapper_vpn_bytes_per_second{{direction="out"}} {status["bytes_out_per_second"]:.1f}',
+            ]
+        if status.get("rtt_samples"):
+            samples = status["rtt_samples"]
+            lines += [
+                "# HELP deployment_swapper_vpn_rtt_seconds TCP connect time through the tunnel to OPENVPN_RTT_TARGET.",
+                "# TYPE deployment_swapper_vpn_rtt_seconds summary",
+                f'deployment_swapper_vpn_rtt_seconds{{quantile="0.5"}} {statistics.median(samples):.6f}',
+                f'deployment_swapper_vpn_rtt_seconds{{quantile="1"}} {max(samples):.6f}',
+                f"deployment_swapper_vpn_rtt_seconds_sum {sum(samples):.6f}",
+                f"deployment_swapper_vpn_rtt_seconds_count {len(samples)}",
+            ]
+        if status.get("connected_since"):
+            lines += [
+                "# HELP deployment_swapper_vpn_connected_since_timestamp_seconds Last time the tunnel came up.",
+                "# TYPE deployment_swapper_vpn_connected_since_timestamp_seconds gauge",
+                f"deployment_swapper_vpn_connected_since_timestamp_seconds {status['connected_since']}",
+            ]
+        with open(f"{path}.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+    def run(self, interval=5, json_file=None, metrics_file=None, exit_after=60):
+        """Poll until the openvpn client has been gone for exit_after seconds"""
+        gone_since = None
+        while True:
+            self.sample()
+            if json_file:
+                self.write_json(json_file)
+            if metrics_file:
+                self.write_prometheus(metrics_file)
+            if self.openvpn.get_vpn_pid():
+                gone_since = None
+            else:
+                gone_since = gone_since or time.time()
+                if time.time() - gone_since > exit_after:
+                    return
+            time.sleep(interval)
+
+
+def format_status(status):
+    """Human readable lines of a collector status"""
+    lines = [f"state:       {status['state']}"]
+    if status.get("error"):
+        lines.append(f"error:       {status['error']}")
+    if status.get("local_ip"):
+        lines.append(f"tunnel ip:   {status['local_ip']} (server {status.get('remote_ip')})")
+    if status.get("connected_since"):
+        lines.append("connected:   {} ({} reconnects)".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(status["connected_since"])),
+            status["reconnects"]))
+    if "bytes_in" in status:
+        lines.append(f"bytes:       {status['bytes_in']} in, {status['bytes_out']} out")
+    if status.get("bytes_in_per_second") is not None:
+        lines.append("throughput:  {:.1f} KB/s in, {:.1f} KB/s out".format(
+            status["bytes_in_per_second"] / 1024, status["bytes_out_per_second"] / 1024))
+    if status.get("rtt_p50") is not None:
+        lines.append("rtt:         {:.1f} ms last, {:.1f} ms p50, {:.1f} ms max".format(
+            (status["rtt"] or 0) * 1000, status["rtt_p50"] * 1000, status["rtt_max"] * 1000))
+    for event in status.get("events", []):
+        lines.append("event:       {} {}".format(
+            time.strftime("%H:%M:%S", time.localtime(event["time"])), event["state"]))
+    return "\n".join(lines)